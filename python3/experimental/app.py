@@ -16,12 +16,26 @@ if (installpath != ""):
 # Remote object reference, lazy initialized
 sysinfo = None
 
+# Database connection pool shared by all requests, lazy initialized, so the
+# app runs with only bottle installed until a page needs the database
+wikidb = None
+
+def wikiDatabase ():
+    '''Return the database dedicated to the wiki, connecting on first use.'''
+    global wikidb
+    if (wikidb is None):
+        from winter import database
+        wikidb = database.Database ("localhost", 27017, "wiki")
+    return wikidb.database
+
 def normalizeResource (resource):
     '''Fix unruly slashes in the resource path.'''
-    # Replace multiple slashes with one slash throughout entire path
-    resource = re.sub (r'//+', r'/', resource)
+    # Replace multiple slashes with one slash throughout entire path, when there are any
+    if ('//' in resource):
+        resource = re.sub (r'//+', r'/', resource)
     # If after all replacement, there is only one slash left and nothing else, remove it
-    resource = re.sub (r'^/$', r'', resource)
+    if (resource == '/'):
+        return ''
     return resource
 
 def normalizeScriptName (request):
@@ -72,7 +86,7 @@ def helloRootGet  ():
     '''Special case of get of resource when resource is empty.'''
     normalizeScriptName (request)
     return template ('root.tpl', links = [
-        'abc', 'abc/+', 'json', 'json/+/history?page=3&size=20', 'x/y/z', '+'])
+        'abc', 'abc/+', 'json', 'json/+/history?before=100&size=20', 'x/y/z', '+'])
 
 @get ('/+')
 def helloRootAllMetadata ():
@@ -92,9 +106,7 @@ def helloResourceAllMetadata (resource):
     normalizeScriptName (request)
     resource = normalizeResource (resource)
     if (resource == ''):
-        import pymongo
-        client = pymongo.MongoClient ("localhost", 27017)
-        db = client.wiki                        # database dedicated to the wiki
+        db = wikiDatabase ()                    # database dedicated to the wiki
         return template ("The database name is '{{name}}'", name=db.name)
         #=======================================================================
         # db.my_collection                        # Collection(Database(MongoClient('localhost', 27017), u'wiki'), u'my_collection')
@@ -107,7 +119,6 @@ def helloResourceAllMetadata (resource):
         # db.my_collection.create_index("x")      # u'x_1'
         # for item in db.my_collection.find().sort("x", pymongo.ASCENDING):
         #     print (item["x"])
-        # [item["x"] for item in db.my_collection.find().limit(2).skip(1)]        # [8, 11]
         #=======================================================================
     return template ("List all metadata associated with resource '/{{resource}}'", resource=resource)
 
@@ -116,13 +127,13 @@ def helloResourceHistory (resource):
     '''History associated with a resource.'''
     normalizeScriptName (request)
     resource = normalizeResource (resource)
-    # Pagination
-    pagenum = request.query.page or '1'
+    # Pagination by cursor, the generation to list revisions before
+    before = request.query.before or 'latest'
     pagesize = request.query.size or '10'
     # Result
     return template (
-        "Obtain history associated with resource '/{{resource}}', page {{page}} size {{size}}",
-        resource=resource, page=pagenum, size=pagesize)
+        "Obtain history associated with resource '/{{resource}}', before {{before}} size {{size}}",
+        resource=resource, before=before, size=pagesize)
 
 @get ('/<resource:path>')
 def helloResourceGet (resource):
@@ -0,0 +1,255 @@
+# This file is part of Winter, a wiki-based computing platform.
+# Copyright (C) 2026  Max Polk <maxpolk@gmail.com>
+# License located at http://www.gnu.org/licenses/agpl-3.0.html
+'''
+Benchmarks of the parts of Winter whose speed matters most, run on synthetic
+wikis, with results as JSON so runs of different releases can be compared.
+
+    read: static GET requests per second and latency percentiles of the web
+        server, serving every resource of the wiki from a store.FileStore
+    cascade: resources recalculated per second by the calc server, for the
+        whole wiki and for single changes
+    release: the same through staging.release, writing to a resources
+        collection, when there is one
+    notify: latency from a status change to its arrival on each of many
+        WebSocket connections following the resource
+
+Clients run in the same process as the servers they measure, so numbers are
+for comparing runs on the same machine, not capacity planning.
+'''
+
+# Requires version 3, say it now rather than fail mysteriously later.
+# Won't work if you use Python 3 exclusive syntax anywhere in the file.
+import sys
+if (sys.version_info.major < 3):
+    exit ("Requires python 3")
+
+# Library imports
+import asyncio
+import json
+import platform
+import random
+import socket
+import tempfile
+import time
+import tornado.httpclient
+import tornado.websocket
+
+# Import the current package to get package vars like winter.software_name
+import winter
+from winter import calc, notify, staging, store, web
+
+# Module short description
+module_description = "benchmark module"
+
+def syntheticWiki (nodes=1000, fanout=3, cycles=0.01, seed=0):
+    '''
+    Return the resources of a synthetic wiki of nodes resources.  The first
+    few are data, the rest Python code summing up to fanout earlier resources;
+    a fraction cycles of them also refer to a later resource, closing a cycle.
+    The same seed gives the same wiki.
+    '''
+    generator = random.Random (seed)
+    resources = []
+    for number in range (nodes):
+        name = "n{}".format (number)
+        if (number < max (1, fanout)):
+            resources.append ({"name": name, "kind": "data", "source": number,
+                               "references": []})
+            continue
+        references = sorted (set ("n{}".format (generator.randrange (number))
+                                  for count in range (fanout)))
+        if (number < nodes - 1 and generator.random () < cycles):
+            references.append ("n{}".format (generator.randrange (number + 1, nodes)))
+        source = "result = (1 + {}) % 1000".format (
+            " + ".join ('(ref ("{}") or 0)'.format (ref) for ref in references))
+        resources.append ({"name": name, "kind": "code", "language": "python",
+                           "source": source, "references": references})
+    return resources
+
+def percentile (values, fraction):
+    '''Return the value below which a fraction of values fall, or None.'''
+    if (not values):
+        return None
+    ordered = sorted (values)
+    return ordered[min (len (ordered) - 1, int (fraction * len (ordered)))]
+
+def latencies (values):
+    '''Summarize seconds as milliseconds, each None when there are no samples.'''
+    if (not values):
+        return {"samples": 0, "p50_ms": None, "p99_ms": None, "max_ms": None}
+    return {
+        "samples": len (values),
+        "p50_ms": percentile (values, 0.5) * 1000,
+        "p99_ms": percentile (values, 0.99) * 1000,
+        "max_ms": max (values) * 1000
+    }
+
+def unusedPort ():
+    '''Return a local port nothing listens on right now.'''
+    with socket.socket () as probe:
+        probe.bind (("127.0.0.1", 0))
+        return probe.getsockname ()[1]
+
+def changeSource (resource, generator):
+    '''Return a copy of a data resource with new source.'''
+    return dict (resource, source=generator.randrange (1000000))
+
+def benchCascade (resources, changes=100, workers=1, seed=0):
+    '''
+    Calculate the whole wiki, then change one random data resource at a time,
+    changes times.  Returns the rates of both.
+    '''
+    generator = random.Random (seed)
+    server = calc.CalcServer (calc.Evaluator (), workers)
+    try:
+        start = time.perf_counter ()
+        total = len (server.change (resources))
+        full = time.perf_counter () - start
+        data = [resource for resource in resources if resource["kind"] == "data"]
+        calculated = 0
+        times = []
+        for count in range (changes):
+            start = time.perf_counter ()
+            calculated += len (server.change ([changeSource (generator.choice (data), generator)]))
+            times.append (time.perf_counter () - start)
+    finally:
+        server.close ()
+    return dict (latencies (times), **{
+        "workers": server.executor.workers,
+        "full_seconds": full,
+        "full_per_second": total / full,
+        "changes": changes,
+        "calculated_per_change": calculated / max (1, changes),
+        "calculated_per_second": calculated / max (sum (times), 1e-9)
+    })
+
+def benchRelease (collection, resources, releases=20, seed=0):
+    '''
+    Release stages of changed data resources through staging.release into
+    collection, emptied first and after.  Returns the rate of releases.
+    '''
+    generator = random.Random (seed)
+    server = calc.CalcServer (calc.Evaluator ())
+    data = [resource for resource in resources if resource["kind"] == "data"]
+    collection.delete_many ({})
+    try:
+        stage = staging.Stage ("benchmark")
+        for resource in resources:
+            stage.put (resource)
+        start = time.perf_counter ()
+        staging.release (stage, collection, server)
+        full = time.perf_counter () - start
+        times = []
+        for count in range (releases):
+            for resource in generator.sample (data, min (len (data), 5)):
+                stage.put (changeSource (resource, generator))
+            start = time.perf_counter ()
+            staging.release (stage, collection, server)
+            times.append (time.perf_counter () - start)
+    finally:
+        collection.delete_many ({})
+        server.close ()
+    return dict (latencies (times), full_seconds=full, releases=releases)
+
+async def benchRead (resources, requests=10000, concurrency=50):
+    '''
+    Publish the wiki to a store, then GET random resources with concurrency
+    requests in flight.  Returns requests per second and latencies.
+    '''
+    generator = random.Random (0)
+    with tempfile.TemporaryDirectory () as directory:
+        filestore = store.FileStore (directory)
+        for resource in resources:
+            content = str (resource.get ("source", "")).encode ('utf-8')
+            filestore.publish (resource["name"], 1, {("text/plain", ""): content})
+        port = unusedPort ()
+        server = web.WebServer (filestore, port=port)
+        server.listen ()
+        client = tornado.httpclient.AsyncHTTPClient (force_instance=True,
+                                                     max_clients=concurrency)
+        names = [generator.choice (resources)["name"] for count in range (requests)]
+        times = []
+        failures = 0
+
+        async def worker ():
+            nonlocal failures
+            while (names):
+                url = "http://127.0.0.1:{}/{}".format (port, names.pop ())
+                start = time.perf_counter ()
+                response = await client.fetch (url, raise_error=False)
+                times.append (time.perf_counter () - start)
+                if (response.code != 200):
+                    failures += 1
+
+        try:
+            start = time.perf_counter ()
+            await asyncio.gather (*(worker () for count in range (concurrency)))
+            elapsed = time.perf_counter () - start
+        finally:
+            client.close ()
+            server.server.stop ()
+    return dict (latencies (times), requests=requests, concurrency=concurrency,
+                 failures=failures, requests_per_second=requests / elapsed)
+
+async def benchNotify (sockets=100, messages=50):
+    '''
+    Connect sockets WebSocket clients following one resource, then publish
+    messages changes of it one at a time, each once all clients received the
+    last.  Returns the latency of every delivery.
+    '''
+    port = unusedPort ()
+    server = notify.NotifyServer (port=port, window=0)
+    server.listen ()
+    url = "ws://127.0.0.1:{}/".format (port)
+    connections = []
+    try:
+        for count in range (sockets):
+            connection = await tornado.websocket.websocket_connect (url)
+            connection.write_message (json.dumps ({"subscribe": ["bench"]}))
+            connections.append (connection)
+        while (len (server.subscribers.get ("bench", ())) < sockets):
+            await asyncio.sleep (0.01)
+        times = []
+
+        async def receive (connection, start):
+            await connection.read_message ()
+            times.append (time.perf_counter () - start)
+
+        for generation in range (messages):
+            start = time.perf_counter ()
+            server.publish ({"resource": "bench", "generation": generation,
+                             "status": "ready", "eta": None})
+            await asyncio.gather (*(receive (connection, start)
+                                    for connection in connections))
+    finally:
+        for connection in connections:
+            connection.close ()
+        server.stop ()
+    return dict (latencies (times), sockets=sockets, messages=messages)
+
+def run (nodes=1000, fanout=3, cycles=0.01, requests=10000, concurrency=50,
+         sockets=100, workers=1, collection=None):
+    '''
+    Run every benchmark on one synthetic wiki and return the results.  The
+    release benchmark runs only with a collection to write to.
+    '''
+    resources = syntheticWiki (nodes, fanout, cycles)
+    results = {
+        "database": type (collection).__name__ if collection is not None else None,
+        "software": winter.software_name,
+        "version": winter.software_version,
+        "python": platform.python_version (),
+        "time": time.time (),
+        "wiki": {"nodes": nodes, "fanout": fanout, "cycles": cycles},
+        "cascade": benchCascade (resources, workers=workers)
+    }
+    if (collection is not None):
+        results["release"] = benchRelease (collection, resources)
+    results["read"] = asyncio.run (benchRead (resources, requests, concurrency))
+    results["notify"] = asyncio.run (benchNotify (sockets))
+    return results
+
+# Running modules as top-level scripts is an antipattern, use bin/snow instead
+if __name__ == '__main__':
+    pass
@@ -3,6 +3,16 @@
 # License located at http://www.gnu.org/licenses/agpl-3.0.html
 '''
 Calc server that recalculates resources after they have been changed.
+
+A resource is a dictionary with at least a "name", and usually these:
+    "kind": "data" or "code", or "validator" (see classify)
+    "language": language of a code resource, like "python"
+    "source": the immediate data, or the code to run
+    "references": names of other resources it refers to
+
+A resource observes the resources it refers to.  When a resource changes, only
+it and the resources observing it, recursively, are recalculated, in an order
+where references are always calculated before their observers.
 '''
 
 # Requires version 3, say it now rather than fail mysteriously later.
@@ -12,19 +22,1124 @@ if (sys.version_info.major < 3):
     exit ("Requires python 3")
 
 # Library imports
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.util
+import os
 import pymongo
+import threading
+import time
 
 # Import the current package to get package vars like winter.software_name
 import winter
+from winter import codecache, database, interp, metrics, notify, refresh, staging
 
 # Module short description
 module_description = "calc server module"
 
+# Metrics of the calc server, see metrics
+recompute_seconds = metrics.registry.histogram (
+    "calc_recompute_seconds", "Seconds to calculate one resource")
+cascade_seconds = metrics.registry.histogram (
+    "calc_cascade_seconds", "Seconds per cascade")
+cascade_size = metrics.registry.histogram (
+    "calc_cascade_size", "Resources calculated per cascade",
+    (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000))
+cutoff_total = metrics.registry.counter (
+    "calc_cutoff_total", "Observers not calculated since nothing they refer to changed")
+queue_depth = metrics.registry.gauge (
+    "calc_queue_depth", "Changes submitted waiting for the next step")
+
+class Evaluator (object):
+    '''
+    Evaluates resources: a data resource, or a validator (see classify),
+    evaluates to its source, and Python 3
+    code is run internally, compiled once per distinct source by a
+    codecache.CodeCache, kept under directory when there is one.
+
+    Python code sees its references through ref (name), the generation it is
+    calculating as generation, and evaluates to whatever it sets result to:
+
+        result = ref ("price") * ref ("quantity")
+
+    Other languages are evaluated by external interpreters, see interp.  The
+    interpreters map each language to the settings of its pool, keyword
+    arguments of interp.InterpreterPool, like:
+
+        {"ruby": {"command": ["ruby", "winter-worker.rb"], "size": 4}}
+
+    The evaluator is called as evaluate (resource, inputs, generation), where
+    inputs map each reference name to its last calculated value, and generation
+    is the number the resource will have once calculated.  It is sent once to
+    each worker process of a PoolExecutor, which keeps its own cache and
+    interpreters for as long as it runs, see startWorker.
+    '''
+    def __init__ (self, directory=None, interpreters=None):
+        self.directory = directory
+        self.interpreters = interpreters or {}
+        self._codes = None
+        self._pools = {}
+
+    def __getstate__ (self):
+        return {'directory': self.directory, 'interpreters': self.interpreters,
+                '_codes': None, '_pools': {}}
+
+    @property
+    def codes (self):
+        '''The code cache of this process, created on first use.'''
+        if (self._codes is None):
+            self._codes = codecache.CodeCache (self.directory)
+        return self._codes
+
+    def __call__ (self, resource, inputs, generation):
+        if (resource.get ('kind', 'data') in ('data', 'validator')):
+            return resource.get ('source')
+        language = resource.get ('language')
+        if (language == 'python'):
+            return self.evaluatePython (resource, inputs, generation)
+        if (language in self.interpreters):
+            return self.pool (language).evaluate (resource, inputs, generation)
+        raise Exception ("ERROR: no interpreter for language {} of resource {}".format (
+            resource.get ('language'), resource['name']))
+
+    def evaluatePython (self, resource, inputs, generation):
+        '''Run a Python code resource and return its result.'''
+        code = self.codes.compile (resource.get ('source', ''), resource['name'])
+        namespace = {
+            '__name__': resource['name'],
+            'ref': inputs.__getitem__,
+            'generation': generation,
+            'result': None
+        }
+        exec (code, namespace)
+        return namespace['result']
+
+    def pool (self, language):
+        '''The interpreter pool of a language in this process.'''
+        pool = self._pools.get (language)
+        if (pool is None):
+            pool = interp.InterpreterPool (**self.interpreters[language])
+            self._pools[language] = pool
+        return pool
+
+    def supervise (self):
+        '''Keep the interpreter pools full of running interpreters.'''
+        for language in self.interpreters:
+            self.pool (language).supervise ()
+
+    def close (self):
+        '''Stop all interpreters.'''
+        for pool in self._pools.values ():
+            pool.close ()
+        self._pools = {}
+
+# Default evaluation of resources, without a directory to keep compiled code
+evaluateResource = Evaluator ()
+
+def digestValue (value):
+    '''
+    Return a digest of a calculated value, the same for equal values.  Values
+    other than bytes and strings are digested by their repr, so occasionally
+    equal values differ, which only costs an unneeded calculation.
+    '''
+    if (isinstance (value, bytes)):
+        data = b'b' + value
+    elif (isinstance (value, str)):
+        data = b's' + value.encode ('utf-8', 'surrogatepass')
+    else:
+        data = b'r' + repr (value).encode ('utf-8', 'surrogatepass')
+    return hashlib.sha256 (data).digest ()
+
+def evaluateUnits (evaluate, units):
+    '''
+    Evaluate a list of units and return, for each unit, the list of (value,
+    seconds, error) for each resource, seconds being the time evaluation
+    took, and error None, or the description of the exception evaluation
+    raised, value being None then.
+
+    A unit is a list of (resource, inputs, generation) to evaluate in order,
+    usually a single resource, or the resources of one cycle.  Values
+    calculated earlier in a unit replace the inputs of later ones referring to
+    them.  Runs in worker processes too, so evaluate must be picklable.
+    '''
+    results = []
+    for unit in units:
+        values = {}
+        unit_values = []
+        for resource, inputs, generation in unit:
+            for ref in inputs:
+                if (ref in values):
+                    inputs[ref] = values[ref]
+            start = time.perf_counter ()
+            try:
+                value = evaluate (resource, inputs, generation)
+                error = None
+                values[resource['name']] = value
+            except Exception as ex:
+                value = None
+                error = "{}: {}".format (type (ex).__name__, str (ex))
+            unit_values.append ((value, time.perf_counter () - start, error))
+        results.append (unit_values)
+    return results
+
+class SerialExecutor (object):
+    '''
+    Evaluates units one after another in the calling process.
+    '''
+    def __init__ (self, evaluate):
+        self.evaluate = evaluate
+        self.workers = 1
+
+    def run (self, units):
+        '''Return the list of (value, seconds, error) for each unit.'''
+        return evaluateUnits (self.evaluate, units)
+
+    def close (self):
+        pass
+
+# The evaluate of this worker process of a PoolExecutor, see startWorker
+worker_evaluate = None
+
+def startWorker (evaluate):
+    '''
+    Start a worker process of a PoolExecutor: keep the one evaluate it was
+    sent, and its code cache and interpreters with it, for every batch, and
+    close it when the process exits.
+    '''
+    global worker_evaluate
+    worker_evaluate = evaluate
+    if (hasattr (evaluate, "close")):
+        multiprocessing.util.Finalize (None, evaluate.close, exitpriority=10)
+
+def evaluateBatch (units):
+    '''Evaluate units in a worker process, see startWorker.'''
+    return evaluateUnits (worker_evaluate, units)
+
+class PoolExecutor (object):
+    '''
+    Evaluates independent units on a pool of worker processes.
+
+    Units are grouped into batches of at least batch resources, so that small
+    resources don't pay the cost of a round trip to a worker each.  When there
+    aren't enough resources to fill more than one batch, they are evaluated in
+    the calling process instead.  The pool is created when first needed,
+    using the spawn start method like the rest of Winter, once however many
+    threads need it at the same time.  Evaluate is sent once to each worker
+    process, see startWorker, not with every batch.
+    '''
+    def __init__ (self, evaluate, workers=None, batch=64):
+        self.evaluate = evaluate
+        self.workers = workers or os.cpu_count () or 1
+        self.batch = batch
+        self.pool = None
+        self.lock = threading.Lock ()   # held creating and closing the pool
+
+    def run (self, units):
+        '''Return the list of (value, seconds, error) for each unit.'''
+        total = sum (len (unit) for unit in units)
+        if (total <= self.batch):
+            return evaluateUnits (self.evaluate, units)
+        # Spread over all workers, but never below the batch size
+        size = max (self.batch, -(-total // self.workers))
+        batches = []
+        current = []
+        count = 0
+        for unit in units:
+            current.append (unit)
+            count += len (unit)
+            if (count >= size):
+                batches.append (current)
+                current = []
+                count = 0
+        if (current):
+            batches.append (current)
+        with self.lock:
+            if (self.pool is None):
+                self.pool = concurrent.futures.ProcessPoolExecutor (
+                    max_workers = self.workers,
+                    mp_context = multiprocessing.get_context ("spawn"),
+                    initializer = startWorker,
+                    initargs = (self.evaluate,))
+            pool = self.pool
+        futures = [pool.submit (evaluateBatch, batch) for batch in batches]
+        results = []
+        for future in futures:
+            results.extend (future.result ())
+        return results
+
+    def close (self):
+        with self.lock:
+            pool = self.pool
+            self.pool = None
+        if (pool is not None):
+            pool.shutdown ()
+
+class DependencyGraph (object):
+    '''
+    References between resources, indexed in both directions.
+
+    For each resource the graph keeps the names it refers to (references), and
+    the reverse index of names that refer to it (observers), so the resources
+    affected by a change are found by walking only the affected edges.
+    '''
+    def __init__ (self):
+        self.references = {}            # name -> set of names it refers to
+        self.observers = {}             # name -> set of names referring to it
+
+    def __contains__ (self, name):
+        return name in self.references
+
+    def __len__ (self):
+        return len (self.references)
+
+    def setReferences (self, name, references):
+        '''Add a resource or replace the references of an existing one.'''
+        references = set (references)
+        old = self.references.get (name, set ())
+        for ref in old - references:
+            self._unobserve (ref, name)
+        for ref in references - old:
+            self.observers.setdefault (ref, set ()).add (name)
+        self.references[name] = references
+
+    def remove (self, name):
+        '''
+        Remove a resource and the references it makes.  Observers of it keep
+        their references, which dangle until the resource is created again.
+        '''
+        for ref in self.references.pop (name, ()):
+            self._unobserve (ref, name)
+
+    def _unobserve (self, ref, name):
+        observers = self.observers.get (ref)
+        if (observers is not None):
+            observers.discard (name)
+            if (not observers):
+                del self.observers[ref]
+
+    def dirty (self, changed):
+        '''
+        Return the set of changed names plus all their observers, recursively.
+        Cost is proportional to the size of the result, not the whole graph.
+        '''
+        dirty = set (changed)
+        pending = list (dirty)
+        while (pending):
+            name = pending.pop ()
+            for observer in self.observers.get (name, ()):
+                if (observer not in dirty):
+                    dirty.add (observer)
+                    pending.append (observer)
+        return dirty
+
+    def components (self, names):
+        '''
+        Return the strongly connected components of the subgraph made of names,
+        as lists of names, ordered so references come before their observers.
+
+        A component with more than one name (or a name referring to itself) is
+        a cycle, whose names are sorted so they are always calculated in the
+        same order.  Uses an iterative Tarjan algorithm so deep reference
+        chains can't exhaust the recursion limit.
+        '''
+        names = set (names)
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set ()
+        result = []
+        for root in names:
+            if (root in index):
+                continue
+            index[root] = low[root] = len (index)
+            stack.append (root)
+            on_stack.add (root)
+            work = [(root, iter (self.references.get (root, ())))]
+            while (work):
+                node, edges = work[-1]
+                for ref in edges:
+                    if (ref not in names):
+                        continue
+                    if (ref not in index):
+                        # Descend into the reference first
+                        index[ref] = low[ref] = len (index)
+                        stack.append (ref)
+                        on_stack.add (ref)
+                        work.append ((ref, iter (self.references.get (ref, ()))))
+                        break
+                    elif (ref in on_stack):
+                        low[node] = min (low[node], index[ref])
+                else:
+                    # All references of node visited
+                    work.pop ()
+                    if (work):
+                        parent = work[-1][0]
+                        low[parent] = min (low[parent], low[node])
+                    if (low[node] == index[node]):
+                        component = []
+                        while (True):
+                            name = stack.pop ()
+                            on_stack.discard (name)
+                            component.append (name)
+                            if (name == node):
+                                break
+                        component.sort ()
+                        result.append (component)
+        return result
+
+    def levels (self, components):
+        '''
+        Group components, ordered as returned by the components method, into
+        levels.  Components of the same level don't refer to each other, so
+        they can be calculated at the same time, after all earlier levels.
+        '''
+        level_of = {}
+        levels = []
+        for component in components:
+            level = 0
+            for name in component:
+                for ref in self.references.get (name, ()):
+                    if (ref in level_of):
+                        level = max (level, level_of[ref] + 1)
+            for name in component:
+                level_of[name] = level
+            if (level == len (levels)):
+                levels.append ([])
+            levels[level].append (component)
+        return levels
+
 class CalcServer (object):
     '''
     The calc server of Winter.
+
+    Holds the resources, their dependency graph, and the last calculated value
+    and generation number of each resource.  Every time a resource is
+    calculated its generation number goes up by one.
+
+    Cyclical references are bounded by generation numbers: in a cascade each
+    resource is calculated at most once, so within a cycle a resource sees the
+    value of generation n for references already calculated in this cascade,
+    and generation n-1 for the rest, including itself.  For example a resource
+    "A" referring to itself can be declared as A(n) = A(n-1) + 1.
+
+    Changes are submitted, then applied together by the next step, which runs
+    a whole cascade, one generation.  Changes submitted meanwhile wait for the
+    step after, so one change never gets ahead of the rest of a cascade.
+
+    The time each resource takes to calculate is remembered, as a moving
+    average, to estimate the expected time of arrival of each resource in a
+    cascade.  The listener, if any, is called with a list of status documents
+    for the notify server (see notify.status_collection):
+        { "_id": name, "generation": n, "status": "computing", "eta": t }
+    as a cascade starts, and the same with status "ready" and no eta as each
+    level of it is done.
     '''
-    pass
+    # Weight of the latest time in the moving average of calculation times
+    smoothing = 0.3
+
+    def __init__ (self, evaluate=None, workers=1, batch=64, listener=None, executor=None):
+        '''
+        The evaluate function is called as evaluate (resource, inputs,
+        generation) and returns the calculated value, see evaluateResource.
+
+        With workers other than 1, independent resources of a cascade are
+        evaluated on a pool of that many processes (0 or None for one per
+        CPU), in batches of at least batch resources, see PoolExecutor.  An
+        executor given replaces either, like cluster.QueueExecutor to spread
+        cascades over several machines.
+        '''
+        self.evaluate = evaluate or evaluateResource
+        if (executor is not None):
+            self.executor = executor
+        elif (workers == 1):
+            self.executor = SerialExecutor (self.evaluate)
+        else:
+            self.executor = PoolExecutor (self.evaluate, workers, batch)
+        self.graph = DependencyGraph ()
+        self.resources = {}             # name -> resource
+        self.values = {}                # name -> last calculated value
+        self.generations = {}           # name -> generation of value
+        self.digests = {}               # name -> digest of value
+        self.errors = {}                # name -> error of its last calculation
+        self.unsettled = set ()         # names modified by a failed cascade, see cascade
+        self.durations = {}             # name -> average seconds to calculate
+        self.listener = listener
+        self.pending = {}               # name -> resource, or None to remove
+        self.lock = threading.Lock ()
+        self.graph_lock = threading.Lock ()     # held changing the graph or values, see preview
+
+    def change (self, resources=(), removed=()):
+        '''
+        Store changed resources and remove deleted ones by name, then run a
+        single cascade over everything affected, together with anything
+        submitted before.  Returns the names calculated, in the order they
+        were calculated.
+        '''
+        self.submit (resources, removed)
+        return self.step ()
+
+    def submit (self, resources=(), removed=()):
+        '''
+        Queue changed resources and names of removed ones for the next step.
+        May be called from any thread.
+        '''
+        with self.lock:
+            for resource in resources:
+                self.pending[resource['name']] = resource
+            for name in removed:
+                self.pending[name] = None
+            queue_depth.set (len (self.pending))
+
+    def step (self):
+        '''
+        Apply all changes submitted so far and run their cascade.  Returns the
+        names calculated, in the order they were calculated.
+        '''
+        return self.apply (self.take ())
+
+    def take (self):
+        '''
+        Return the changes submitted so far, by name, a resource or None to
+        remove, to be applied by apply.
+        '''
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            queue_depth.set (0)
+        return pending
+
+    def apply (self, pending):
+        '''
+        Apply changes returned by take and run their cascade.  Returns the
+        names calculated.  When the cascade fails, the changes are submitted
+        again for the next step, and the names whose values it did change are
+        kept unsettled, so that step brings their observers up to date too.
+        '''
+        with self.graph_lock:
+            for name, resource in pending.items ():
+                if (resource is not None):
+                    self.resources[name] = resource
+                    self.graph.setReferences (name, resource.get ('references', ()))
+                else:
+                    self.resources.pop (name, None)
+                    self.values.pop (name, None)
+                    self.generations.pop (name, None)
+                    self.digests.pop (name, None)
+                    self.errors.pop (name, None)
+                    self.durations.pop (name, None)
+                    self.graph.remove (name)
+        changed = set (pending) | self.unsettled
+        if (not changed):
+            return []
+        try:
+            calculated = self.cascade (changed)
+            self.unsettled = set ()
+            return calculated
+        except BaseException:
+            # Keep the changes for the next step, unless replaced meanwhile
+            with self.lock:
+                for name, resource in pending.items ():
+                    self.pending.setdefault (name, resource)
+                queue_depth.set (len (self.pending))
+            raise
+
+    def cascade (self, changed):
+        '''
+        Recalculate the changed names and their observers, recursively, with
+        references calculated before observers.  Independent resources are
+        handed to the executor together, one level at a time.  Returns the
+        names calculated.
+
+        Cuts off early: an observer is only calculated when the value of
+        something it refers to actually changed, judged by digest, so a change
+        that doesn't change a value stops there.
+
+        A resource whose evaluation raises keeps its last value, and its error
+        is kept in errors until it calculates again, reported with status
+        "error".  Its observers are cut off like those of a value that didn't
+        change, and everything else is calculated as usual.
+
+        Values are stored a level at a time, so when a later level fails the
+        values already changed are added to unsettled, counting as modified
+        for the next cascade although their digests are stored.
+        '''
+        start = time.perf_counter ()
+        calculated = []
+        # Names removed, or never created, count as modified, as do unsettled ones
+        modified = set (name for name in changed if name not in self.resources)
+        modified.update (self.unsettled)
+        try:
+            self.calculateLevels (changed, modified, calculated)
+        except BaseException:
+            self.unsettled.update (modified)
+            raise
+        cascade_size.observe (len (calculated))
+        cascade_seconds.observe (time.perf_counter () - start)
+        return calculated
+
+    def calculateLevels (self, changed, modified, calculated):
+        '''
+        The levels of cascade, adding the names whose value changed to
+        modified, and those calculated to calculated.  The listener hears of
+        each level as it is calculated, and only of the names scheduled, so
+        names cut off cost no status at all.
+        '''
+        components = self.graph.components (self.graph.dirty (changed))
+        levels = self.graph.levels (components)
+        if (self.listener is not None):
+            etas = self.estimate (levels)
+        for level in levels:
+            units = []
+            for component in level:
+                # Skip names removed, or referred to but never created
+                names = [name for name in component if name in self.resources]
+                if (any (name in changed or not self.graph.references[name].isdisjoint (modified)
+                         for name in names)):
+                    units.append ([self.prepare (self.resources[name]) for name in names])
+                else:
+                    cutoff_total.inc (len (names))
+            if (not units):
+                continue
+            scheduled = [resource['name'] for unit in units for resource, inputs, generation in unit]
+            if (self.listener is not None):
+                self.listener ([self.status (name, "computing", etas[name]) for name in scheduled])
+            results = list (zip (units, self.executor.run (units)))
+            # Stored a level at a time, so previews take whole levels
+            with self.graph_lock:
+                for unit, values in results:
+                    for (resource, inputs, generation), (value, seconds, error) in zip (unit, values):
+                        name = resource['name']
+                        self.generations[name] = generation
+                        if (error is not None):
+                            self.errors[name] = error
+                        else:
+                            self.errors.pop (name, None)
+                            digest = digestValue (value)
+                            if (digest != self.digests.get (name)):
+                                modified.add (name)
+                            self.values[name] = value
+                            self.digests[name] = digest
+                        average = self.durations.get (name, seconds)
+                        self.durations[name] = average + self.smoothing * (seconds - average)
+                        recompute_seconds.observe (seconds)
+                        calculated.append (name)
+            if (self.listener is not None):
+                self.listener ([self.status (name, "error" if name in self.errors else "ready")
+                                for name in scheduled])
+
+    def estimate (self, levels):
+        '''
+        Return the expected time of arrival, in seconds since the epoch, of
+        each resource in levels as returned by DependencyGraph.levels.  Each
+        level takes the longer of its longest resource, and its total time
+        shared by the workers.  Resources never calculated yet are expected to
+        take the average time of all resources.
+        '''
+        default = (sum (self.durations.values ()) / len (self.durations)
+                   if self.durations else 0.001)
+        etas = {}
+        eta = time.time ()
+        for level in levels:
+            names = [name for component in level for name in component
+                     if name in self.resources]
+            durations = [self.durations.get (name, default) for name in names]
+            if (durations):
+                eta += max (max (durations), sum (durations) / self.executor.workers)
+            for name in names:
+                etas[name] = eta
+        return etas
+
+    def status (self, name, status, eta=None):
+        '''
+        Return the status document of a resource, with its error if any, and
+        the digest of its last value in hex, so cut off survives a restart.
+        '''
+        document = {
+            "_id": name,
+            "generation": self.generations.get (name, 0),
+            "status": status,
+            "eta": eta
+        }
+        if (name in self.digests):
+            document["digest"] = self.digests[name].hex ()
+        if (status == "error"):
+            document["error"] = self.errors[name]
+        return document
+
+    def prepare (self, resource):
+        '''
+        Return the (resource, inputs, generation) needed to calculate a
+        resource from the current values of its references.
+        '''
+        name = resource['name']
+        inputs = {ref: self.values.get (ref)
+                  for ref in resource.get ('references', ())}
+        return (resource, inputs, self.generations.get (name, 0) + 1)
+
+    def preview (self, changes):
+        '''
+        Return an Overlay of what values would be if changes, a dict of name
+        to resource or None to remove, were applied, without applying them.
+        May be called from any thread, sharing the executor.
+        '''
+        return Overlay (self, changes)
+
+    def close (self):
+        '''Release worker processes, if any.'''
+        self.executor.close ()
+
+class Overlay (object):
+    '''
+    Values of a calc server as they would be with some changes applied, for
+    previews of unreleased changes.
+
+    Only the changed resources and their observers, recursively, are
+    calculated, with the same cut off as a cascade; every other value is read
+    from the calc server, so an overlay holds nothing but what it calculated
+    and what that was calculated from, and many can exist at once.  What it
+    calculates from is taken from the calc server at once when it is made, so
+    a cascade running meanwhile can't mix generations into it.  Values of
+    other resources are read from the calc server as last calculated.
+    '''
+    def __init__ (self, server, changes):
+        self.server = server
+        self.changes = dict (changes)   # name -> resource, or None to remove
+        self.base = {}                  # name -> (resource, value, generation, digest) when made
+        self.values = {}                # name -> value calculated here
+        self.generations = {}           # name -> generation of value
+        self.errors = {}                # name -> error calculating it here
+        self.calculated = []            # names calculated, in order
+        self.calculate ()
+
+    def __contains__ (self, name):
+        return self.resource (name) is not None
+
+    def resource (self, name):
+        '''Return a resource as changed, or None if there is none.'''
+        if (name in self.changes):
+            return self.changes[name]
+        if (name in self.base):
+            return self.base[name][0]
+        return self.server.resources.get (name)
+
+    def value (self, name):
+        '''Return the value of a resource as changed.'''
+        if (name in self.values):
+            return self.values[name]
+        if (name in self.changes):
+            return None
+        if (name in self.base):
+            return self.base[name][1]
+        return self.server.values.get (name)
+
+    def generation (self, name):
+        if (name in self.generations):
+            return self.generations[name]
+        if (name in self.base):
+            return self.base[name][2]
+        return self.server.generations.get (name, 0)
+
+    def calculate (self):
+        '''
+        Calculate the changed resources and their observers, in levels like
+        CalcServer.cascade, ordered by the references of the changed
+        resources where they differ.
+        '''
+        server = self.server
+        changed = set (self.changes)
+        graph = DependencyGraph ()
+        with server.graph_lock:
+            dirty = server.graph.dirty (changed)
+            for name in dirty:
+                if (name in self.changes):
+                    resource = self.changes[name]
+                    graph.setReferences (name, resource.get ('references', ()) if resource else ())
+                else:
+                    graph.setReferences (name, server.graph.references.get (name, ()))
+            needed = set (dirty)
+            for name in dirty:
+                needed.update (graph.references[name])
+            self.base = {name: (server.resources.get (name), server.values.get (name),
+                                server.generations.get (name, 0), server.digests.get (name))
+                         for name in needed}
+        modified = set (name for name in changed if self.resource (name) is None)
+        for level in graph.levels (graph.components (dirty)):
+            units = []
+            for component in level:
+                names = [name for name in component if self.resource (name) is not None]
+                if (any (name in changed or not graph.references[name].isdisjoint (modified)
+                         for name in names)):
+                    units.append ([self.prepare (name) for name in names])
+            for unit, values in zip (units, server.executor.run (units)):
+                for (resource, inputs, generation), (value, seconds, error) in zip (unit, values):
+                    name = resource['name']
+                    self.generations[name] = generation
+                    self.calculated.append (name)
+                    if (error is not None):
+                        self.errors[name] = error
+                        continue
+                    if (digestValue (value) != self.base[name][3]):
+                        modified.add (name)
+                    self.values[name] = value
+
+    def prepare (self, name):
+        '''Return the (resource, inputs, generation) to calculate a resource.'''
+        resource = self.resource (name)
+        inputs = {ref: self.value (ref) for ref in resource.get ('references', ())}
+        return (resource, inputs, self.base[name][2] + 1)
+
+def encodeValue (resource, value):
+    '''
+    Return (mime, content as bytes) of a calculated value, as published for
+    the web servers: bytes as they are, strings as UTF-8 text, anything else
+    as JSON.  A "mime" attribute of the resource overrides the mime type.
+    '''
+    if (isinstance (value, bytes)):
+        mime, content = "application/octet-stream", value
+    elif (isinstance (value, str)):
+        mime, content = "text/plain; charset=utf-8", value.encode ('utf-8')
+    else:
+        mime, content = "application/json", json.dumps (value, default=str).encode ('utf-8')
+    return (resource.get ('mime', mime), content)
+
+class CalcDaemon (object):
+    '''
+    The calc server run as a component of Winter.
+
+    Loads every resource of the resources collection, then follows changes to
+    it, stepping the calc server at most every period seconds, and once for
+    all the changes of a release.  Each value
+    calculated is published to a store.FileStore for the web servers before its
+    status is written for the notify servers, so a browser told a resource is
+    ready always finds it ready.
+
+    Data resources referring to external information are fetched again when
+    due by a refresh.RefreshScheduler, running on an event loop of its own
+    thread, which submits what changed for the next step.
+
+    With a history.History, each value published is recorded as a revision of
+    its resource too, the daemon being the only writer of history.  Revisions
+    are recorded by a thread of their own, see recording, off the cascade.
+
+    Being the only process publishing, the daemon also collects the garbage of
+    the filestore every collect_interval seconds, between steps.
+    '''
+    def __init__ (self, db, filestore, evaluate=None, workers=1, period=0.1, executor=None,
+                  history=None, collect_interval=3600, release_timeout=60):
+        self.db = db
+        self.filestore = filestore
+        self.collect_interval = collect_interval
+        self.release_timeout = release_timeout
+        self.history = history
+        self.revisions = collections.deque ()   # (name, generation, content) to record
+        self.revised = threading.Event ()
+        self.period = period
+        self.writer = notify.StatusWriter (db)
+        self.server = CalcServer (evaluate, workers, listener=self.ready, executor=executor)
+        self.published = {}             # name -> generation published
+        self.changed = threading.Event ()
+        self.stopped = threading.Event ()
+        self.stream = None
+        self.threads = []
+        self.refresher = None           # refresh.RefreshScheduler, once running
+        self.refresh_loop = None        # event loop it runs on
+        self.refresh_ready = threading.Event ()
+        self.feeds = set ()             # names of resources it follows
+        self.held = {}                  # name -> change held during releases, see receive
+        self.releases = {}              # releases in progress -> time they began
+        self.release_lock = threading.Lock ()
+
+    def ready (self, statuses):
+        '''Listener of the calc server: publish values, then write statuses.'''
+        for status in statuses:
+            name = status["_id"]
+            if (status["status"] == "ready" and name in self.server.values and
+                self.published.get (name) != status["generation"]):
+                mime, content = encodeValue (self.server.resources[name],
+                                             self.server.values[name])
+                self.filestore.publish (name, status["generation"], {(mime, ""): content})
+                self.published[name] = status["generation"]
+                if (self.history is not None):
+                    # Text as text, else as published
+                    value = self.server.values[name]
+                    self.revisions.append ((name, status["generation"],
+                                            value if isinstance (value, str) else content))
+                    self.revised.set ()
+        self.writer (statuses)
+
+    def remember (self):
+        '''
+        Record the revisions published so far in history.  A revision that
+        can't be recorded, too large say, is reported and skipped.
+        '''
+        while (self.revisions):
+            name, generation, content = self.revisions.popleft ()
+            try:
+                self.history.record (name, generation, content)
+            except pymongo.errors.DuplicateKeyError:
+                # Published again after a restart, the revision is already there
+                pass
+            except Exception as ex:
+                print ("Recording history of {} failed: {}".format (name, str (ex)))
+
+    def recording (self):
+        '''Record revisions as they are published, until stop.'''
+        while (not self.stopped.is_set ()):
+            if (self.revised.wait (5)):
+                self.revised.clear ()
+                self.remember ()
+
+    def load (self):
+        '''
+        Submit every resource of the database, continuing the generations and
+        digests recorded in the status collection.
+        '''
+        for status in self.db.collection (notify.status_collection).find ():
+            self.server.generations[status["_id"]] = status.get ("generation", 0)
+            if (status.get ("digest")):
+                self.server.digests[status["_id"]] = bytes.fromhex (status["digest"])
+        resources = []
+        for document in self.db.collection (staging.resource_collection).find ():
+            if (staging.releaseOf (document.pop ("_id", None)) is None):
+                resources.append (document)
+        self.server.submit (resources)
+        self.changed.set ()
+
+    def follow (self, resume_token=None):
+        '''Return a change stream of the resources collection.'''
+        return self.db.collection (staging.resource_collection).watch (
+            full_document="updateLookup", resume_after=resume_token)
+
+    def watch (self, stream):
+        '''
+        Follow a change stream of the resources collection, submitting each
+        change, see receive.  Runs in its own thread until stop, resuming
+        after errors where it left off.  When the changes since then are
+        gone, it starts over from now and catches up with reload.
+        '''
+        resume_token = None
+        delay = 1
+        catch_up = False
+        with self.release_lock:
+            self.held = {}
+            self.releases = {}
+        while (not self.stopped.is_set ()):
+            try:
+                if (stream is None):
+                    stream = self.follow (resume_token)
+                with stream:
+                    self.stream = stream
+                    if (catch_up):
+                        with self.release_lock:
+                            self.held = {}
+                            self.releases = {}
+                        self.reload ()
+                        catch_up = False
+                    delay = 1
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        if ("documentKey" in change):
+                            # Dropping the collection and such have none
+                            self.receive (change)
+            except pymongo.errors.PyMongoError as ex:
+                if (self.stopped.is_set ()):
+                    break
+                if (database.historyLost (ex)):
+                    print ("Calc change stream lost its history, reloading: {}".format (str (ex)))
+                    resume_token = None
+                    catch_up = True
+                else:
+                    print ("Calc change stream problem, retrying: {}".format (str (ex)))
+                    self.stopped.wait (delay)
+                    delay = min (delay * 2, 60)
+            stream = None
+
+    def receive (self, change):
+        '''
+        Submit a change of the resources collection, unless a release is in
+        progress, see staging.release: then changes are held until no release
+        is, and submitted together, so a release is calculated by one step.
+        A release whose end isn't seen within release_timeout seconds, its
+        releaser having died, is given up on, see expire.
+        '''
+        key = change["documentKey"]["_id"]
+        release = staging.releaseOf (key)
+        with self.release_lock:
+            if (release is not None):
+                if (change["operationType"] == "insert"):
+                    self.releases[release] = time.monotonic ()
+                else:
+                    self.releases.pop (release, None)
+            else:
+                document = change.get ("fullDocument")
+                if (change["operationType"] == "delete" or document is None):
+                    self.held[key] = None
+                else:
+                    document.pop ("_id", None)
+                    self.held[key] = document
+            self.flush ()
+
+    def expire (self):
+        '''
+        Give up on releases begun over release_timeout seconds ago, deleting
+        their marks, and submit the changes they held.  Called by run every
+        few seconds, since no change may arrive to notice them.
+        '''
+        now = time.monotonic ()
+        with self.release_lock:
+            expired = [release for release, start in self.releases.items ()
+                       if now - start > self.release_timeout]
+            for release in expired:
+                print ("Release {} never ended, taking its changes".format (release))
+                del self.releases[release]
+            self.flush ()
+        for release in expired:
+            try:
+                self.db.collection (staging.resource_collection).delete_one (
+                    {"_id": {"release": release}})
+            except pymongo.errors.PyMongoError as ex:
+                print ("Deleting the mark of release {} failed: {}".format (release, str (ex)))
+
+    def flush (self):
+        '''Submit the changes held, unless a release is in progress, holding release_lock.'''
+        if (self.releases or not self.held):
+            return
+        held = self.held
+        self.held = {}
+        self.server.submit ([document for document in held.values () if document is not None],
+                            removed=[name for name, document in held.items () if document is None])
+        self.changed.set ()
+
+    def reload (self):
+        '''
+        Catch up with changes to the resources collection the change stream
+        missed: submit the resources differing from those of the calc server,
+        and remove those gone.
+        '''
+        with self.server.graph_lock:
+            known = dict (self.server.resources)
+        resources = []
+        for document in self.db.collection (staging.resource_collection).find ():
+            if (staging.releaseOf (document.pop ("_id", None)) is not None):
+                continue
+            if (known.pop (document.get ("name"), None) != document):
+                resources.append (document)
+        self.server.submit (resources, removed=list (known))
+        self.changed.set ()
+
+    def step (self):
+        '''Run one step of the calc server, unpublishing removed resources.'''
+        pending = self.server.take ()
+        calculated = self.server.apply (pending)
+        for name, resource in pending.items ():
+            if (resource is None):
+                self.filestore.remove (name)
+                self.published.pop (name, None)
+            self.track (name, resource)
+        return calculated
+
+    def track (self, name, resource):
+        '''Have the refresh scheduler follow a resource or forget it.'''
+        if (self.refresh_loop is None):
+            return
+        if (resource is not None and refresh.isFeed (resource)):
+            self.feeds.add (name)
+            self.refresh_loop.call_soon_threadsafe (self.refresher.add, resource)
+        elif (name in self.feeds):
+            self.feeds.discard (name)
+            self.refresh_loop.call_soon_threadsafe (self.refresher.remove, name)
+
+    def refreshing (self):
+        '''Run the refresh scheduler on an event loop of this thread, until stop.'''
+        async def run ():
+            self.refresher = refresh.RefreshScheduler (self.server, self.changed)
+            self.refresh_loop = asyncio.get_running_loop ()
+            self.refresh_ready.set ()
+            await self.refresher.run ()
+        try:
+            asyncio.run (run ())
+        finally:
+            self.refresh_ready.set ()
+
+    def run (self):
+        '''
+        Step whenever changes arrive, until stop.  A step that fails, not
+        because of a resource but of the executor or the database, keeps its
+        changes, and is tried again after a delay growing up to a minute.
+        '''
+        delay = 1
+        collected = time.monotonic ()
+        while (not self.stopped.is_set ()):
+            if (self.releases):
+                self.expire ()
+            if (self.changed.wait (min (5, self.release_timeout))):
+                self.changed.clear ()
+                try:
+                    self.step ()
+                    delay = 1
+                except Exception as ex:
+                    print ("Calculation failed, retrying in {}s: {}".format (delay, str (ex)))
+                    self.changed.set ()
+                    self.stopped.wait (delay)
+                    delay = min (delay * 2, 60)
+                # Let changes arriving together gather into one cascade
+                self.stopped.wait (self.period)
+            if (time.monotonic () - collected >= self.collect_interval):
+                collected = time.monotonic ()
+                self.collect ()
+            if (hasattr (self.server.evaluate, "supervise")):
+                self.server.evaluate.supervise ()
+
+    def collect (self):
+        '''Collect the garbage of the filestore, on the thread publishing to it.'''
+        try:
+            self.filestore.collect ()
+        except OSError as ex:
+            print ("Collecting the filestore failed: {}".format (str (ex)))
+
+    def listen (self):
+        '''
+        Load resources, then start following and calculating them.  Changes
+        are followed from before loading, so none made meanwhile are missed,
+        and the refresh scheduler is running before the first step.
+        '''
+        if (self.history is not None):
+            self.history.createIndexes ()
+        thread = threading.Thread (target=self.refreshing, daemon=True)
+        thread.start ()
+        self.threads.append (thread)
+        self.refresh_ready.wait ()
+        stream = self.follow ()
+        self.load ()
+        for target, args in ((self.watch, (stream,)), (self.run, ()), (self.recording, ())):
+            thread = threading.Thread (target=target, args=args, daemon=True)
+            thread.start ()
+            self.threads.append (thread)
+
+    def stop (self):
+        '''Stop following changes and calculating.'''
+        self.stopped.set ()
+        self.changed.set ()
+        self.revised.set ()
+        if (self.stream is not None):
+            self.stream.close ()
+        if (self.refresh_loop is not None):
+            self.refresh_loop.call_soon_threadsafe (self.refresher.stop)
+
+    async def drain (self, timeout=30):
+        '''Stop, letting a cascade in progress finish within timeout seconds.'''
+        self.stop ()
+        deadline = time.monotonic () + timeout
+        for thread in self.threads:
+            while (thread.is_alive () and time.monotonic () < deadline):
+                await asyncio.sleep (0.1)
+        self.server.close ()
+        if (hasattr (self.server.evaluate, "close")):
+            self.server.evaluate.close ()
 
 # Running modules as top-level scripts is an antipattern, use bin/snow instead
 if __name__ == '__main__':
@@ -0,0 +1,275 @@
+# This file is part of Winter, a wiki-based computing platform.
+# Copyright (C) 2026  Max Polk <maxpolk@gmail.com>
+# License located at http://www.gnu.org/licenses/agpl-3.0.html
+'''
+Resource classification: resources declare classes, and the validators of a
+class test every resource of it, so writing the validator of a text markup
+class and declaring resources to be text markup tests all of them.
+
+A resource declares its classes by name, and a validator is a resource of
+kind "validator" naming the class it validates:
+    { "name": "page", "source": "= Title =", "classes": ["markup"] }
+    { "name": "markup-check", "kind": "validator", "validates": "markup",
+      "language": "python", "source": "result = ref ('value').startswith ('=')" }
+A validator is code seeing the value of the resource tested as ref ("value")
+and its name as ref ("name").  It passes by setting result to True or leaving
+it None; anything else, or an exception, is a failure described by it.  The
+calc server evaluates a validator to its own source, so it changes value
+exactly when its code does.
+
+Only tests affected by a cascade run: those of the resources calculated, and
+all of a class when its validator was calculated.  Tests already passed with
+the same validator source and the same resource name and value, by digest,
+are not run again.
+Those remaining run on a pool of worker processes like cascades do.
+'''
+
+# Requires version 3, say it now rather than fail mysteriously later.
+# Won't work if you use Python 3 exclusive syntax anywhere in the file.
+import sys
+if (sys.version_info.major < 3):
+    exit ("Requires python 3")
+
+# Library imports
+import collections
+import threading
+
+# Import the current package to get package vars like winter.software_name
+import winter
+from winter import calc, metrics
+
+# Module short description
+module_description = "resource classification module"
+
+# Metrics of the test runner, see metrics
+tests_total = metrics.registry.counter (
+    "classify_tests_total", "Tests of classified resources run")
+cached_total = metrics.registry.counter (
+    "classify_cached_total", "Tests skipped since they passed before on the same content")
+failures_total = metrics.registry.counter (
+    "classify_failures_total", "Tests of classified resources failed")
+
+class Check (object):
+    '''
+    Runs a validator on a value, returning None when it passes, otherwise
+    what describes the failure.  Runs in worker processes too, see
+    calc.evaluateUnits, so it is picklable when evaluate is.
+    '''
+    def __init__ (self, evaluate):
+        self.evaluate = evaluate
+
+    def __call__ (self, validator, inputs, generation):
+        try:
+            result = self.evaluate (dict (validator, kind="code"), inputs, generation)
+        except Exception as ex:
+            return "{}: {}".format (type (ex).__name__, str (ex))
+        if (result is None or result is True):
+            return None
+        return str (result) if result is not False else "failed"
+
+class TestRunner (object):
+    '''
+    Tests the classified resources of a calc server, incrementally.
+
+    Submit the names calculated by each cascade; the tests they affect run in
+    the background, or on step, and their latest outcome is kept in results
+    by (validator, resource).  Passes are remembered by content in passed,
+    the passed_size most recent of them.  As a release gate, see gate, it
+    only runs the tests a stage affects.
+    '''
+    def __init__ (self, calcserver, evaluate=None, workers=1, batch=64, passed_size=100000):
+        self.server = calcserver
+        check = Check (evaluate or calcserver.evaluate)
+        if (workers == 1):
+            self.executor = calc.SerialExecutor (check)
+        else:
+            self.executor = calc.PoolExecutor (check, workers, batch)
+        self.members = {}               # class -> set of names
+        self.validators = {}            # class -> set of validator names
+        self.indexed = {}               # name -> (classes, class validated)
+        self.results = {}               # (validator, name) -> None or failure
+        self.passed = collections.OrderedDict ()    # (validator digest, name, value digest) -> None
+        self.passed_size = passed_size
+        self.pending = set ()           # names calculated since the last step
+        self.lock = threading.Lock ()
+        self.indexing = threading.Lock ()   # held using members and validators
+        self.changed = threading.Event ()
+        self.stopped = threading.Event ()
+        self.thread = None
+        self.index (list (calcserver.resources))
+
+    def index (self, names):
+        '''Bring the classes and validators of names up to date.'''
+        for name in names:
+            classes, validates = self.indexed.pop (name, ((), None))
+            for klass in classes:
+                self.members[klass].discard (name)
+            if (validates is not None):
+                self.validators[validates].discard (name)
+            resource = self.server.resources.get (name)
+            if (resource is None):
+                for key in [key for key in self.results if name in key]:
+                    del self.results[key]
+                continue
+            classes = tuple (resource.get ("classes", ()))
+            validates = resource.get ("validates") if resource.get ("kind") == "validator" else None
+            for klass in classes:
+                self.members.setdefault (klass, set ()).add (name)
+            if (validates is not None):
+                self.validators.setdefault (validates, set ()).add (name)
+            self.indexed[name] = (classes, validates)
+
+    def affected (self, names):
+        '''Return the set of (validator, name) tests affected by names.'''
+        tests = set ()
+        for name in names:
+            classes, validates = self.indexed.get (name, ((), None))
+            if (validates is not None):
+                tests.update ((name, member) for member in self.members.get (validates, ()))
+            for klass in classes:
+                tests.update ((validator, name) for validator in self.validators.get (klass, ()))
+        return tests
+
+    def test (self, tests):
+        '''
+        Run tests, a list of (validator resource, name, value, generation),
+        except those passed before on the same content.  Returns the failures
+        by (validator, name).
+        '''
+        keys = []
+        units = []
+        outcomes = {}
+        for validator, name, value, generation in tests:
+            test = (validator['name'], name)
+            # Validators see the name too, so a pass only holds for the same name
+            key = (calc.digestValue ([validator.get ('language'), validator.get ('source')]),
+                   name, calc.digestValue (value))
+            if (self.remembered (key)):
+                cached_total.inc ()
+                outcomes[test] = None
+                continue
+            keys.append ((test, key))
+            units.append ([(validator, {"value": value, "name": name}, generation)])
+        for (test, key), values in zip (keys, self.executor.run (units)):
+            failure = values[0][0]
+            tests_total.inc ()
+            if (failure is None):
+                self.remember (key)
+            else:
+                failures_total.inc ()
+            outcomes[test] = failure
+        return {test: failure for test, failure in outcomes.items () if failure is not None}
+
+    def remembered (self, key):
+        '''True if the test of key passed before, as one of the most recent.'''
+        with self.lock:
+            if (key not in self.passed):
+                return False
+            self.passed.move_to_end (key)
+            return True
+
+    def remember (self, key):
+        with self.lock:
+            self.passed[key] = None
+            self.passed.move_to_end (key)
+            if (len (self.passed) > self.passed_size):
+                self.passed.popitem (last=False)
+
+    def submit (self, names, removed=()):
+        '''Queue the tests affected by names calculated and removed.'''
+        with self.lock:
+            self.pending.update (names)
+            self.pending.update (removed)
+        self.changed.set ()
+
+    def step (self):
+        '''Run the tests affected by everything submitted, returning failures.'''
+        with self.lock:
+            names = self.pending
+            self.pending = set ()
+        with self.indexing:
+            self.index (names)
+            affected = self.affected (names)
+        tests = []
+        for validator, name in sorted (affected):
+            if (validator in self.server.values and name in self.server.values):
+                tests.append ((self.server.resources[validator], name,
+                               self.server.values[name], self.server.generations[name]))
+        failures = self.test (tests)
+        for validator, name, value, generation in tests:
+            self.results[(validator['name'], name)] = failures.get ((validator['name'], name))
+        return failures
+
+    def failures (self):
+        '''Return the latest failures by (validator, name).'''
+        return {test: failure for test, failure in self.results.items () if failure is not None}
+
+    def gate (self, stage):
+        '''
+        Check a stage before it is released, see staging.release: tests of
+        the data resources it changes, whose values are their sources, and of
+        the validators it changes against the resources of their class.  Code
+        resources are tested once calculated, after the release.  Raises
+        when a test fails, so the stage is not released.
+        '''
+        with self.indexing:
+            tests = self.gateTests (stage)
+        failures = self.test (tests)
+        if (failures):
+            raise Exception ("ERROR: release refused, failing tests: {}".format ("; ".join (
+                "{} by {}: {}".format (name, validator, failure)
+                for (validator, name), failure in sorted (failures.items ()))))
+
+    def gateTests (self, stage):
+        '''Return the tests of gate, as test takes them.'''
+        def validatorsOf (klass):
+            names = set (self.validators.get (klass, ()))
+            names.update (name for name, resource in stage.changes.items ()
+                          if resource is not None and resource.get ("kind") == "validator"
+                          and resource.get ("validates") == klass)
+            for name in sorted (names):
+                resource = stage.changes.get (name, self.server.resources.get (name))
+                if (resource is not None):
+                    yield resource
+
+        tests = []
+        for name, resource in sorted (stage.changes.items ()):
+            if (resource is None):
+                continue
+            generation = self.server.generations.get (name, 0) + 1
+            if (resource.get ("kind", "data") == "data"):
+                for klass in resource.get ("classes", ()):
+                    tests.extend ((validator, name, resource.get ("source"), generation)
+                                  for validator in validatorsOf (klass))
+            if (resource.get ("kind") == "validator"):
+                for member in sorted (self.members.get (resource.get ("validates"), ())):
+                    if (member not in stage.changes and member in self.server.values):
+                        tests.append ((resource, member, self.server.values[member],
+                                       self.server.generations[member]))
+        return tests
+
+    def run (self):
+        '''Step whenever names are submitted, until stop.'''
+        while (not self.stopped.is_set ()):
+            if (self.changed.wait (5)):
+                self.changed.clear ()
+                try:
+                    self.step ()
+                except Exception as ex:
+                    print ("Testing failed: {}".format (str (ex)))
+
+    def start (self):
+        '''Run tests in the background, so releases never wait for them.'''
+        self.thread = threading.Thread (target=self.run, daemon=True)
+        self.thread.start ()
+
+    def stop (self):
+        self.stopped.set ()
+        self.changed.set ()
+        if (self.thread is not None):
+            self.thread.join ()
+        self.executor.close ()
+
+# Running modules as top-level scripts is an antipattern, use bin/snow instead
+if __name__ == '__main__':
+    pass
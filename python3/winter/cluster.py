@@ -0,0 +1,567 @@
+# This file is part of Winter, a wiki-based computing platform.
+# Copyright (C) 2026  Max Polk <maxpolk@gmail.com>
+# License located at http://www.gnu.org/licenses/agpl-3.0.html
+'''
+Cascades spread over several machines.
+
+The calc daemon still decides what to calculate and in what order, one level
+of a cascade at a time, but with a QueueExecutor it hands the units of each
+level to calc workers running on any number of machines, through a durable
+work queue in the database:
+    { "_id": id, "batch": level, "partition": node, "state": "ready",
+      "queued": time, "attempts": n, "units": units as documents }
+A worker claims a task by leasing it for lease seconds, keeps the lease while
+evaluating, up to max_lease seconds in all, and stores the results with state
+"done".  A lease that runs out, because its worker died or hung, makes the
+task claimable again by any worker, so a dead node's work is picked up by the
+rest without anyone noticing it died.  A task failing, or whose lease ran out,
+max_attempts times is "failed", so one killing its workers or running forever
+fails its cascade rather than go round the workers for good.
+
+Each unit goes to the worker node owning most of the resources it refers to,
+so each resource tends to stay on one node, where its compiled code and
+interpreters are warm, and few references cross nodes.  Since units arrive
+references first, this is streaming graph partitioning: a node's score is
+the number of references it owns, discounted as it fills up, which keeps the
+nodes balanced within slack.  Ready tasks waiting over steal_after seconds may
+be taken by any worker, which evens out uneven levels.
+
+Units and results are stored as plain documents, see encodeUnits, never
+as pickles, so whoever can write to the queue can't run code on the nodes
+reading it.  Values are encoded so they come back as they were, see
+encodeValue.  A unit with inputs that can't be encoded is evaluated by the
+coordinator itself, and a value calculated on a calc worker that can't be
+encoded becomes the error of its resource.
+
+Workers announce themselves in the nodes collection every few seconds.
+Leases and announcements are in wall clock time, so machines must keep their
+clocks synchronized.
+'''
+
+# Requires version 3, say it now rather than fail mysteriously later.
+# Won't work if you use Python 3 exclusive syntax anywhere in the file.
+import sys
+if (sys.version_info.major < 3):
+    exit ("Requires python 3")
+
+# Library imports
+import asyncio
+import bson
+import concurrent.futures
+import datetime
+import os
+import pymongo
+import socket
+import threading
+import time
+
+# Import the current package to get package vars like winter.software_name
+import winter
+from winter import calc, metrics
+
+# Module short description
+module_description = "distributed calc module"
+
+# Collection holding the work queue
+queue_collection = "calcqueue"
+
+# Collection holding the worker nodes alive, by node name as _id
+nodes_collection = "calcnodes"
+
+# Metrics of distributed calculation, see metrics
+tasks_total = metrics.registry.counter (
+    "cluster_tasks_total", "Tasks evaluated by this worker")
+reclaimed_total = metrics.registry.counter (
+    "cluster_reclaimed_total", "Tasks claimed after another worker's lease ran out")
+task_wait_seconds = metrics.registry.histogram (
+    "cluster_task_wait_seconds", "Seconds tasks waited in the queue before being claimed")
+
+# Key of the documents encodeValue tags values with
+value_tag = "~"
+
+def encodeValue (value):
+    '''
+    Return a value as the database can store it, and decodeValue bring back
+    equal and of the same type: None, booleans, floats, strings, bytes, and
+    integers of 64 bits are stored as they are, lists and dicts of them too,
+    while other integers, tuples, sets, complex numbers, datetimes, and dicts
+    with keys that aren't plain strings are tagged, like {"~": "int", "v":
+    "18446744073709551616"}.  Raises TypeError for any other type.
+    '''
+    if (value is None or isinstance (value, (bool, float, str, bytes))):
+        return value
+    if (isinstance (value, int)):
+        if (-2 ** 63 <= value < 2 ** 63):
+            return value
+        return {value_tag: "int", "v": str (value)}
+    if (isinstance (value, list)):
+        return [encodeValue (item) for item in value]
+    if (isinstance (value, dict)):
+        if (all (isinstance (key, str) and key != value_tag and key[:1] != "$" and
+                 "." not in key and "\0" not in key for key in value)):
+            return {key: encodeValue (item) for key, item in value.items ()}
+        return {value_tag: "dict",
+                "v": [[encodeValue (key), encodeValue (item)] for key, item in value.items ()]}
+    if (isinstance (value, (tuple, set, frozenset))):
+        return {value_tag: type (value).__name__, "v": [encodeValue (item) for item in value]}
+    if (isinstance (value, complex)):
+        return {value_tag: "complex", "v": [value.real, value.imag]}
+    if (isinstance (value, datetime.datetime)):
+        return {value_tag: "datetime", "v": value.isoformat ()}
+    raise TypeError ("values of type {} can't be stored".format (type (value).__name__))
+
+# Types of the values tagged by encodeValue
+tagged_types = {"tuple": tuple, "set": set, "frozenset": frozenset}
+
+def decodeValue (value):
+    '''Return the value encodeValue encoded.'''
+    if (isinstance (value, list)):
+        return [decodeValue (item) for item in value]
+    if (isinstance (value, bson.int64.Int64)):
+        return int (value)
+    if (not isinstance (value, dict)):
+        return value
+    if (value_tag not in value):
+        return {key: decodeValue (item) for key, item in value.items ()}
+    tag = value[value_tag]
+    if (tag == "int"):
+        return int (value["v"])
+    if (tag == "dict"):
+        return {decodeValue (key): decodeValue (item) for key, item in value["v"]}
+    if (tag in tagged_types):
+        return tagged_types[tag] (decodeValue (item) for item in value["v"])
+    if (tag == "complex"):
+        return complex (*value["v"])
+    if (tag == "datetime"):
+        return datetime.datetime.fromisoformat (value["v"])
+    raise ValueError ("unknown value tag {}".format (tag))
+
+def encodeUnits (members):
+    '''
+    Return the documents of members, a list of (position, unit), a unit being
+    a list of (resource, inputs, generation).  Inputs are listed as [name,
+    value] pairs, since names may hold characters field names can't.  Raises
+    TypeError if an input can't be encoded, see encodeValue.
+    '''
+    return [{"position": position,
+             "unit": [{"resource": resource,
+                       "inputs": [[name, encodeValue (value)]
+                                  for name, value in inputs.items ()],
+                       "generation": generation}
+                      for resource, inputs, generation in unit]}
+            for position, unit in members]
+
+def decodeUnits (documents):
+    '''Return the list of (position, unit) of documents made by encodeUnits.'''
+    members = []
+    for document in documents:
+        unit = []
+        for item in document["unit"]:
+            if (not isinstance (item["resource"], dict)):
+                raise ValueError ("resource is not a document")
+            unit.append ((item["resource"],
+                          {name: decodeValue (value) for name, value in item["inputs"]},
+                          int (item["generation"])))
+        members.append ((int (document["position"]), unit))
+    return members
+
+def encodeResults (results):
+    '''
+    Return the documents of results, a list of (position, [(value, seconds,
+    error)]).  A value that can't be encoded becomes the error of its
+    resource.
+    '''
+    documents = []
+    for position, values in results:
+        encoded = []
+        for value, seconds, error in values:
+            try:
+                encoded.append ([encodeValue (value), seconds, error])
+            except TypeError as ex:
+                encoded.append ([None, seconds, "value can't be stored: {}".format (str (ex))])
+        documents.append ({"position": position, "values": encoded})
+    return documents
+
+def decodeResults (documents):
+    '''Return the list of (position, [(value, seconds, error)]) of encodeResults documents.'''
+    return [(int (document["position"]),
+             [(decodeValue (value), float (seconds), None if error is None else str (error))
+              for value, seconds, error in document["values"]])
+            for document in documents]
+
+class WorkQueue (object):
+    '''
+    Tasks in a collection, leased by workers for lease seconds at a time, and
+    max_lease seconds in all.
+    '''
+    def __init__ (self, collection, lease=30, max_attempts=3, max_lease=600):
+        self.collection = collection
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.max_lease = max_lease
+
+    def createIndexes (self):
+        self.collection.create_index ([("state", pymongo.ASCENDING),
+                                       ("partition", pymongo.ASCENDING),
+                                       ("queued", pymongo.ASCENDING)])
+        self.collection.create_index ([("batch", pymongo.ASCENDING)])
+
+    def put (self, batch, tasks):
+        '''Queue tasks of a batch, each a (partition, units encoded by encodeUnits).'''
+        now = time.time ()
+        self.collection.bulk_write ([pymongo.InsertOne ({
+            "batch": batch,
+            "partition": partition,
+            "state": "ready",
+            "queued": now,
+            "attempts": 0,
+            "units": units
+        }) for partition, units in tasks])
+
+    def claim (self, node, steal_after=10):
+        '''
+        Lease the oldest task for node: one of its partition, or of none, or
+        waiting over steal_after seconds, or whose lease ran out before
+        max_attempts.  Returns the task, or None if there is nothing to do.
+        '''
+        now = time.time ()
+        return self.collection.find_one_and_update (
+            {"$or": [
+                {"state": "ready", "partition": {"$in": [node, None]}},
+                {"state": "ready", "queued": {"$lt": now - steal_after}},
+                {"state": "leased", "lease_until": {"$lt": now},
+                 "attempts": {"$lt": self.max_attempts}}
+            ]},
+            {"$set": {"state": "leased", "owner": node, "claimed": now,
+                      "lease_until": now + self.lease},
+             "$inc": {"attempts": 1}},
+            sort=[("queued", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER)
+
+    def overdue (self, task):
+        '''True if a task was leased max_lease seconds ago, so can't be renewed.'''
+        return time.time () >= task.get ("claimed", time.time ()) + self.max_lease
+
+    def extend (self, task, node):
+        '''Renew the lease of a task, at most to max_lease, False if it was lost meanwhile.'''
+        until = min (time.time () + self.lease,
+                     task.get ("claimed", time.time ()) + self.max_lease)
+        result = self.collection.update_one (
+            {"_id": task["_id"], "state": "leased", "owner": node},
+            {"$set": {"lease_until": until}})
+        return result.matched_count > 0
+
+    def complete (self, task, node, results):
+        '''Store the results of a task, False if its lease was lost meanwhile.'''
+        result = self.collection.update_one (
+            {"_id": task["_id"], "state": "leased", "owner": node},
+            {"$set": {"state": "done", "results": encodeResults (results)},
+             "$unset": {"units": True}})
+        return result.matched_count > 0
+
+    def fail (self, task, node, error):
+        '''Put a task back for any worker, or mark it failed past max_attempts.'''
+        if (task.get ("attempts", 0) >= self.max_attempts):
+            update = {"$set": {"state": "failed", "error": error}}
+        else:
+            update = {"$set": {"state": "ready", "partition": None, "error": error}}
+        self.collection.update_one (
+            {"_id": task["_id"], "state": "leased", "owner": node}, update)
+
+    def expire (self, batch):
+        '''Mark failed the tasks of a batch whose last lease ran out.'''
+        now = time.time ()
+        query = {"batch": batch, "state": "leased", "lease_until": {"$lt": now},
+                 "attempts": {"$gte": self.max_attempts}}
+        for task in self.collection.find (query, {"_id": True}):
+            self.collection.update_one (dict (query, _id=task["_id"]), {"$set": {
+                "state": "failed",
+                "error": "lease ran out {} times".format (self.max_attempts)}})
+
+    def finished (self, batch):
+        '''Return the tasks of a batch that are done or failed.'''
+        return list (self.collection.find (
+            {"batch": batch, "state": {"$in": ["done", "failed"]}}))
+
+    def remove (self, batch):
+        self.collection.delete_many ({"batch": batch})
+
+class Partitioner (object):
+    '''
+    Assigns each resource to a node, streaming, keeping what it assigned, see
+    the module description.
+    '''
+    def __init__ (self, slack=0.1):
+        self.slack = slack
+        self.owners = {}                # name -> node
+        self.loads = {}                 # node -> names owned
+
+    def setNodes (self, nodes):
+        '''Use these nodes; names owned by nodes gone are assigned afresh.'''
+        self.owners = {name: node for name, node in self.owners.items () if node in nodes}
+        self.loads = {node: 0 for node in nodes}
+        for node in self.owners.values ():
+            self.loads[node] += 1
+
+    def place (self, unit):
+        '''Return the node for a unit, a list of (resource, inputs, generation).'''
+        names = [resource['name'] for resource, inputs, generation in unit]
+        for name in names:
+            node = self.owners.get (name)
+            if (node is not None):
+                return node
+        neighbors = {}
+        for resource, inputs, generation in unit:
+            for ref in inputs:
+                owner = self.owners.get (ref)
+                if (owner is not None):
+                    neighbors[owner] = neighbors.get (owner, 0) + 1
+        capacity = (sum (self.loads.values ()) + len (names)) * (1 + self.slack) / len (self.loads)
+        best = max (self.loads, key=lambda node: (
+            neighbors.get (node, 0) * max (0, 1 - self.loads[node] / capacity),
+            -self.loads[node]))
+        for name in names:
+            self.owners[name] = best
+        self.loads[best] += len (names)
+        return best
+
+def nodeName ():
+    '''Name of this worker node, unique per process.'''
+    return "{}:{}".format (socket.gethostname (), os.getpid ())
+
+def aliveNodes (db, timeout=15):
+    '''Return the names of worker nodes that announced themselves lately.'''
+    return sorted (node["_id"] for node in db.collection (nodes_collection).find (
+        {"seen": {"$gte": time.time () - timeout}}))
+
+class QueueExecutor (object):
+    '''
+    Evaluates the units of each level on the calc workers alive, through a
+    WorkQueue, with at most batch resources per task.  With no worker alive,
+    evaluates them itself, so cascades go on, only slower.
+    '''
+    def __init__ (self, db, evaluate, batch=64, lease=30, steal_after=10,
+                  node_timeout=15, poll=0.01):
+        self.db = db
+        self.evaluate = evaluate
+        self.batch = batch
+        self.steal_after = steal_after
+        self.node_timeout = node_timeout
+        self.poll = poll
+        self.queue = WorkQueue (db.collection (queue_collection), lease)
+        self.partitioner = Partitioner ()
+        self.nodes = []
+        self.checked = 0                # time nodes were last looked up
+        self.indexed = False
+        self.name = "coordinator:" + nodeName ()
+
+    @property
+    def workers (self):
+        return max (1, len (self.nodes))
+
+    def refresh (self, force=False):
+        '''Look up the nodes alive, at most every few seconds.'''
+        if (force or time.monotonic () - self.checked > 2):
+            self.checked = time.monotonic ()
+            nodes = aliveNodes (self.db, self.node_timeout)
+            if (nodes != self.nodes):
+                self.nodes = nodes
+                if (nodes):
+                    self.partitioner.setNodes (nodes)
+
+    def run (self, units):
+        '''Return the list of (value, seconds, error) for each unit.'''
+        self.refresh ()
+        if (not units or not self.nodes):
+            return calc.evaluateUnits (self.evaluate, units)
+        if (not self.indexed):
+            self.queue.createIndexes ()
+            self.indexed = True
+        # Group units by node, then into tasks of about batch resources,
+        # keeping here those with inputs that can't be encoded
+        grouped = {}
+        local = []
+        for position, unit in enumerate (units):
+            try:
+                document = encodeUnits ([(position, unit)])[0]
+            except TypeError:
+                local.append (position)
+                continue
+            grouped.setdefault (self.partitioner.place (unit), []).append (
+                (len (unit), document))
+        tasks = []
+        for node, members in sorted (grouped.items ()):
+            current = []
+            count = 0
+            for size, document in members:
+                current.append (document)
+                count += size
+                if (count >= self.batch):
+                    tasks.append ((node, current))
+                    current = []
+                    count = 0
+            if (current):
+                tasks.append ((node, current))
+        batch = bson.ObjectId ()
+        if (tasks):
+            self.queue.put (batch, tasks)
+        try:
+            local_results = calc.evaluateUnits (self.evaluate, [units[position]
+                                                                 for position in local])
+            results = self.wait (batch, len (tasks), len (units))
+        finally:
+            self.queue.remove (batch)
+        for position, values in zip (local, local_results):
+            results[position] = values
+        return results
+
+    def wait (self, batch, count, size):
+        '''Wait for the count tasks of a batch and return their results in order.'''
+        delay = self.poll
+        while (True):
+            self.queue.expire (batch)
+            finished = self.queue.finished (batch)
+            if (len (finished) >= count):
+                break
+            self.refresh ()
+            if (not self.nodes):
+                # Every worker is gone, so do the work here
+                task = self.queue.claim (self.name, steal_after=0)
+                if (task is not None):
+                    work (self.queue, self.name, task, self.evaluate)
+                    continue
+            time.sleep (delay)
+            delay = min (delay * 2, 0.25)
+        results = [None] * size
+        for task in finished:
+            if (task["state"] == "failed"):
+                raise Exception ("ERROR: calculation failed on a calc worker: {}".format (
+                    task.get ("error")))
+            for position, values in decodeResults (task["results"]):
+                results[position] = values
+        return results
+
+    def close (self):
+        pass
+
+def work (queue, node, task, evaluate, executor=None):
+    '''
+    Evaluate a claimed task, renewing its lease meanwhile, and store its
+    results, or put it back when evaluation fails or takes over max_lease
+    seconds, leaving it running.  Returns True if the results were stored.
+    '''
+    task_wait_seconds.observe (max (0, time.time () - task["queued"]))
+    if (task.get ("owner") != node or task.get ("attempts", 1) > 1):
+        reclaimed_total.inc ()
+    try:
+        members = decodeUnits (task["units"])
+    except (KeyError, TypeError, ValueError) as ex:
+        queue.fail (task, node, "malformed task: {}".format (str (ex)))
+        return False
+    units = [unit for position, unit in members]
+    run = executor.run if executor is not None else (
+        lambda units: calc.evaluateUnits (evaluate, units))
+    runner = concurrent.futures.ThreadPoolExecutor (1)
+    try:
+        future = runner.submit (run, units)
+        while (True):
+            try:
+                results = future.result (queue.lease / 3)
+                break
+            except concurrent.futures.TimeoutError:
+                if (queue.overdue (task)):
+                    queue.fail (task, node, "evaluation took over {} seconds".format (
+                        queue.max_lease))
+                    return False
+                if (not queue.extend (task, node)):
+                    return False
+            except Exception as ex:
+                queue.fail (task, node, str (ex))
+                return False
+    finally:
+        runner.shutdown (wait=False)
+    tasks_total.inc ()
+    try:
+        return queue.complete (task, node, [(position, values) for (position, unit), values
+                                            in zip (members, results)])
+    except (bson.errors.InvalidDocument, OverflowError) as ex:
+        queue.fail (task, node, "values can't be stored: {}".format (str (ex)))
+        return False
+
+class CalcWorker (object):
+    '''
+    A calc worker run as a component of Winter, evaluating tasks of the work
+    queue, on workers processes of this machine (see calc.PoolExecutor).
+    '''
+    def __init__ (self, db, evaluate, workers=1, node=None, lease=30, steal_after=10,
+                  batch=64):
+        self.db = db
+        self.evaluate = evaluate
+        self.node = node or nodeName ()
+        self.steal_after = steal_after
+        self.queue = WorkQueue (db.collection (queue_collection), lease)
+        if (workers == 1):
+            self.executor = calc.SerialExecutor (evaluate)
+        else:
+            self.executor = calc.PoolExecutor (evaluate, workers, batch)
+        self.stopped = threading.Event ()
+        self.thread = None
+        self.seen = 0
+
+    def announce (self):
+        '''Tell the coordinator this node is alive, every few seconds.'''
+        if (time.monotonic () - self.seen >= self.queue.lease / 10):
+            self.seen = time.monotonic ()
+            self.db.collection (nodes_collection).replace_one (
+                {"_id": self.node}, {"_id": self.node, "seen": time.time ()}, upsert=True)
+
+    def step (self):
+        '''Evaluate one task if there is one, True if there was.'''
+        self.announce ()
+        task = self.queue.claim (self.node, self.steal_after)
+        if (task is None):
+            return False
+        work (self.queue, self.node, task, self.evaluate, self.executor)
+        return True
+
+    def run (self):
+        '''Evaluate tasks as they come, until stop.'''
+        delay = 0.01
+        while (not self.stopped.is_set ()):
+            try:
+                if (self.step ()):
+                    delay = 0.01
+                    continue
+            except pymongo.errors.PyMongoError as ex:
+                print ("Calc worker database problem, retrying: {}".format (str (ex)))
+                delay = 1
+            except Exception as ex:
+                print ("Calc worker task failed: {}".format (str (ex)))
+            self.stopped.wait (delay)
+            delay = min (delay * 2, 0.25)
+            if (hasattr (self.evaluate, "supervise")):
+                self.evaluate.supervise ()
+
+    def listen (self):
+        self.queue.createIndexes ()
+        self.thread = threading.Thread (target=self.run, daemon=True)
+        self.thread.start ()
+
+    def stop (self):
+        self.stopped.set ()
+
+    async def drain (self, timeout=30):
+        '''Stop, finishing the task in progress within timeout seconds.'''
+        self.stop ()
+        deadline = time.monotonic () + timeout
+        while (self.thread is not None and self.thread.is_alive () and
+               time.monotonic () < deadline):
+            await asyncio.sleep (0.1)
+        self.db.collection (nodes_collection).delete_one ({"_id": self.node})
+        self.executor.close ()
+        if (hasattr (self.evaluate, "close")):
+            self.evaluate.close ()
+
+# Running modules as top-level scripts is an antipattern, use bin/snow instead
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,123 @@
+# This file is part of Winter, a wiki-based computing platform.
+# Copyright (C) 2026  Max Polk <maxpolk@gmail.com>
+# License located at http://www.gnu.org/licenses/agpl-3.0.html
+'''
+Cache of compiled Python 3 code resources.
+
+Code is compiled once per distinct source, then found by the SHA-256 of its
+source.  Compiled code is kept in memory, and optionally marshalled to files
+under a directory, like the one given by the --directory option, so new worker
+processes find it compiled already:
+
+    code/ab/cdef...                     marshalled code object
+'''
+
+# Requires version 3, say it now rather than fail mysteriously later.
+# Won't work if you use Python 3 exclusive syntax anywhere in the file.
+import sys
+if (sys.version_info.major < 3):
+    exit ("Requires python 3")
+
+# Library imports
+import collections
+import hashlib
+import importlib.util
+import marshal
+import os
+import tempfile
+import threading
+
+# Import the current package to get package vars like winter.software_name
+import winter
+
+# Module short description
+module_description = "compiled code cache module"
+
+class CodeCache (object):
+    '''
+    Compiled code objects by source digest, the size most recently used kept
+    in memory, and all of them in files when there is a directory.
+
+    Marshalled code only loads in the Python version that wrote it, so the
+    digest includes the bytecode magic number of the running Python.  Safe to
+    use from several threads, as previews and cascades share it.
+    '''
+    def __init__ (self, directory=None, size=1024):
+        self.directory = directory
+        self.size = size
+        self.codes = collections.OrderedDict ()     # digest -> code object
+        self.lock = threading.Lock ()               # held using codes and counts
+        self.hits = 0
+        self.misses = 0
+        if (directory is not None):
+            os.makedirs (os.path.join (directory, "code"), exist_ok=True)
+
+    def digest (self, source, filename):
+        '''Return the key of a source compiled under a file name.'''
+        digest = hashlib.sha256 (importlib.util.MAGIC_NUMBER)
+        digest.update (filename.encode ('utf-8'))
+        digest.update (b'\0')
+        digest.update (source.encode ('utf-8'))
+        return digest.hexdigest ()
+
+    def path (self, digest):
+        '''Return the file of marshalled code with the given digest.'''
+        return os.path.join (self.directory, "code", digest[:2], digest[2:])
+
+    def compile (self, source, filename="<resource>"):
+        '''
+        Return source compiled for exec, compiling only if not cached.  The
+        file name, usually the resource name, appears in tracebacks.
+        '''
+        digest = self.digest (source, filename)
+        with self.lock:
+            code = self.codes.get (digest)
+            if (code is not None):
+                self.codes.move_to_end (digest)
+                self.hits += 1
+                return code
+        # Compiled outside the lock, a race only compiles the same code twice
+        code = self.load (digest)
+        loaded = code is not None
+        if (not loaded):
+            code = compile (source, filename, "exec", dont_inherit=True)
+            self.save (digest, code)
+        with self.lock:
+            if (loaded):
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.codes[digest] = code
+            self.codes.move_to_end (digest)
+            if (len (self.codes) > self.size):
+                self.codes.popitem (last=False)
+        return code
+
+    def load (self, digest):
+        '''Return the marshalled code of a digest, or None.'''
+        if (self.directory is None):
+            return None
+        try:
+            with open (self.path (digest), 'rb') as codefile:
+                return marshal.loads (codefile.read ())
+        except (FileNotFoundError, EOFError, ValueError, TypeError):
+            return None
+
+    def save (self, digest, code):
+        '''Marshal code to its file, written whole or not at all.'''
+        if (self.directory is None):
+            return
+        path = self.path (digest)
+        os.makedirs (os.path.dirname (path), exist_ok=True)
+        fd, tmppath = tempfile.mkstemp (dir=os.path.dirname (path), prefix=".tmp")
+        try:
+            with os.fdopen (fd, 'wb') as tmpfile:
+                tmpfile.write (marshal.dumps (code))
+            os.replace (tmppath, path)
+        except BaseException:
+            os.unlink (tmppath)
+            raise
+
+# Running modules as top-level scripts is an antipattern, use bin/snow instead
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,161 @@
+# This file is part of Winter, a wiki-based computing platform.
+# Copyright (C) 2026  Max Polk <maxpolk@gmail.com>
+# License located at http://www.gnu.org/licenses/agpl-3.0.html
+'''
+Shared connection to the database.
+
+A MongoClient is a pool of connections meant to be shared by a whole process,
+so each process makes one per database with the connect function, rather than
+one per request, which would cost a connection and authentication each time.
+
+The database is used through collection (name), which returns a pymongo
+Collection, and Winter only uses these of its methods, always with pymongo
+write operations (InsertOne, ReplaceOne, UpdateOne, DeleteOne, DeleteMany):
+    find, find_one, count_documents, insert_one, replace_one, update_one,
+    find_one_and_update, delete_one, delete_many, bulk_write, create_index,
+    watch, drop
+The in-process backend, memory.MemoryDatabase, provides the same, and is used
+instead with "memory" as database host.
+'''
+
+# Requires version 3, say it now rather than fail mysteriously later.
+# Won't work if you use Python 3 exclusive syntax anywhere in the file.
+import sys
+if (sys.version_info.major < 3):
+    exit ("Requires python 3")
+
+# Library imports
+import os
+import pymongo
+import threading
+
+# Import the current package to get package vars like winter.software_name
+import winter
+from winter import memory
+
+# Module short description
+module_description = "database connection module"
+
+class Database (object):
+    '''
+    A lazily connected pool of connections to one MongoDB database.
+
+    Nothing connects until the client is first used.  A child process never
+    uses the client of its parent: a Database sent to a spawned child is
+    pickled without it, and a forked child notices the process id changed, so
+    either way the child makes its own.
+    '''
+    # Usable from other processes, each connecting on its own
+    local = False
+
+    def __init__ (self, host='127.0.0.1', port=27017, name='winter',
+                  user=None, password=None, pool_size=100, timeout=5000):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.user = user
+        self.password = password
+        self.pool_size = pool_size
+        self.timeout = timeout          # milliseconds to find a server
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock ()
+
+    def __getstate__ (self):
+        state = self.__dict__.copy ()
+        state['_client'] = None
+        state['_pid'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__ (self, state):
+        self.__dict__.update (state)
+        self._lock = threading.Lock ()
+
+    @property
+    def client (self):
+        '''The MongoClient of this process, created on first use.'''
+        if (self._client is None or self._pid != os.getpid ()):
+            with self._lock:
+                if (self._client is None or self._pid != os.getpid ()):
+                    credentials = {}
+                    if (self.user):
+                        credentials = dict (username=self.user,
+                                            password=self.password,
+                                            authSource=self.name)
+                    self._client = pymongo.MongoClient (
+                        host = self.host, port = self.port,
+                        maxPoolSize = self.pool_size,
+                        serverSelectionTimeoutMS = self.timeout,
+                        connect = False,
+                        **credentials)
+                    self._pid = os.getpid ()
+        return self._client
+
+    @property
+    def database (self):
+        '''The pymongo Database object.'''
+        return self.client[self.name]
+
+    def collection (self, name):
+        '''Return the named collection of the database.'''
+        return self.database[name]
+
+    def ping (self):
+        '''Health check, returns True if the server answers a ping.'''
+        try:
+            self.client.admin.command ('ping')
+            return True
+        except pymongo.errors.PyMongoError:
+            return False
+
+    def close (self):
+        '''Close all connections; using the client again reconnects.'''
+        with self._lock:
+            if (self._client is not None and self._pid == os.getpid ()):
+                self._client.close ()
+            self._client = None
+            self._pid = None
+
+# Codes of change stream errors whose resume point is gone from the history
+history_lost_codes = (136, 280, 286)
+
+def historyLost (ex):
+    '''
+    True if a change stream failed because the changes after its resume token
+    are gone, so resuming again can never work and it has to start over.
+    '''
+    return (isinstance (ex, pymongo.errors.OperationFailure) and
+            ex.code in history_lost_codes)
+
+# Databases shared by this process, by connection settings
+_databases = {}
+_databases_lock = threading.Lock ()
+
+def connect (options):
+    '''
+    Return the Database of this process for the database options made by
+    initiate.Setup (dbhost, dbport, dbname, dbuser, dbpassword, dbpoolsize).
+    With "memory" as dbhost, it is a memory.MemoryDatabase instead, saved
+    under the directory option when there is one.
+    '''
+    key = (options.dbhost, options.dbport, options.dbname, options.dbuser)
+    with _databases_lock:
+        database = _databases.get (key)
+        if (database is None):
+            if (options.dbhost == "memory"):
+                directory = getattr (options, 'directory', None)
+                database = memory.MemoryDatabase (
+                    options.dbname,
+                    os.path.join (directory, "memory", options.dbname) if directory else None)
+            else:
+                database = Database (
+                    options.dbhost, options.dbport, options.dbname,
+                    options.dbuser, options.dbpassword,
+                    getattr (options, 'dbpoolsize', 100))
+            _databases[key] = database
+        return database
+
+# Running modules as top-level scripts is an antipattern, use bin/snow instead
+if __name__ == '__main__':
+    pass
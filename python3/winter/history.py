@@ -0,0 +1,209 @@
+# This file is part of Winter, a wiki-based computing platform.
+# Copyright (C) 2026  Max Polk <maxpolk@gmail.com>
+# License located at http://www.gnu.org/licenses/agpl-3.0.html
+'''
+History of the revisions of each resource.
+
+Each revision is a document of the history collection, indexed by resource and
+generation, newest first.  History is read a page at a time, newest first,
+where each page ends with a cursor, the generation to read the next page
+before.  Unlike skipping some number of revisions, the cost of a page doesn't
+grow with how far back it is.
+
+Most revisions differ little from the one before, so most are stored as a
+delta from a full snapshot of an earlier revision:
+    { "resource": name, "generation": n, "snapshot": content }
+    { "resource": name, "generation": n, "base": m, "delta": [...] }
+where base is the generation of the snapshot.  A delta is a list of byte
+ranges [start, end] to copy from the snapshot, and bytes to insert, found by
+comparing lines.  Rebuilding a revision costs one snapshot and one delta at
+most.  A new snapshot is taken when the delta would grow past a fraction of the
+content, or after many deltas, which bounds how big deltas get.
+"text" is true when the content was a string rather than bytes.
+'''
+
+# Requires version 3, say it now rather than fail mysteriously later.
+# Won't work if you use Python 3 exclusive syntax anywhere in the file.
+import sys
+if (sys.version_info.major < 3):
+    exit ("Requires python 3")
+
+# Library imports
+import collections
+import difflib
+import pymongo
+import threading
+
+# Import the current package to get package vars like winter.software_name
+import winter
+
+# Module short description
+module_description = "resource history module"
+
+# Collection holding the revisions of all resources
+history_collection = "history"
+
+# Most revisions in one page
+max_page_size = 1000
+
+# Bytes a copy operation of a delta is counted as
+copy_cost = 16
+
+def makeDelta (base, content):
+    '''Return the delta rebuilding content from base, both bytes.'''
+    base_lines = base.splitlines (keepends=True)
+    lines = content.splitlines (keepends=True)
+    offsets = [0]
+    for line in base_lines:
+        offsets.append (offsets[-1] + len (line))
+    delta = []
+    matcher = difflib.SequenceMatcher (None, base_lines, lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes ():
+        if (tag == 'equal'):
+            delta.append ([offsets[i1], offsets[i2]])
+        elif (j1 < j2):
+            delta.append (b''.join (lines[j1:j2]))
+    return delta
+
+def applyDelta (base, delta):
+    '''Return the content rebuilt from base and a delta.'''
+    return b''.join (base[op[0]:op[1]] if isinstance (op, list) else op
+                     for op in delta)
+
+def deltaSize (delta):
+    '''Return about how many bytes a delta takes to store.'''
+    return sum (copy_cost if isinstance (op, list) else len (op) for op in delta)
+
+class History (object):
+    '''
+    The revisions of resources, kept in a collection.
+
+    A new snapshot is taken when a delta would be larger than ratio times the
+    content, or max_deltas revisions after the last snapshot.  The last
+    snapshot of recently recorded resources, and the cache_size most recently
+    rebuilt revisions, are kept in memory, behind a lock since pages are
+    read from executor threads.
+    '''
+    def __init__ (self, collection, ratio=0.5, max_deltas=100, cache_size=256):
+        self.collection = collection
+        self.ratio = ratio
+        self.max_deltas = max_deltas
+        self.cache_size = cache_size
+        self.snapshots = collections.OrderedDict ()  # name -> (generation, content, deltas)
+        self.revisions = collections.OrderedDict ()  # (name, generation) -> content
+        self.lock = threading.Lock ()   # held using snapshots and revisions
+
+    def createIndexes (self):
+        '''Create the index every query of history uses.'''
+        self.collection.create_index (
+            [("resource", pymongo.ASCENDING), ("generation", pymongo.DESCENDING)],
+            unique=True)
+
+    def record (self, resource, generation, content):
+        '''Record a revision of a resource, content being a string or bytes.'''
+        text = isinstance (content, str)
+        data = content.encode ('utf-8') if text else content
+        document = {"resource": resource, "generation": generation, "text": text}
+        base = self.lastSnapshot (resource)
+        delta = None
+        if (base is not None and base[2] < self.max_deltas):
+            delta = makeDelta (base[1], data)
+            if (deltaSize (delta) > self.ratio * len (data)):
+                delta = None
+        if (delta is None):
+            document["snapshot"] = data
+            self._remember (self.snapshots, resource, (generation, data, 0))
+        else:
+            document["base"] = base[0]
+            document["delta"] = delta
+            self._remember (self.snapshots, resource, (base[0], base[1], base[2] + 1))
+        self.collection.insert_one (document)
+        self._remember (self.revisions, (resource, generation), content)
+
+    def lastSnapshot (self, resource):
+        '''
+        Return (generation, content, deltas since) of the last snapshot of a
+        resource, or None if it has no history.
+        '''
+        snapshot = self._recall (self.snapshots, resource)
+        if (snapshot is not None):
+            return snapshot
+        deltas = 0
+        for document in (self.collection.find ({"resource": resource})
+                         .sort ("generation", pymongo.DESCENDING)
+                         .limit (self.max_deltas + 1)):
+            if ("snapshot" in document):
+                return (document["generation"], document["snapshot"], deltas)
+            deltas += 1
+        return None
+
+    def get (self, resource, generation):
+        '''Return the content of a revision, or None if there is none.'''
+        content = self._recall (self.revisions, (resource, generation))
+        if (content is not None):
+            return content
+        documents = list (self.collection.find (
+            {"resource": resource, "generation": generation}).limit (1))
+        if (not documents):
+            return None
+        return self.rebuild (documents[0])
+
+    def rebuild (self, document):
+        '''Return the content of a revision document, rebuilding a delta.'''
+        key = (document["resource"], document["generation"])
+        content = self._recall (self.revisions, key)
+        if (content is not None):
+            return content
+        if ("snapshot" in document):
+            data = document["snapshot"]
+        else:
+            base = self.get (document["resource"], document["base"])
+            if (isinstance (base, str)):
+                base = base.encode ('utf-8')
+            data = applyDelta (base, document["delta"])
+        content = data.decode ('utf-8') if document.get ("text") else data
+        self._remember (self.revisions, key, content)
+        return content
+
+    def page (self, resource, before=None, size=10):
+        '''
+        Return (revisions, cursor): up to size revisions of a resource, newest
+        first, older than generation before if given, and the cursor to pass
+        as before for the next page, or None if there are no more.  Each
+        revision is { "resource": name, "generation": n, "content": content }.
+        '''
+        size = max (1, min (size, max_page_size))
+        query = {"resource": resource}
+        if (before is not None):
+            query["generation"] = {"$lt": before}
+        documents = list (self.collection.find (query, {"_id": False})
+                          .sort ("generation", pymongo.DESCENDING)
+                          .limit (size + 1))
+        cursor = None
+        if (len (documents) > size):
+            documents = documents[:size]
+            cursor = documents[-1]["generation"]
+        revisions = [{
+            "resource": resource,
+            "generation": document["generation"],
+            "content": self.rebuild (document)
+        } for document in documents]
+        return (revisions, cursor)
+
+    def _recall (self, cache, key):
+        with self.lock:
+            value = cache.get (key)
+            if (value is not None):
+                cache.move_to_end (key)
+            return value
+
+    def _remember (self, cache, key, value):
+        with self.lock:
+            cache[key] = value
+            cache.move_to_end (key)
+            if (len (cache) > self.cache_size):
+                cache.popitem (last=False)
+
+# Running modules as top-level scripts is an antipattern, use bin/snow instead
+if __name__ == '__main__':
+    pass
@@ -18,14 +18,22 @@ if (sys.version_info.major < 3):
 
 # Library imports
 import argparse                         # read/parse command-line options
+import asyncio
+import json
 import os
 import pymongo
 import multiprocessing
+import signal
+import socket
+import threading
+import time
+import tornado.ioloop
 
 from configparser import ConfigParser
 
 # Import the current package to get package vars like winter.software_name
 import winter
+from winter import bench, calc, cluster, database, history, memory, metrics, notify, store, web
 
 # Module short description
 module_description = "initiate server module"
@@ -65,7 +73,14 @@ class Setup (object):
 
     # This is always loaded first, so global init methods go here.
     # Setting start method causes child python interpreters to not inherit from parent.
-    multiprocessing.set_start_method ("spawn")
+    # Spawned children already have it set, and setting it twice is an error.
+    if (multiprocessing.get_start_method (allow_none=True) != "spawn"):
+        multiprocessing.set_start_method ("spawn")
+
+    # Options whose values are numbers, since config files only hold strings
+    integer_options = ("dbport", "dbpoolsize", "calcworkers", "metricsport", "benchnodes",
+                       "benchfanout", "benchrequests", "benchsockets")
+    float_options = ("benchcycles",)
 
     # Create a long description from the package init vars
     long_description = "{} ({}): {}".format (
@@ -87,7 +102,16 @@ class Setup (object):
             "dbport": 27017,
             "dbname": 'winter',
             "dbuser": None,
-            "dbpassword": None
+            "dbpassword": None,
+            "dbpoolsize": 100,
+            "calcworkers": 0,
+            "metricsport": 8082,
+            "benchnodes": 1000,
+            "benchfanout": 3,
+            "benchcycles": 0.01,
+            "benchrequests": 10000,
+            "benchsockets": 100,
+            "benchoutput": None
         }
 
         # All options always exist because we use defaults if not present
@@ -172,6 +196,67 @@ class Setup (object):
             default = argparse.SUPPRESS,
             help = "database password to use when authenticating to MongoDB")
 
+        # DB pool size: most connections each process opens to MongoDB database
+        parser.add_argument (
+            "--dbpoolsize",
+            default = argparse.SUPPRESS,
+            type = int,
+            help = "most connections to MongoDB per process [default: {}]".format (
+                defaults['dbpoolsize']))
+
+        # Calc workers: number of processes calculating resources in parallel
+        parser.add_argument (
+            "--calcworkers",
+            default = argparse.SUPPRESS,
+            type = int,
+            help = "calc worker processes, 0 for one per CPU, 1 for none [default: {}]".format (
+                defaults['calcworkers']))
+
+        # Metrics port: where the supervisor serves the metrics of all components
+        parser.add_argument (
+            "--metricsport",
+            default = argparse.SUPPRESS,
+            type = int,
+            help = "local port serving metrics of all components, 0 for none [default: {}]".format (
+                defaults['metricsport']))
+
+        # Benchmark: size and shape of the synthetic wiki, and load to apply
+        parser.add_argument (
+            "--benchnodes",
+            default = argparse.SUPPRESS,
+            type = int,
+            help = "resources of the benchmark wiki [default: {}]".format (
+                defaults['benchnodes']))
+        parser.add_argument (
+            "--benchfanout",
+            default = argparse.SUPPRESS,
+            type = int,
+            help = "references of each benchmark resource [default: {}]".format (
+                defaults['benchfanout']))
+        parser.add_argument (
+            "--benchcycles",
+            default = argparse.SUPPRESS,
+            type = float,
+            help = "fraction of benchmark resources in cycles [default: {}]".format (
+                defaults['benchcycles']))
+        parser.add_argument (
+            "--benchrequests",
+            default = argparse.SUPPRESS,
+            type = int,
+            help = "benchmark web requests [default: {}]".format (
+                defaults['benchrequests']))
+        parser.add_argument (
+            "--benchsockets",
+            default = argparse.SUPPRESS,
+            type = int,
+            help = "benchmark notify connections [default: {}]".format (
+                defaults['benchsockets']))
+        parser.add_argument (
+            "--benchoutput",
+            default = argparse.SUPPRESS,
+            metavar = "FILE",
+            help = "file to write benchmark results to, as JSON [default: standard output]")
+
         # Everything else goes into "commands".
         #
         # We fill choices with methods of System tagged with @command, which
@@ -239,17 +324,22 @@ class Setup (object):
             for key in defaults:
                 if (not hasattr (options, key) and not key in profile):
                     # Missing everywhere, use default value
-                    if (key == "dbport"):
+                    if (key in self.integer_options):
                         setattr (options, key, int (defaults[key]))
+                    elif (key in self.float_options):
+                        setattr (options, key, float (defaults[key]))
                     else:
                         setattr (options, key, defaults[key])
                     if (options.verbose):
                         show (key, defaults[key], None, "from default value")
                 elif (not hasattr (options, key)):
                     # Missing from command option only, use config file value
-                    if (key == "dbport"):
+                    if (key in self.integer_options):
                         # Integer option
                         setattr (options, key, int (profile[key]))
+                    elif (key in self.float_options):
+                        # Float option
+                        setattr (options, key, float (profile[key]))
                     else:
                         # String option
                         setattr (options, key, profile[key])
@@ -298,6 +388,413 @@ def command (func):
     setattr (func, "command", None)
     return func
 
+def createComponent (component, options):
+    '''
+    Return the server of a component of the deployment, not yet listening:
+    a web.WebServer, a notify.NotifyServer, a calc.CalcDaemon, or a
+    cluster.CalcWorker.
+    '''
+    kind = component.get ("component")
+    setup = component.get ("setup", {})
+    address = setup.get ("bindAddress", "127.0.0.1")
+    db = database.connect (options)
+    filestore = store.FileStore (os.path.join (options.directory, "store"))
+    revisions = history.History (db.collection (history.history_collection))
+    if (kind == "web"):
+        revisions.createIndexes ()
+        return web.WebServer (
+            filestore, address, setup.get ("port", 8080),
+            history=revisions, reuse_port=True)
+    if (kind == "notify"):
+        return notify.NotifyServer (db, address, setup.get ("port", 8081))
+    if (kind == "daemon"):
+        evaluator = calc.Evaluator (options.directory, setup.get ("interpreters"))
+        executor = None
+        if (setup.get ("distributed")):
+            executor = cluster.QueueExecutor (db, evaluator, lease=setup.get ("lease", 30))
+        return calc.CalcDaemon (db, filestore, evaluator, options.calcworkers,
+                                executor=executor, history=revisions)
+    if (kind == "calcworker"):
+        evaluator = calc.Evaluator (options.directory, setup.get ("interpreters"))
+        return cluster.CalcWorker (db, evaluator, options.calcworkers,
+                                   lease=setup.get ("lease", 30))
+    raise Exception ("ERROR: unknown component {}".format (kind))
+
+def runComponent (component, options, heartbeat, reports=None):
+    '''
+    Run a component of the deployment until it is told to stop, the target of
+    each child process of the Supervisor.  Sets heartbeat, a shared double,
+    to the time every second while the IOLoop is responsive, and sends a
+    snapshot of its metrics every few seconds on reports, the sending end of
+    a pipe, from a thread of its own so a full pipe never blocks the IOLoop,
+    skipping snapshots while it is full.  On SIGTERM the component drains, finishing what is in progress,
+    then exits.
+    '''
+    loop = tornado.ioloop.IOLoop.current ()
+    server = createComponent (component, options)
+    server.listen ()
+
+    def beat ():
+        heartbeat.value = time.time ()
+
+    async def drain ():
+        await server.drain (component.get ("setup", {}).get ("drainTimeout", 30))
+        loop.stop ()
+
+    # Only the latest snapshot waits to be sent
+    latest = [None]
+    wanted = threading.Event ()
+
+    def report ():
+        latest[0] = metrics.registry.snapshot ()
+        wanted.set ()
+
+    def sending ():
+        while (True):
+            wanted.wait ()
+            wanted.clear ()
+            try:
+                reports.send (latest[0])
+            except OSError:
+                return
+
+    beat ()
+    tornado.ioloop.PeriodicCallback (beat, 1000).start ()
+    if (reports is not None):
+        threading.Thread (target=sending, daemon=True).start ()
+        tornado.ioloop.PeriodicCallback (report, 5000).start ()
+    # Interrupting is left to the supervisor, which then drains its children
+    signal.signal (signal.SIGINT, signal.SIG_IGN)
+    loop.asyncio_loop.add_signal_handler (
+        signal.SIGTERM, lambda: loop.add_callback (drain))
+    loop.start ()
+
+def processStats (pid):
+    '''
+    Return { "cpu": seconds, "rss": bytes } of a running process, from /proc,
+    or None if that isn't available.
+    '''
+    try:
+        with open ("/proc/{}/stat".format (pid)) as statfile:
+            # The command name may hold spaces, so split after it
+            fields = statfile.read ().rpartition (")")[2].split ()
+        with open ("/proc/{}/statm".format (pid)) as statmfile:
+            pages = int (statmfile.read ().split ()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    ticks = os.sysconf ("SC_CLK_TCK")
+    return {
+        "cpu": (int (fields[11]) + int (fields[12])) / ticks,
+        "rss": pages * os.sysconf ("SC_PAGE_SIZE")
+    }
+
+# Components run by a local database when the deployment collection has none
+local_deployment = [
+    {"_id": "web", "component": "web", "setup": {"workers": 1}},
+    {"_id": "notify", "component": "notify"},
+    {"_id": "daemon", "component": "daemon"}
+]
+
+class Child (object):
+    '''
+    A component of the deployment, run in a child process by the Supervisor.
+    '''
+    def __init__ (self, component, name):
+        self.component = component
+        self.name = name
+        self.process = None
+        self.heartbeat = None           # shared time of last heartbeat, 0 until listening
+        self.launched = None            # time of last start
+        self.started = None             # monotonic time of last start
+        self.failures = 0               # failures in a row
+        self.restarts = 0
+        self.restart_at = 0             # monotonic time to start again
+        self.reports = None             # receiving end of metrics snapshots
+        self.metrics = {}               # last metrics snapshot
+
+    def alive (self):
+        return self.process is not None and self.process.is_alive ()
+
+class Supervisor (object):
+    '''
+    Runs the components of the deployment found for this host, each in a
+    child process, and keeps them running.
+
+    A child that exits, or whose heartbeat is over timeout seconds old, or
+    that hasn't beaten within startup_timeout seconds of starting, loading
+    what it serves, is restarted after a delay doubling from min_backoff up to max_backoff with
+    each failure in a row; a child that ran stable seconds before failing
+    starts over from min_backoff.  The deployment collection is read again
+    every reload seconds: new components are started, removed ones stopped,
+    and changed ones restarted.  A child is stopped by draining it, which
+    finishes requests in progress and closes WebSocket connections cleanly
+    within drain_timeout seconds, before it is killed.
+
+    A web component runs as several workers, given by "workers" in its setup,
+    one per CPU by default, all listening on the same port.  Web workers are
+    replaced one by one, each new one listening before the old one drains, so
+    a rolling change of setup never refuses a connection.
+    '''
+    def __init__ (self, options, poll=1, timeout=15, min_backoff=1, max_backoff=60,
+                  stable=60, reload=10, drain_timeout=30, startup_timeout=300):
+        self.options = options
+        self.poll = poll
+        self.timeout = timeout
+        self.startup_timeout = startup_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable = stable
+        self.reload = reload
+        self.drain_timeout = drain_timeout
+        self.context = multiprocessing.get_context ("spawn")
+        self.children = {}              # component _id -> Child
+        self.stopped = threading.Event ()
+
+    def components (self):
+        '''Return the components of the deployment for this host, by _id.'''
+        deployment = database.connect (self.options).collection ("deployment")
+        query = {"$or": [{"host": {"$exists": False}}, {"host": socket.gethostname ()}]}
+        return {component["_id"]: component for component in deployment.find (query)}
+
+    def workers (self, components):
+        '''
+        Return the children to run for components, by (_id, worker), with the
+        name of each as (component, name).
+        '''
+        children = {}
+        for key, component in components.items ():
+            kind = component.get ("component")
+            if (kind == "web"):
+                count = component.get ("setup", {}).get ("workers") or os.cpu_count () or 1
+            else:
+                count = 1
+            for worker in range (count):
+                name = "{} {}".format (kind, key)
+                if (count > 1):
+                    name += " #{}".format (worker)
+                children[(key, worker)] = (component, name)
+        return children
+
+    def backoff (self, failures):
+        '''Return the seconds to wait before a restart after so many failures.'''
+        return min (self.max_backoff, self.min_backoff * 2 ** max (0, failures - 1))
+
+    def start (self, child):
+        child.heartbeat = self.context.Value ('d', 0.0)
+        child.launched = time.time ()
+        child.reports, reports = self.context.Pipe (duplex=False)
+        child.process = self.context.Process (
+            target=runComponent, name=child.name,
+            args=(child.component, self.options, child.heartbeat, reports))
+        child.process.start ()
+        reports.close ()
+        child.started = time.monotonic ()
+        print ("Started {}, pid {}".format (child.name, child.process.pid))
+
+    def startupTimeout (self, child):
+        '''Return the seconds a child has to start beating.'''
+        return child.component.get ("setup", {}).get ("startupTimeout", self.startup_timeout)
+
+    def listening (self, child):
+        '''Wait for a child to start beating, True if it did.'''
+        deadline = time.monotonic () + self.startupTimeout (child)
+        while (child.heartbeat.value == 0 and child.alive () and
+               time.monotonic () < deadline):
+            time.sleep (0.1)
+        return child.heartbeat.value != 0
+
+    def stop (self, child):
+        '''Drain a child, killing it if it doesn't exit in time.'''
+        if (child.process is None):
+            return
+        if (child.alive ()):
+            child.process.terminate ()
+            child.process.join (self.drain_timeout + 5)
+            if (child.alive ()):
+                print ("Killing {}, still draining".format (child.name))
+                child.process.kill ()
+                child.process.join ()
+        child.process = None
+
+    def check (self):
+        '''Restart children that exited or stopped beating, after a backoff.'''
+        now = time.monotonic ()
+        for child in self.children.values ():
+            self.receive (child)
+            if (child.process is not None):
+                if (child.heartbeat.value):
+                    stale = time.time () - child.heartbeat.value > self.timeout
+                else:
+                    stale = time.time () - child.launched > self.startupTimeout (child)
+                if (child.alive () and not stale):
+                    continue
+                if (stale and child.alive ()):
+                    print ("{} stopped responding, killing it".format (child.name))
+                    child.process.kill ()
+                child.process.join ()
+                print ("{} exited with {}".format (child.name, child.process.exitcode))
+                child.process = None
+                if (now - child.started >= self.stable):
+                    child.failures = 0
+                child.failures += 1
+                child.restart_at = now + self.backoff (child.failures)
+            if (now >= child.restart_at):
+                child.restarts += 1
+                self.start (child)
+
+    def receive (self, child):
+        '''Take the latest metrics snapshot a child sent, if any.'''
+        try:
+            while (child.reports is not None and child.reports.poll ()):
+                child.metrics = child.reports.recv ()
+        except (EOFError, OSError):
+            child.reports = None
+
+    def collect (self):
+        '''
+        Return the metrics of all children, each labeled by child, with their
+        process statistics, as metrics.exposition takes them.
+        '''
+        collected = []
+        stats = self.stats ()
+        for child in list (self.children.values ()):
+            stat = stats.get (child.name, {})
+            snapshot = dict (child.metrics)
+            snapshot["winter_child_restarts_total"] = {
+                "kind": "counter", "description": "Restarts of the child process",
+                "value": stat.get ("restarts", 0)}
+            snapshot["winter_child_up"] = {
+                "kind": "gauge", "description": "Whether the child process is running",
+                "value": int (stat.get ("pid") is not None)}
+            if ("cpu" in stat):
+                snapshot["process_cpu_seconds_total"] = {
+                    "kind": "counter", "description": "CPU seconds used",
+                    "value": stat["cpu"]}
+                snapshot["process_resident_memory_bytes"] = {
+                    "kind": "gauge", "description": "Resident memory in bytes",
+                    "value": stat["rss"]}
+            collected.append (({"child": child.name,
+                                "component": child.component.get ("component")}, snapshot))
+        return collected
+
+    def reconfigure (self, components):
+        '''Bring the children in line with the components of the deployment.'''
+        workers = self.workers (components)
+        for key, (component, name) in workers.items ():
+            child = self.children.get (key)
+            if (child is None):
+                self.children[key] = Child (component, name)
+                self.start (self.children[key])
+            elif (child.component != component):
+                print ("Restarting {} with its new setup".format (child.name))
+                replacement = Child (component, name)
+                replacement.restarts = child.restarts
+                if (component.get ("component") == "web"):
+                    # Sharing the port, the old worker drains once the new one listens
+                    self.start (replacement)
+                    self.listening (replacement)
+                    self.stop (child)
+                else:
+                    self.stop (child)
+                    self.start (replacement)
+                self.children[key] = replacement
+        for key in list (self.children):
+            if (key not in workers):
+                print ("Removing {}".format (self.children[key].name))
+                self.stop (self.children.pop (key))
+
+    def stats (self):
+        '''
+        Return the state of each child by name: its pid, restarts, and the
+        cpu seconds and rss bytes of processStats when it is running.
+        '''
+        stats = {}
+        for child in self.children.values ():
+            stat = {"pid": None, "restarts": child.restarts}
+            if (child.alive ()):
+                stat["pid"] = child.process.pid
+                stat.update (processStats (child.process.pid) or {})
+            stats[child.name] = stat
+        return stats
+
+    def run (self):
+        '''Run the children until interrupted or terminated, then stop them.'''
+        if (database.connect (self.options).local):
+            return self.runLocal ()
+        signal.signal (signal.SIGTERM, lambda signum, frame: self.stopped.set ())
+        server = self.serveMetrics (self.collect)
+        try:
+            self.reconfigure (self.components ())
+            reloaded = time.monotonic ()
+            while (not self.stopped.wait (self.poll)):
+                self.check ()
+                if (time.monotonic () - reloaded >= self.reload):
+                    reloaded = time.monotonic ()
+                    try:
+                        self.reconfigure (self.components ())
+                    except pymongo.errors.PyMongoError as ex:
+                        print ("Unable to read deployment: {}".format (str (ex)))
+                    if (self.options.verbose):
+                        for name, stat in sorted (self.stats ().items ()):
+                            print ("{}: {}".format (name, stat))
+        except KeyboardInterrupt:
+            pass
+        print ("Stopping")
+        for child in self.children.values ():
+            if (child.alive ()):
+                child.process.terminate ()
+        for child in self.children.values ():
+            self.stop (child)
+        if (server is not None):
+            server.stop ()
+
+    def serveMetrics (self, collect):
+        '''Start serving metrics on the metricsport option, unless it is 0.'''
+        if (not self.options.metricsport):
+            return None
+        server = metrics.MetricsServer (collect, port=self.options.metricsport)
+        server.start ()
+        return server
+
+    def runLocal (self):
+        '''
+        Run every component in this process, on one IOLoop, for a database
+        only this process can use, see memory.  Without any component in the
+        deployment collection, runs those of local_deployment.  The database
+        is saved every reload seconds, and once all components drained.
+        '''
+        db = database.connect (self.options)
+        components = self.components () or {
+            component["_id"]: component for component in local_deployment}
+        loop = tornado.ioloop.IOLoop.current ()
+        servers = []
+        for component in components.values ():
+            server = createComponent (component, self.options)
+            server.listen ()
+            servers.append ((component, server))
+            print ("Started {} {}".format (component.get ("component"), component["_id"]))
+
+        draining = []
+
+        async def drain ():
+            if (draining):
+                return
+            draining.append (True)
+            print ("Stopping")
+            await asyncio.gather (*(
+                server.drain (component.get ("setup", {}).get ("drainTimeout", self.drain_timeout))
+                for component, server in servers))
+            loop.stop ()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.asyncio_loop.add_signal_handler (signum, lambda: loop.add_callback (drain))
+        tornado.ioloop.PeriodicCallback (db.save, self.reload * 1000).start ()
+        server = self.serveMetrics (lambda: [({}, metrics.registry.snapshot ())])
+        loop.start ()
+        if (server is not None):
+            server.stop ()
+        db.close ()
+
 class System (object):
     '''
     The Winter system embodied as a single object that runs commands.
@@ -322,21 +819,70 @@ class System (object):
         '''
         Command to run Winter, launching all the parts based on database.
 
-        Looks only in deployment collection.
+        Looks only in deployment collection, for components without a "host",
+        or with this host as "host".  Each runs in its own process, kept
+        running by a Supervisor, and changes to the collection are picked up
+        while running.
 
         Finds web components:
             "component": "web"
-        Expects its setup to contain bindAddress and port:
-            "setup" : { "bindAddress" : "127.0.0.2", "port" : 80 }
+        Expects its setup to contain bindAddress and port, and optionally the
+        number of worker processes sharing the port, one per CPU by default:
+            "setup" : { "bindAddress" : "127.0.0.2", "port" : 80, "workers" : 4 }
 
         Finds notify components:
             "component": "notify"
+        Its setup may also contain bindAddress and port.
 
         Finds daemon components:
             "component": "daemon"
+        Its setup may map languages to the pool of external interpreters
+        evaluating them (see calc.Evaluator):
+            "setup" : { "interpreters" : { "ruby" : { "command" : ["ruby", "w.rb"] } } }
+        With distributed, it hands calculations to the calc workers of every
+        host through the database instead, see cluster:
+            "setup" : { "distributed" : true, "lease" : 30 }
+
+        Finds calcworker components, evaluating for a distributed daemon, which
+        may be on many hosts, each using calcworkers processes:
+            "component": "calcworker"
+        Its setup may contain interpreters and lease, like the daemon's.
+
+        Any setup may give drainTimeout, the seconds a component has to finish
+        what it is doing when stopped, and startupTimeout, the seconds it has
+        to start, 300 by default.  Runs until interrupted.
+
+        With "memory" as database host, everything runs in this one process
+        instead, see Supervisor.runLocal.
+
+        Metrics of every component are served at /metrics on the local port
+        of the metricsport option, see metrics.
+        '''
+        Supervisor (self.options).run ()
 
+    @command
+    def benchmark (self):
         '''
-        print ("Hello")
+        Command to benchmark web reads, cascades, releases, and notifications
+        on a synthetic wiki, see bench.  Releases are written to a scratch
+        collection of the database, or of a memory.MemoryDatabase when it is
+        unreachable.  Results are JSON.
+        '''
+        db = database.connect (self.options)
+        if (not db.ping ()):
+            print ("Database unreachable, benchmarking releases in memory")
+            db = memory.MemoryDatabase ()
+        collection = db.collection ("benchmark")
+        results = bench.run (
+            self.options.benchnodes, self.options.benchfanout, self.options.benchcycles,
+            self.options.benchrequests, sockets=self.options.benchsockets,
+            workers=self.options.calcworkers, collection=collection)
+        output = json.dumps (results, indent=2, sort_keys=True)
+        if (self.options.benchoutput and self.options.benchoutput != "None"):
+            with open (self.options.benchoutput, 'w') as outputfile:
+                outputfile.write (output + "\n")
+        else:
+            print (output)
 
     @command
     def test_db_connection (self):
@@ -344,29 +890,29 @@ class System (object):
         print ("Testing database connection, host {}, port {}, database {}".format (
             self.options.dbhost, self.options.dbport, self.options.dbname))
         try:
-            # Make connection
-            client = pymongo.MongoClient (
-                host=self.options.dbhost, port=self.options.dbport)
-            client.admin.command ('ping')
-            print ("Connected without error:")
-            # Get server information
-            info = client.server_info ()
-            print ("    server version {}".format (info['version']))
-            # Get database and names of collections
-            database = client[self.options.dbname]
-            # Try authenticating against the database
-            if (self.options.dbuser):
-                print ("Authenticating as user {}".format (
-                    self.options.dbuser))
-                database.authenticate (self.options.dbuser, self.options.dbpassword)
-                print ("    authenticated to database '{}' as user '{}'".format (self.options.dbname, self.options.dbuser))
+            # Make connection, the shared one of this process
+            db = database.connect (self.options)
+            if (db.local):
+                # The in-memory database of this process, no server to reach
+                db.ping ()
+                print ("Using the in-memory database, no server to connect to")
             else:
-                print ("Not using database authentication")
-            # Show collections
-            names = database.collection_names ()
+                client = db.client
+                client.admin.command ('ping')
+                print ("Connected without error:")
+                # Get server information
+                info = client.server_info ()
+                print ("    server version {}".format (info['version']))
+                # Authentication happens on connecting, with the credentials given
+                if (self.options.dbuser):
+                    print ("    authenticated to database '{}' as user '{}'".format (self.options.dbname, self.options.dbuser))
+                else:
+                    print ("Not using database authentication")
+            # Get database and names of collections
+            names = db.database.list_collection_names ()
             print ("Database '{}' has {} collections".format (
                 self.options.dbname, len (names)))
-            client.close ()
+            db.close ()
         except pymongo.errors.InvalidName as ex:
             print ("Invalid database name: {}".format (str (ex)))
         except Exception as ex:
@@ -0,0 +1,216 @@
+# This file is part of Winter, a wiki-based computing platform.
+# Copyright (C) 2026  Max Polk <maxpolk@gmail.com>
+# License located at http://www.gnu.org/licenses/agpl-3.0.html
+'''
+Pools of long-lived external interpreters for code resources in languages
+other than Python 3.
+
+An interpreter is any program that reads requests from its standard input and
+writes one response for each to its standard output, both framed as a 4-byte
+big-endian length followed by that many bytes of UTF-8 JSON.  A request is:
+    { "resource": resource, "inputs": inputs, "generation": n }
+and the response is either of:
+    { "result": value }
+    { "error": "what went wrong" }
+Its standard error is left alone, so it goes wherever ours goes.
+
+Starting an interpreter usually costs far more than evaluating a small
+resource, so interpreters are kept running and reused, and only replaced after
+max_requests requests, after a timeout, or when they die.
+'''
+
+# Requires version 3, say it now rather than fail mysteriously later.
+# Won't work if you use Python 3 exclusive syntax anywhere in the file.
+import sys
+if (sys.version_info.major < 3):
+    exit ("Requires python 3")
+
+# Library imports
+import json
+import os
+import select
+import struct
+import subprocess
+import threading
+import time
+
+# Import the current package to get package vars like winter.software_name
+import winter
+
+# Module short description
+module_description = "external interpreter module"
+
+# Frame header: length of the JSON that follows
+frame_header = struct.Struct (">I")
+
+class Interpreter (object):
+    '''
+    One running interpreter process.
+    '''
+    def __init__ (self, command):
+        self.process = subprocess.Popen (
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        self.requests = 0
+
+    def alive (self):
+        return self.process.poll () is None
+
+    def call (self, request, timeout):
+        '''
+        Send a request and return the response, raising an exception when the
+        interpreter doesn't take it and answer within timeout seconds, or dies
+        meanwhile.
+        '''
+        data = json.dumps (request).encode ('utf-8')
+        deadline = time.monotonic () + timeout
+        self._write (frame_header.pack (len (data)) + data, deadline)
+        size, = frame_header.unpack (self._read (frame_header.size, deadline))
+        self.requests += 1
+        return json.loads (self._read (size, deadline).decode ('utf-8'))
+
+    def _write (self, data, deadline):
+        '''
+        Write all of data before the deadline, at most PIPE_BUF bytes at a time
+        once the pipe has room, since a write that size never blocks.
+        '''
+        fd = self.process.stdin.fileno ()
+        view = memoryview (data)
+        while (view):
+            remaining = deadline - time.monotonic ()
+            if (remaining <= 0 or not select.select ([], [fd], [], remaining)[1]):
+                raise Exception ("ERROR: interpreter timed out")
+            try:
+                written = os.write (fd, view[:select.PIPE_BUF])
+            except BrokenPipeError:
+                raise Exception ("ERROR: interpreter exited with {}".format (
+                    self.process.wait ()))
+            view = view[written:]
+
+    def _read (self, size, deadline):
+        '''Read exactly size bytes of output before the deadline.'''
+        fd = self.process.stdout.fileno ()
+        chunks = []
+        while (size > 0):
+            remaining = deadline - time.monotonic ()
+            if (remaining <= 0 or not select.select ([fd], [], [], remaining)[0]):
+                raise Exception ("ERROR: interpreter timed out")
+            chunk = os.read (fd, size)
+            if (not chunk):
+                raise Exception ("ERROR: interpreter exited with {}".format (
+                    self.process.wait ()))
+            chunks.append (chunk)
+            size -= len (chunk)
+        return b''.join (chunks)
+
+    def close (self, kill=False):
+        '''Stop the interpreter, by closing its input, else killing it.'''
+        try:
+            if (kill):
+                self.process.kill ()
+            self.process.stdin.close ()
+            self.process.wait (1)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill ()
+            self.process.wait ()
+        self.process.stdout.close ()
+
+class InterpreterPool (object):
+    '''
+    Up to size running interpreters of one language, started by command, a
+    list of program and arguments.
+
+    Calls take the most recently used idle interpreter, which is the warmest,
+    and wait when all are busy.  An interpreter is replaced after max_requests
+    requests, and killed when a request takes over timeout seconds.  Safe to
+    use from several threads.
+    '''
+    def __init__ (self, command, size=2, max_requests=1000, timeout=10):
+        self.command = command
+        self.size = size
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.idle = []                  # interpreters ready for a request
+        self.running = 0                # interpreters, idle or busy
+        self.condition = threading.Condition ()
+
+    def evaluate (self, resource, inputs, generation):
+        '''Evaluate a resource on an interpreter and return the result.'''
+        interpreter = self.acquire ()
+        healthy = False
+        try:
+            response = interpreter.call (
+                {"resource": resource, "inputs": inputs, "generation": generation},
+                self.timeout)
+            healthy = True
+        finally:
+            self.release (interpreter, healthy)
+        if ("error" in response):
+            raise Exception ("ERROR: {} failed: {}".format (
+                resource['name'], response["error"]))
+        return response.get ("result")
+
+    def acquire (self):
+        '''Take an idle interpreter, or start one, or wait for one.'''
+        with self.condition:
+            while (not self.idle and self.running >= self.size):
+                self.condition.wait ()
+            if (self.idle):
+                return self.idle.pop ()
+            self.running += 1
+        try:
+            return Interpreter (self.command)
+        except BaseException:
+            with self.condition:
+                self.running -= 1
+                self.condition.notify ()
+            raise
+
+    def release (self, interpreter, healthy=True):
+        '''Return an interpreter, stopping it if it shouldn't be reused.'''
+        if (healthy and interpreter.alive () and
+            interpreter.requests < self.max_requests):
+            with self.condition:
+                self.idle.append (interpreter)
+                self.condition.notify ()
+            return
+        interpreter.close (kill=not healthy)
+        with self.condition:
+            self.running -= 1
+            self.condition.notify ()
+
+    def supervise (self):
+        '''
+        Stop idle interpreters that died, and start interpreters until the
+        pool is full, so calls don't wait for one to start.  Call now and then.
+        '''
+        with self.condition:
+            dead = [interpreter for interpreter in self.idle
+                    if not interpreter.alive ()]
+            self.idle = [interpreter for interpreter in self.idle
+                         if interpreter.alive ()]
+            self.running -= len (dead)
+            missing = self.size - self.running
+            self.running += missing
+        for interpreter in dead:
+            interpreter.close ()
+        for count in range (missing):
+            try:
+                self.release (Interpreter (self.command))
+            except OSError as ex:
+                print ("Unable to start interpreter {}: {}".format (self.command, str (ex)))
+                with self.condition:
+                    self.running -= 1
+
+    def close (self):
+        '''Stop all idle interpreters; busy ones stop once released.'''
+        with self.condition:
+            idle = self.idle
+            self.idle = []
+            self.running -= len (idle)
+            self.max_requests = 0
+        for interpreter in idle:
+            interpreter.close ()
+
+# Running modules as top-level scripts is an antipattern, use bin/snow instead
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,585 @@
+# This file is part of Winter, a wiki-based computing platform.
+# Copyright (C) 2026  Max Polk <maxpolk@gmail.com>
+# License located at http://www.gnu.org/licenses/agpl-3.0.html
+'''
+In-process database with the same semantics as the MongoDB one, for tests,
+benchmarks, and small deployments on a single machine that would rather not
+pay a network round trip per query.
+
+A MemoryDatabase gives collections implementing the part of the pymongo
+Collection that Winter uses (see database), including change streams:
+    find, find_one, count_documents, insert_one, replace_one, update_one,
+    find_one_and_update, delete_one, delete_many, bulk_write, create_index,
+    watch, drop
+Documents are kept by _id in insertion order.  Each index is a dict from each
+value of its first field to the array of _id having it, and a query with an
+equality on an indexed field only looks at those; everything else scans.
+Documents are copied going in and out, so callers never share them.
+
+Being in one process, a MemoryDatabase can't be shared by separate processes;
+initiate.Supervisor runs all components in one process when using it.  With a
+directory, collections are saved there as BSON by save, and read back when
+the database is created.
+'''
+
+# Requires version 3, say it now rather than fail mysteriously later.
+# Won't work if you use Python 3 exclusive syntax anywhere in the file.
+import sys
+if (sys.version_info.major < 3):
+    exit ("Requires python 3")
+
+# Library imports
+import bson
+import collections
+import copy
+import os
+import pymongo
+import tempfile
+import threading
+
+# Import the current package to get package vars like winter.software_name
+import winter
+
+# Module short description
+module_description = "in-memory database module"
+
+# Changes kept per collection for change streams to resume from
+change_history = 10000
+
+def getField (document, key):
+    '''Return (True, value) of a dotted key of a document, or (False, None).'''
+    value = document
+    for part in key.split ("."):
+        if (not isinstance (value, dict) or part not in value):
+            return (False, None)
+        value = value[part]
+    return (True, value)
+
+def compare (value, operator, operand):
+    '''True if a value satisfies one query operator; mismatched types never do.'''
+    if (operator == "$eq"):
+        return value == operand or (isinstance (value, list) and operand in value)
+    if (operator == "$ne"):
+        return not compare (value, "$eq", operand)
+    if (operator == "$in"):
+        return any (compare (value, "$eq", item) for item in operand)
+    if (operator == "$nin"):
+        return not compare (value, "$in", operand)
+    try:
+        if (operator == "$lt"):
+            return value is not None and value < operand
+        if (operator == "$lte"):
+            return value is not None and value <= operand
+        if (operator == "$gt"):
+            return value is not None and value > operand
+        if (operator == "$gte"):
+            return value is not None and value >= operand
+    except TypeError:
+        return False
+    raise pymongo.errors.OperationFailure ("unknown operator: {}".format (operator))
+
+def isOperators (condition):
+    return (isinstance (condition, dict) and bool (condition) and
+            all (key.startswith ("$") for key in condition))
+
+def matches (document, query):
+    '''True if a document matches a query.'''
+    for key, condition in query.items ():
+        if (key == "$or"):
+            if (not any (matches (document, part) for part in condition)):
+                return False
+        elif (key == "$and"):
+            if (not all (matches (document, part) for part in condition)):
+                return False
+        else:
+            found, value = getField (document, key)
+            if (isOperators (condition)):
+                for operator, operand in condition.items ():
+                    if (operator == "$exists"):
+                        if (found != bool (operand)):
+                            return False
+                    elif (not found):
+                        # A missing field equals null, and compares with nothing else
+                        if (operator not in ("$eq", "$ne", "$in", "$nin") or
+                            not compare (None, operator, operand)):
+                            return False
+                    elif (not compare (value, operator, operand)):
+                        return False
+            elif (condition is None):
+                # Null matches a missing field too
+                if (found and value is not None):
+                    return False
+            elif (not found or not compare (value, "$eq", condition)):
+                return False
+    return True
+
+def project (document, projection):
+    '''Return a copy of a document with only the fields of a projection.'''
+    document = copy.deepcopy (document)
+    if (not projection):
+        return document
+    included = [key for key, value in projection.items () if value and key != "_id"]
+    if (included):
+        result = {key: document[key] for key in included if key in document}
+        if (projection.get ("_id", True) and "_id" in document):
+            result["_id"] = document["_id"]
+        return result
+    for key, value in projection.items ():
+        if (not value):
+            document.pop (key, None)
+    return document
+
+def indexKeys (value):
+    '''Return the keys a value is indexed under, every item of an array too.'''
+    keys = [indexKey (value)]
+    if (isinstance (value, list)):
+        keys.extend (indexKey (item) for item in value)
+    return keys
+
+def indexKey (value):
+    try:
+        hash (value)
+        return value
+    except TypeError:
+        return ("unhashable", repr (value))
+
+def applyUpdate (document, update):
+    '''Apply the $set, $unset and $inc of an update to a document.'''
+    for operator, fields in update.items ():
+        for key, value in fields.items ():
+            if (operator == "$set"):
+                document[key] = copy.deepcopy (value)
+            elif (operator == "$unset"):
+                document.pop (key, None)
+            elif (operator == "$inc"):
+                document[key] = document.get (key, 0) + value
+            else:
+                raise pymongo.errors.OperationFailure (
+                    "unknown update operator: {}".format (operator))
+
+class MemoryCursor (object):
+    '''Result of find, sorted and limited before iterating.'''
+    def __init__ (self, documents, projection):
+        self.documents = documents
+        self.projection = projection
+
+    def sort (self, key, direction=pymongo.ASCENDING):
+        keys = key if isinstance (key, list) else [(key, direction)]
+        for field, order in reversed (keys):
+            present = [document for document in self.documents
+                       if getField (document, field)[1] is not None]
+            missing = [document for document in self.documents
+                       if getField (document, field)[1] is None]
+            present.sort (key=lambda document: getField (document, field)[1],
+                          reverse=order < 0)
+            # None sorts before everything, as in MongoDB
+            self.documents = missing + present if order > 0 else present + missing
+        return self
+
+    def skip (self, count):
+        self.documents = self.documents[count:]
+        return self
+
+    def limit (self, count):
+        if (count):
+            self.documents = self.documents[:count]
+        return self
+
+    def __iter__ (self):
+        for document in self.documents:
+            yield project (document, self.projection)
+
+class MemoryChangeStream (object):
+    '''
+    Change stream of a MemoryCollection, iterating changes as they happen,
+    shaped like those of MongoDB, until closed.
+    '''
+    def __init__ (self, collection, resume_after=None):
+        self.collection = collection
+        self.closed = False
+        self.resume_token = resume_after
+        with collection.condition:
+            if (resume_after is None):
+                self.position = collection.sequence
+            else:
+                self.position = resume_after["_data"]
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *args):
+        self.close ()
+
+    def __iter__ (self):
+        return self
+
+    def __next__ (self):
+        change = self.next ()
+        if (change is None):
+            raise StopIteration
+        return change
+
+    def next (self, timeout=None):
+        '''Return the next change, waiting for it, or None once closed.'''
+        collection = self.collection
+        with collection.condition:
+            while (not self.closed and self.position >= collection.sequence):
+                if (not collection.condition.wait (timeout) and timeout is not None):
+                    return None
+            if (self.closed):
+                return None
+            oldest = collection.changes[0][0]
+            if (self.position + 1 < oldest):
+                # Like ChangeStreamHistoryLost of MongoDB, see database.historyLost
+                raise pymongo.errors.OperationFailure (
+                    "change stream fell behind the change history", code=286)
+            sequence, change = collection.changes[self.position + 1 - oldest]
+            self.position = sequence
+        self.resume_token = change["_id"]
+        return copy.deepcopy (change)
+
+    def try_next (self):
+        '''Return the next change if there is one, otherwise None.'''
+        return self.next (0)
+
+    @property
+    def alive (self):
+        return not self.closed
+
+    def close (self):
+        with self.collection.condition:
+            self.closed = True
+            self.collection.condition.notify_all ()
+
+class MemoryCollection (object):
+    '''
+    A collection of documents by _id, with indexes.  Safe to use from several
+    threads.
+    '''
+    def __init__ (self, name):
+        self.name = name
+        self.documents = {}             # indexKey (_id) -> document
+        self.indexes = {}               # field -> {indexKey (value): [indexKey (_id), ...]}
+        self.unique = []                # field lists of unique indexes
+        self.changes = collections.deque (maxlen=change_history)  # (sequence, change)
+        self.sequence = 0
+        self.condition = threading.Condition (threading.RLock ())
+
+    def createIndexEntries (self, field):
+        index = {}
+        for key, document in self.documents.items ():
+            found, value = getField (document, field)
+            for entry in indexKeys (value if found else None):
+                index.setdefault (entry, []).append (key)
+        self.indexes[field] = index
+
+    def create_index (self, keys, unique=False, **options):
+        '''Index the first field of keys, checking the whole of unique ones.'''
+        if (isinstance (keys, str)):
+            keys = [(keys, pymongo.ASCENDING)]
+        fields = [field for field, direction in keys]
+        with self.condition:
+            if (fields[0] not in self.indexes):
+                self.createIndexEntries (fields[0])
+            if (unique and fields not in self.unique):
+                self.unique.append (fields)
+        return "_".join ("{}_{}".format (field, direction) for field, direction in keys)
+
+    def candidates (self, query):
+        '''Return the _id of documents that may match, using an index if possible.'''
+        for key, condition in query.items ():
+            if (key == "_id" and not isOperators (condition)):
+                return [indexKey (condition)]
+            index = self.indexes.get (key)
+            if (index is None):
+                continue
+            if (not isOperators (condition)):
+                return list (index.get (indexKey (condition), ()))
+            if (list (condition) == ["$in"]):
+                keys = []
+                for item in condition["$in"]:
+                    keys.extend (index.get (indexKey (item), ()))
+                return list (dict.fromkeys (keys))
+        return list (self.documents)
+
+    def _find (self, query):
+        query = query or {}
+        return [self.documents[key] for key in self.candidates (query)
+                if key in self.documents and matches (self.documents[key], query)]
+
+    def find (self, query=None, projection=None):
+        with self.condition:
+            return MemoryCursor (self._find (query), projection)
+
+    def find_one (self, query=None, projection=None):
+        for document in self.find (query, projection).limit (1):
+            return document
+        return None
+
+    def count_documents (self, query):
+        with self.condition:
+            return len (self._find (query))
+
+    def _index (self, document, add=True):
+        for field, index in self.indexes.items ():
+            found, value = getField (document, field)
+            for key in set (indexKeys (value if found else None)):
+                identity = indexKey (document["_id"])
+                if (add):
+                    index.setdefault (key, []).append (identity)
+                else:
+                    ids = index.get (key, [])
+                    if (identity in ids):
+                        ids.remove (identity)
+                    if (not ids):
+                        index.pop (key, None)
+
+    def _checkUnique (self, document):
+        for fields in self.unique:
+            values = [getField (document, field) for field in fields]
+            query = {field: value for field, (found, value) in zip (fields, values)}
+            for other in self._find (query):
+                if (other["_id"] != document["_id"]):
+                    raise pymongo.errors.DuplicateKeyError (
+                        "E11000 duplicate key error collection: {} index: {}".format (
+                            self.name, "_".join (fields)))
+
+    def _record (self, operation, key, document=None):
+        self.sequence += 1
+        change = {
+            "_id": {"_data": self.sequence},
+            "operationType": operation,
+            "ns": {"coll": self.name}
+        }
+        if (key is not None):
+            change["documentKey"] = {"_id": key}
+        if (document is not None):
+            change["fullDocument"] = copy.deepcopy (document)
+        self.changes.append ((self.sequence, change))
+        self.condition.notify_all ()
+
+    def _insert (self, document):
+        if ("_id" not in document):
+            document["_id"] = bson.ObjectId ()
+        stored = copy.deepcopy (document)
+        if (indexKey (stored["_id"]) in self.documents):
+            raise pymongo.errors.DuplicateKeyError (
+                "E11000 duplicate key error collection: {} index: _id_".format (self.name))
+        self._checkUnique (stored)
+        self.documents[indexKey (stored["_id"])] = stored
+        self._index (stored)
+        self._record ("insert", stored["_id"], stored)
+        return stored["_id"]
+
+    def _replace (self, old, document, operation):
+        self._checkUnique (document)
+        self._index (old, add=False)
+        self.documents[indexKey (document["_id"])] = document
+        self._index (document)
+        self._record (operation, document["_id"], document)
+
+    def insert_one (self, document):
+        with self.condition:
+            return pymongo.results.InsertOneResult (self._insert (document), True)
+
+    def _replaceOne (self, query, replacement, upsert=False):
+        '''Return (matched, upserted _id or None).'''
+        found = self._find (query)
+        if (found):
+            document = copy.deepcopy (replacement)
+            document["_id"] = found[0]["_id"]
+            self._replace (found[0], document, "replace")
+            return (1, None)
+        if (not upsert):
+            return (0, None)
+        document = dict (replacement)
+        if ("_id" not in document and "_id" in query and not isOperators (query["_id"])):
+            document["_id"] = query["_id"]
+        return (0, self._insert (document))
+
+    def _updateOne (self, query, update, upsert=False):
+        found = self._find (query)
+        if (found):
+            document = copy.deepcopy (found[0])
+            applyUpdate (document, update)
+            self._replace (found[0], document, "update")
+            return (1, None)
+        if (not upsert):
+            return (0, None)
+        document = {key: value for key, value in query.items ()
+                    if not key.startswith ("$") and not isOperators (value)}
+        applyUpdate (document, update)
+        return (0, self._insert (document))
+
+    def _delete (self, query, many):
+        deleted = 0
+        for document in self._find (query):
+            del self.documents[indexKey (document["_id"])]
+            self._index (document, add=False)
+            self._record ("delete", document["_id"])
+            deleted += 1
+            if (not many):
+                break
+        return deleted
+
+    def replace_one (self, query, replacement, upsert=False):
+        with self.condition:
+            matched, upserted = self._replaceOne (query, replacement, upsert)
+        return pymongo.results.UpdateResult (
+            {"n": matched or int (upserted is not None), "nModified": matched,
+             "upserted": upserted}, True)
+
+    def update_one (self, query, update, upsert=False):
+        with self.condition:
+            matched, upserted = self._updateOne (query, update, upsert)
+        return pymongo.results.UpdateResult (
+            {"n": matched or int (upserted is not None), "nModified": matched,
+             "upserted": upserted}, True)
+
+    def delete_one (self, query):
+        with self.condition:
+            return pymongo.results.DeleteResult ({"n": self._delete (query, False)}, True)
+
+    def delete_many (self, query):
+        with self.condition:
+            return pymongo.results.DeleteResult ({"n": self._delete (query, True)}, True)
+
+    def find_one_and_update (self, query, update, projection=None, sort=None,
+                             return_document=pymongo.ReturnDocument.BEFORE):
+        '''Update the first document matching, in sort order, atomically.'''
+        with self.condition:
+            cursor = MemoryCursor (self._find (query), None)
+            if (sort):
+                cursor.sort (sort)
+            if (not cursor.documents):
+                return None
+            old = cursor.documents[0]
+            document = copy.deepcopy (old)
+            applyUpdate (document, update)
+            self._replace (old, document, "update")
+            return project (document if return_document else old, projection)
+
+    def bulk_write (self, operations, ordered=True):
+        '''
+        Apply pymongo InsertOne, ReplaceOne, UpdateOne, DeleteOne and
+        DeleteMany operations.  Ordered writes stop at the first error, others
+        go on; either way errors are raised as a BulkWriteError at the end.
+        '''
+        result = {"nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0,
+                  "nRemoved": 0, "upserted": [], "writeErrors": [],
+                  "writeConcernErrors": []}
+        with self.condition:
+            for number, operation in enumerate (operations):
+                try:
+                    if (isinstance (operation, pymongo.InsertOne)):
+                        self._insert (operation._doc)
+                        result["nInserted"] += 1
+                        continue
+                    if (isinstance (operation, pymongo.ReplaceOne)):
+                        matched, upserted = self._replaceOne (
+                            operation._filter, operation._doc, operation._upsert)
+                    elif (isinstance (operation, pymongo.UpdateOne)):
+                        matched, upserted = self._updateOne (
+                            operation._filter, operation._doc, operation._upsert)
+                    elif (isinstance (operation, pymongo.DeleteOne)):
+                        result["nRemoved"] += self._delete (operation._filter, False)
+                        continue
+                    elif (isinstance (operation, pymongo.DeleteMany)):
+                        result["nRemoved"] += self._delete (operation._filter, True)
+                        continue
+                    else:
+                        raise pymongo.errors.OperationFailure (
+                            "unsupported operation: {}".format (type (operation).__name__))
+                    result["nMatched"] += matched
+                    result["nModified"] += matched
+                    if (upserted is not None):
+                        result["nUpserted"] += 1
+                        result["upserted"].append ({"index": number, "_id": upserted})
+                except pymongo.errors.PyMongoError as ex:
+                    result["writeErrors"].append ({"index": number, "errmsg": str (ex),
+                                                   "op": operation})
+                    if (ordered):
+                        break
+        if (result["writeErrors"]):
+            raise pymongo.errors.BulkWriteError (result)
+        return pymongo.results.BulkWriteResult (result, True)
+
+    def watch (self, pipeline=None, full_document=None, resume_after=None, **options):
+        '''
+        Return a change stream of this collection.  Changes always carry the
+        whole document, as with full_document="updateLookup".
+        '''
+        return MemoryChangeStream (self, resume_after)
+
+    def drop (self):
+        with self.condition:
+            self.documents = {}
+            for field in list (self.indexes):
+                self.indexes[field] = {}
+            self._record ("drop", None)
+
+class MemoryDatabase (object):
+    '''
+    A database of MemoryCollection, saved under directory, if given, by save.
+    '''
+    # Only usable by the process holding it
+    local = True
+
+    def __init__ (self, name='winter', directory=None):
+        self.name = name
+        self.directory = directory
+        self.collections = {}           # name -> MemoryCollection
+        self._lock = threading.Lock ()
+        if (directory is not None):
+            self.load ()
+
+    @property
+    def database (self):
+        return self
+
+    def collection (self, name):
+        '''Return a collection, created empty on first use.'''
+        with self._lock:
+            collection = self.collections.get (name)
+            if (collection is None):
+                collection = self.collections[name] = MemoryCollection (name)
+            return collection
+
+    def list_collection_names (self):
+        return sorted (self.collections)
+
+    def ping (self):
+        return True
+
+    def load (self):
+        '''Read back collections saved in the directory.'''
+        if (not os.path.isdir (self.directory)):
+            return
+        for filename in sorted (os.listdir (self.directory)):
+            if (filename.endswith (".bson")):
+                with open (os.path.join (self.directory, filename), 'rb') as datafile:
+                    collection = self.collection (filename[:-len (".bson")])
+                    for document in bson.decode_all (datafile.read ()):
+                        collection.documents[indexKey (document["_id"])] = document
+
+    def save (self):
+        '''Write every collection to the directory, each replaced atomically.'''
+        if (self.directory is None):
+            return
+        os.makedirs (self.directory, exist_ok=True)
+        for name, collection in list (self.collections.items ()):
+            with collection.condition:
+                data = b''.join (bson.encode (document)
+                                 for document in collection.documents.values ())
+            descriptor, path = tempfile.mkstemp (dir=self.directory)
+            with os.fdopen (descriptor, 'wb') as datafile:
+                datafile.write (data)
+            os.replace (path, os.path.join (self.directory, name + ".bson"))
+
+    def close (self):
+        '''Save, if there is a directory; the data stays in memory.'''
+        self.save ()
+
+# Running modules as top-level scripts is an antipattern, use bin/snow instead
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,222 @@
+# This file is part of Winter, a wiki-based computing platform.
+# Copyright (C) 2026  Max Polk <maxpolk@gmail.com>
+# License located at http://www.gnu.org/licenses/agpl-3.0.html
+'''
+Counters, gauges, and histograms of what each process is doing, exposed in the
+Prometheus text format.
+
+Metrics are made once, when a module is imported, and registered in the
+registry of the process:
+    requests = metrics.registry.counter ("web_requests_total", "Requests answered")
+    requests.inc ()
+Updating one is a single addition to a value allocated in advance, without a
+lock, so the only cost on the hot path is the addition.  Each metric is
+updated from one thread (the IOLoop, or the thread stepping the calc server),
+or under a lock already held.
+
+Each child process of initiate.Supervisor sends a snapshot of its registry
+now and then, and the supervisor serves all of them on one endpoint, each
+series labeled by child.
+'''
+
+# Requires version 3, say it now rather than fail mysteriously later.
+# Won't work if you use Python 3 exclusive syntax anywhere in the file.
+import sys
+if (sys.version_info.major < 3):
+    exit ("Requires python 3")
+
+# Library imports
+import bisect
+import http.server
+import threading
+import tornado.web
+
+# Import the current package to get package vars like winter.software_name
+import winter
+
+# Module short description
+module_description = "metrics module"
+
+# Upper bounds of histogram buckets, in seconds, unless given otherwise
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+
+class Counter (object):
+    '''A count that only goes up.'''
+    kind = "counter"
+
+    def __init__ (self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc (self, amount=1):
+        self.value += amount
+
+    def snapshot (self):
+        return self.value
+
+class Gauge (object):
+    '''
+    A value that goes up and down, or, with function, whatever function
+    returns when collected.
+    '''
+    kind = "gauge"
+
+    def __init__ (self, name, description, function=None):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.value = 0
+
+    def set (self, value):
+        self.value = value
+
+    def inc (self, amount=1):
+        self.value += amount
+
+    def dec (self, amount=1):
+        self.value -= amount
+
+    def snapshot (self):
+        return self.function () if self.function is not None else self.value
+
+class Histogram (object):
+    '''
+    Counts of observed values falling under each of the upper bounds of its
+    buckets, kept as an array, with their sum.
+    '''
+    kind = "histogram"
+
+    def __init__ (self, name, description, buckets=default_buckets):
+        self.name = name
+        self.description = description
+        self.bounds = tuple (sorted (buckets))
+        self.counts = [0] * (len (self.bounds) + 1)     # last for +Inf
+        self.sum = 0
+
+    def observe (self, value):
+        self.counts[bisect.bisect_left (self.bounds, value)] += 1
+        self.sum += value
+
+    def snapshot (self):
+        return {"bounds": self.bounds, "counts": list (self.counts), "sum": self.sum}
+
+class Registry (object):
+    '''The metrics of a process, by name.'''
+    def __init__ (self):
+        self.metrics = {}               # name -> metric
+
+    def register (self, metric):
+        '''Register a metric, or return the one registered by that name.'''
+        return self.metrics.setdefault (metric.name, metric)
+
+    def counter (self, name, description):
+        return self.register (Counter (name, description))
+
+    def gauge (self, name, description, function=None):
+        return self.register (Gauge (name, description, function))
+
+    def histogram (self, name, description, buckets=default_buckets):
+        return self.register (Histogram (name, description, buckets))
+
+    def snapshot (self):
+        '''
+        Return the current values of all metrics, which can be pickled:
+            { name: { "kind": kind, "description": text, "value": value } }
+        where the value of a histogram is a dict of bounds, counts, and sum.
+        '''
+        return {name: {"kind": metric.kind, "description": metric.description,
+                       "value": metric.snapshot ()}
+                for name, metric in list (self.metrics.items ())}
+
+# Metrics of this process
+registry = Registry ()
+
+def formatLabels (labels, extra=None):
+    pairs = list (labels.items ()) + ([extra] if extra else [])
+    if (not pairs):
+        return ""
+    return "{" + ",".join ('{}="{}"'.format (
+        key, str (value).replace ("\\", "\\\\").replace ('"', '\\"'))
+        for key, value in pairs) + "}"
+
+def exposition (snapshots):
+    '''
+    Return the Prometheus text format of snapshots, a list of (labels,
+    snapshot) where labels is a dict added to every series of the snapshot.
+    '''
+    families = {}                       # name -> (kind, description, [(labels, value)])
+    for labels, snapshot in snapshots:
+        for name, metric in snapshot.items ():
+            family = families.setdefault (name, (metric["kind"], metric["description"], []))
+            family[2].append ((labels, metric["value"]))
+    lines = []
+    for name, (kind, description, series) in sorted (families.items ()):
+        lines.append ("# HELP {} {}".format (name, description))
+        lines.append ("# TYPE {} {}".format (name, kind))
+        for labels, value in series:
+            if (kind != "histogram"):
+                lines.append ("{}{} {}".format (name, formatLabels (labels), value))
+                continue
+            cumulative = 0
+            for bound, count in zip (list (value["bounds"]) + ["+Inf"], value["counts"]):
+                cumulative += count
+                lines.append ("{}_bucket{} {}".format (
+                    name, formatLabels (labels, ("le", bound)), cumulative))
+            lines.append ("{}_sum{} {}".format (name, formatLabels (labels), value["sum"]))
+            lines.append ("{}_count{} {}".format (name, formatLabels (labels), cumulative))
+    return "\n".join (lines) + "\n"
+
+# Content type of the Prometheus text format
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+class MetricsHandler (tornado.web.RequestHandler):
+    '''Serves the metrics of this process, for servers with an IOLoop.'''
+    def get (self):
+        self.set_header ("Content-Type", content_type)
+        self.set_header ("Cache-Control", "no-cache")
+        self.write (exposition ([({}, registry.snapshot ())]))
+
+class MetricsServer (object):
+    '''
+    A small HTTP server in its own thread answering GET /metrics with the
+    exposition of what collect returns, a list as exposition takes.  For
+    processes without an IOLoop of their own to serve it.
+    '''
+    def __init__ (self, collect, address="127.0.0.1", port=8082):
+        self.collect = collect
+        self.address = address
+        self.port = port
+        self.server = None
+
+    def start (self):
+        collect = self.collect
+
+        class Handler (http.server.BaseHTTPRequestHandler):
+            def do_GET (self):
+                if (self.path.split ("?")[0] != "/metrics"):
+                    self.send_error (404)
+                    return
+                body = exposition (collect ()).encode ('utf-8')
+                self.send_response (200)
+                self.send_header ("Content-Type", content_type)
+                self.send_header ("Content-Length", str (len (body)))
+                self.end_headers ()
+                self.wfile.write (body)
+
+            def log_message (self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer ((self.address, self.port), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread (target=self.server.serve_forever, daemon=True).start ()
+
+    def stop (self):
+        if (self.server is not None):
+            self.server.shutdown ()
+            self.server.server_close ()
+
+# Running modules as top-level scripts is an antipattern, use bin/snow instead
+if __name__ == '__main__':
+    pass
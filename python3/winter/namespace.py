@@ -0,0 +1,165 @@
+# This file is part of Winter, a wiki-based computing platform.
+# Copyright (C) 2026  Max Polk <maxpolk@gmail.com>
+# License located at http://www.gnu.org/licenses/agpl-3.0.html
+'''
+Namespace of resources, their names being paths like "recipes/soup/leek".
+
+The names of all published resources are kept in memory as a trie of path
+segments, so finding a name costs one step per segment, and listing the
+children of a name only visits those children, however many resources there
+are elsewhere.  The trie follows the journal of names of a store.FileStore,
+reading only what was appended since it last looked.
+'''
+
+# Requires version 3, say it now rather than fail mysteriously later.
+# Won't work if you use Python 3 exclusive syntax anywhere in the file.
+import sys
+if (sys.version_info.major < 3):
+    exit ("Requires python 3")
+
+# Library imports
+import json
+import os
+
+# Import the current package to get package vars like winter.software_name
+import winter
+
+# Module short description
+module_description = "resource namespace module"
+
+def segments (name):
+    '''Return the path segments of a name, ignoring extra slashes.'''
+    return tuple (segment for segment in name.split ("/") if segment)
+
+class Node (object):
+    '''A segment of the trie, which may be a resource and have children.'''
+    __slots__ = ("children", "present", "ordered")
+
+    def __init__ (self):
+        self.children = {}              # segment -> Node
+        self.present = False            # a resource has this name
+        self.ordered = None             # sorted segments of children, until they change
+
+    def sorted (self):
+        '''Return the segments of the children, sorted once per change to them.'''
+        if (self.ordered is None):
+            self.ordered = sorted (self.children)
+        return self.ordered
+
+class Namespace (object):
+    '''
+    Trie of resource names, following the journal of names of a filestore
+    when there is one, see refresh.
+    '''
+    def __init__ (self, filestore=None):
+        self.filestore = filestore
+        self.root = Node ()
+        self.count = 0
+        self.journal = None             # (device, inode) of the journal read
+        self.offset = 0                 # bytes of the journal read
+
+    def __len__ (self):
+        return self.count
+
+    def __contains__ (self, name):
+        node = self.resolve (name)
+        return node is not None and node.present
+
+    def resolve (self, name):
+        '''Return the node of a name, or None when nothing has that name or below.'''
+        node = self.root
+        for segment in segments (name):
+            node = node.children.get (segment)
+            if (node is None):
+                return None
+        return node
+
+    def add (self, name):
+        node = self.root
+        for segment in segments (name):
+            child = node.children.get (segment)
+            if (child is None):
+                child = node.children[segment] = Node ()
+                node.ordered = None
+            node = child
+        if (not node.present):
+            node.present = True
+            self.count += 1
+
+    def remove (self, name):
+        '''Remove a name, and the segments left leading nowhere.'''
+        names = segments (name)
+        path = [self.root]
+        for segment in names:
+            node = path[-1].children.get (segment)
+            if (node is None):
+                return
+            path.append (node)
+        if (not path[-1].present):
+            return
+        path[-1].present = False
+        self.count -= 1
+        for depth in range (len (names), 0, -1):
+            if (path[depth].present or path[depth].children):
+                break
+            del path[depth - 1].children[names[depth - 1]]
+            path[depth - 1].ordered = None
+
+    def children (self, name=""):
+        '''
+        Return the children of a name, sorted, as a list of (segment, is a
+        resource, has children), or None when nothing is below or at name.
+        '''
+        node = self.resolve (name)
+        if (node is None):
+            return None
+        return [(segment, node.children[segment].present, bool (node.children[segment].children))
+                for segment in node.sorted ()]
+
+    def names (self, prefix=""):
+        '''Yield every name at or below prefix, sorted.'''
+        node = self.resolve (prefix)
+        if (node is None):
+            return
+        pending = [("/".join (segments (prefix)), node)]
+        while (pending):
+            name, node = pending.pop ()
+            if (node.present):
+                yield name
+            pending.extend ((name + "/" + segment if name else segment, node.children[segment])
+                            for segment in reversed (node.sorted ()))
+
+    def refresh (self):
+        '''
+        Apply what was appended to the journal of names of the filestore
+        since last time, starting over when the journal was compacted.  Costs
+        one stat when nothing changed.
+        '''
+        path = self.filestore.namesPath ()
+        try:
+            stat = os.stat (path)
+        except FileNotFoundError:
+            return
+        identity = (stat.st_dev, stat.st_ino)
+        if (identity != self.journal or stat.st_size < self.offset):
+            self.root = Node ()
+            self.count = 0
+            self.journal = identity
+            self.offset = 0
+        if (stat.st_size == self.offset):
+            return
+        with open (path, 'rb') as journal:
+            journal.seek (self.offset)
+            data = journal.read ()
+        # Leave a line still being written for next time
+        data = data[:data.rfind (b"\n") + 1]
+        self.offset += len (data)
+        for line in data.decode ('utf-8').splitlines ():
+            if (line[:1] == "+"):
+                self.add (json.loads (line[1:]))
+            elif (line[:1] == "-"):
+                self.remove (json.loads (line[1:]))
+
+# Running modules as top-level scripts is an antipattern, use bin/snow instead
+if __name__ == '__main__':
+    pass
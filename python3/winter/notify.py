@@ -3,6 +3,21 @@
 # License located at http://www.gnu.org/licenses/agpl-3.0.html
 '''
 WebSocket server for notifications about calculated resources.
+
+The calc server keeps one document per resource in the status collection:
+    { "_id": name, "generation": n, "status": "computing" or "ready", "eta": t,
+      "digest": hex }
+where eta is the expected time of arrival of a resource being computed, in
+seconds since the epoch, and digest that of its last value.  A resource whose calculation failed has status
+"error" and the description of what went wrong as error.  The notify server follows changes to it with a
+MongoDB change stream, which needs the database to run as a replica set.
+
+A browser opens a WebSocket and sends JSON messages to follow resources:
+    { "subscribe": [names] }
+    { "unsubscribe": [names] }
+and receives a JSON message for each change to a resource it follows:
+    { "resource": name, "generation": n, "status": status, "eta": t }
+with error too when status is "error".
 '''
 
 # Requires version 3, say it now rather than fail mysteriously later.
@@ -12,19 +27,305 @@ if (sys.version_info.major < 3):
     exit ("Requires python 3")
 
 # Library imports
+import json
+import threading
+import time
 import pymongo
+import tornado.gen
+import tornado.httpserver
+import tornado.ioloop
+import tornado.web
+import tornado.websocket
 
 # Import the current package to get package vars like winter.software_name
 import winter
+from winter import database, metrics
 
 # Module short description
 module_description = "notify server module"
 
+# Collection holding the calculation status of each resource
+status_collection = "status"
+
+# Metrics of the notify server, see metrics
+connections = metrics.registry.gauge (
+    "notify_connections", "Open WebSocket connections")
+messages_total = metrics.registry.counter (
+    "notify_messages_total", "Messages sent to browsers")
+send_lag_seconds = metrics.registry.histogram (
+    "notify_send_lag_seconds", "Seconds from sending a message until it was written out")
+slow_closed_total = metrics.registry.counter (
+    "notify_slow_closed_total", "Connections closed for being too slow")
+
+def statusMessage (document):
+    '''Return the message sent to browsers for a status document.'''
+    message = {
+        "resource": document["_id"],
+        "generation": document.get ("generation"),
+        "status": document.get ("status"),
+        "eta": document.get ("eta")
+    }
+    if (document.get ("error") is not None):
+        message["error"] = document["error"]
+    return message
+
+class StatusWriter (object):
+    '''
+    Listener of a calc.CalcServer writing the status documents it reports to
+    the status collection, with one bulk write per report, for the notify
+    servers to pass on.
+    '''
+    def __init__ (self, db):
+        self.db = db
+
+    def __call__ (self, statuses):
+        if (not statuses):
+            return
+        self.db.collection (status_collection).bulk_write ([
+            pymongo.ReplaceOne ({"_id": status["_id"]}, status, upsert=True)
+            for status in statuses], ordered=False)
+
+class NotifyHandler (tornado.websocket.WebSocketHandler):
+    '''
+    One browser connection, following the resources it subscribed to.
+
+    Messages are sent right away while the bytes the browser hasn't taken yet
+    stay under the max_buffer of the server.  Past that the connection is
+    slow, and only the latest message per resource waits for it, so the
+    memory it holds is bounded by the number of resources it follows.  A
+    connection slow for max_lag seconds is closed, and its browser can
+    reconnect to start over from the latest state.
+    '''
+    def initialize (self, server):
+        self.server = server
+        self.resources = set ()
+        self.pending = {}               # name -> latest message not yet sent
+        self.outstanding = 0            # bytes sent but not yet written out
+        self.lagging_since = None       # time it became slow, if slow
+
+    def check_origin (self, origin):
+        # Pages come from the web servers, on other hosts or ports
+        return True
+
+    def open (self):
+        connections.inc ()
+
+    def on_message (self, message):
+        try:
+            request = json.loads (message)
+            subscribe = request.get ("subscribe", [])
+            unsubscribe = request.get ("unsubscribe", [])
+        except (ValueError, AttributeError):
+            self.close (1003, "expected a JSON object")
+            return
+        self.server.subscribe (self, subscribe)
+        self.server.unsubscribe (self, unsubscribe)
+
+    def on_close (self):
+        connections.dec ()
+        self.server.unsubscribe (self, list (self.resources))
+        self.pending = {}
+
+    def queue (self, message):
+        '''Queue a message, keeping only the latest generation per resource.'''
+        name = message["resource"]
+        old = self.pending.get (name)
+        if (old is None or (message["generation"] or 0) >= (old["generation"] or 0)):
+            self.pending[name] = message
+
+    def drain (self):
+        '''Send queued messages, unless the connection is too slow for now.'''
+        if (not self.pending):
+            return
+        if (self.outstanding > self.server.max_buffer):
+            if (self.lagging_since is None):
+                self.lagging_since = time.monotonic ()
+                tornado.ioloop.IOLoop.current ().call_later (
+                    self.server.max_lag, self.checkLag)
+            return
+        self.lagging_since = None
+        pending = self.pending
+        self.pending = {}
+        for message in pending.values ():
+            self.send (message)
+
+    def checkLag (self):
+        '''Close the connection if it stayed slow for max_lag seconds.'''
+        if (self.lagging_since is not None and
+            time.monotonic () - self.lagging_since >= self.server.max_lag):
+            self.pending = {}
+            slow_closed_total.inc ()
+            self.close (1013, "too slow, reconnect")
+
+    def send (self, message):
+        '''Send a message, ignoring a connection closed meanwhile.'''
+        data = json.dumps (message)
+        try:
+            future = self.write_message (data)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        self.outstanding += len (data)
+        messages_total.inc ()
+        start = time.monotonic ()
+        future.add_done_callback (lambda future: self.sent (future, len (data), start))
+
+    def sent (self, future, size, start):
+        '''Account for a message written out, then send what was held back.'''
+        future.exception ()             # closed connections are fine
+        send_lag_seconds.observe (time.monotonic () - start)
+        self.outstanding -= size
+        if (self.outstanding <= self.server.max_buffer):
+            self.drain ()
+
 class NotifyServer (object):
     '''
     The notification server of Winter.
+
+    Keeps an index from each resource to the connections following it, so a
+    change costs only as much as the number of its followers.  Changes arriving
+    within window seconds of each other are coalesced, so only the latest
+    change of a resource is sent.  Slow connections are held back past
+    max_buffer bytes and closed after max_lag seconds, see NotifyHandler.
     '''
-    pass
+    def __init__ (self, db=None, address="127.0.0.1", port=8081, window=0.05,
+                  max_buffer=1024 * 1024, max_lag=30):
+        '''The db is a database.Database to watch, or None to only publish.'''
+        self.db = db
+        self.address = address
+        self.port = port
+        self.window = window
+        self.max_buffer = max_buffer
+        self.max_lag = max_lag
+        self.subscribers = {}           # name -> set of NotifyHandler
+        self.pending = {}               # name -> latest message not yet sent
+        self.flushing = False
+        self.loop = None
+        self.server = None
+        self.stream = None
+        self.stopped = threading.Event ()
+
+    def application (self):
+        '''Return the tornado application of the notify server.'''
+        return tornado.web.Application ([
+            (r"/", NotifyHandler, dict (server=self)),
+            (r"/metrics", metrics.MetricsHandler)
+        ])
+
+    def subscribe (self, handler, names):
+        for name in names:
+            self.subscribers.setdefault (name, set ()).add (handler)
+            handler.resources.add (name)
+
+    def unsubscribe (self, handler, names):
+        for name in names:
+            handlers = self.subscribers.get (name)
+            if (handlers is not None):
+                handlers.discard (handler)
+                if (not handlers):
+                    del self.subscribers[name]
+            handler.resources.discard (name)
+
+    def publish (self, message):
+        '''
+        Queue a message about a resource for its subscribers, replacing any
+        message about it still waiting.  Call from the IOLoop thread.
+        '''
+        name = message["resource"]
+        if (name not in self.subscribers):
+            return
+        self.pending[name] = message
+        if (not self.flushing):
+            self.flushing = True
+            tornado.ioloop.IOLoop.current ().call_later (self.window, self.flush)
+
+    def flush (self):
+        '''Send all waiting messages to the subscribers of their resource.'''
+        pending = self.pending
+        self.pending = {}
+        self.flushing = False
+        handlers = set ()
+        for name, message in pending.items ():
+            for handler in self.subscribers.get (name, ()):
+                handler.queue (message)
+                handlers.add (handler)
+        for handler in handlers:
+            handler.drain ()
+
+    def watch (self):
+        '''
+        Follow the status collection, publishing each change on the IOLoop.
+        Runs in its own thread until stop, resuming after errors where the
+        change stream left off.  When the changes since then are gone, it
+        starts over from now, publishing the current status of every resource
+        followed.
+        '''
+        collection = self.db.collection (status_collection)
+        resume_token = None
+        delay = 1
+        catch_up = False
+        while (not self.stopped.is_set ()):
+            try:
+                with collection.watch (full_document="updateLookup",
+                                       resume_after=resume_token) as stream:
+                    self.stream = stream
+                    if (catch_up):
+                        for document in collection.find ({"_id": {"$in": list (self.subscribers)}}):
+                            self.loop.add_callback (self.publish, statusMessage (document))
+                        catch_up = False
+                    delay = 1
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        document = change.get ("fullDocument")
+                        if (document is not None):
+                            self.loop.add_callback (
+                                self.publish, statusMessage (document))
+            except pymongo.errors.PyMongoError as ex:
+                if (self.stopped.is_set ()):
+                    break
+                if (database.historyLost (ex)):
+                    print ("Notify change stream lost its history, starting over: {}".format (str (ex)))
+                    resume_token = None
+                    catch_up = True
+                else:
+                    print ("Notify change stream problem, retrying: {}".format (str (ex)))
+                    self.stopped.wait (delay)
+                    delay = min (delay * 2, 60)
+
+    def listen (self):
+        '''Start accepting connections and following changes.'''
+        self.loop = tornado.ioloop.IOLoop.current ()
+        self.server = tornado.httpserver.HTTPServer (self.application ())
+        self.server.listen (self.port, self.address)
+        if (self.db is not None):
+            threading.Thread (target=self.watch, daemon=True).start ()
+
+    def run (self):
+        '''Serve until the IOLoop is stopped.'''
+        self.listen ()
+        tornado.ioloop.IOLoop.current ().start ()
+
+    def stop (self):
+        '''Stop following changes and accepting connections.'''
+        self.stopped.set ()
+        if (self.stream is not None):
+            self.stream.close ()
+        if (self.server is not None):
+            self.server.stop ()
+
+    async def drain (self, timeout=30):
+        '''
+        Stop, then close every connection as going away, so browsers reconnect
+        to another notify server, waiting up to timeout seconds for them.
+        '''
+        self.stop ()
+        handlers = set ()
+        for subscribed in self.subscribers.values ():
+            handlers.update (subscribed)
+        for handler in handlers:
+            handler.close (1001, "going away")
+        deadline = time.monotonic () + timeout
+        while (self.subscribers and time.monotonic () < deadline):
+            await tornado.gen.sleep (0.1)
 
 # Running modules as top-level scripts is an antipattern, use bin/snow instead
 if __name__ == '__main__':
@@ -0,0 +1,207 @@
+# This file is part of Winter, a wiki-based computing platform.
+# Copyright (C) 2026  Max Polk <maxpolk@gmail.com>
+# License located at http://www.gnu.org/licenses/agpl-3.0.html
+'''
+Refresh of data resources referring to external information.
+
+A data resource refers to external information with either of:
+    "url": "https://example.com/news.rss"
+    "command": ["uname", "-a"]
+and is fetched again every "refresh" seconds, its time attribute.  Fetched
+content becomes the source of the resource, but a cascade only happens when
+the content actually changed: web servers are asked with If-None-Match and
+If-Modified-Since, and anything fetched is compared to the last by digest.
+
+The calc daemon runs a RefreshScheduler on an event loop of its own thread,
+see calc.CalcDaemon, following the resources it steps.
+'''
+
+# Requires version 3, say it now rather than fail mysteriously later.
+# Won't work if you use Python 3 exclusive syntax anywhere in the file.
+import sys
+if (sys.version_info.major < 3):
+    exit ("Requires python 3")
+
+# Library imports
+import asyncio
+import hashlib
+import heapq
+import random
+import time
+import tornado.httpclient
+
+# Import the current package to get package vars like winter.software_name
+import winter
+
+# Module short description
+module_description = "external data refresh module"
+
+def isFeed (resource):
+    '''True if a resource refers to external information.'''
+    return 'url' in resource or 'command' in resource
+
+def definition (resource):
+    '''Return a resource without its source, what fetching it doesn't change.'''
+    return {key: value for key, value in resource.items () if key != 'source'}
+
+class Feed (object):
+    '''
+    A data resource referring to external information, and what is known of
+    the last fetch of it.
+    '''
+    def __init__ (self, resource):
+        self.resource = resource
+        self.name = resource['name']
+        self.period = resource.get ('refresh', 3600)
+        self.due = None                 # monotonic time of next fetch
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+
+class RefreshScheduler (object):
+    '''
+    Fetches data resources when due, and submits changed ones to the calc
+    server, setting the changed event, if any, for whoever steps it.
+
+    Feeds wait in a heap ordered by due time.  Each fetch is scheduled period
+    seconds after the last, give or take jitter (a fraction of the period), so
+    feeds with the same period drift apart rather than being fetched together.
+    Web fetches share one pooled HTTP client of at most max_clients
+    connections, and commands run at most max_clients at once.
+    '''
+    def __init__ (self, calcserver, changed=None, max_clients=20, jitter=0.1, timeout=30):
+        self.calcserver = calcserver
+        self.changed = changed
+        self.jitter = jitter
+        self.timeout = timeout
+        self.feeds = {}                 # name -> Feed
+        self.heap = []                  # (due, name), stale entries skipped
+        self.client = tornado.httpclient.AsyncHTTPClient (max_clients=max_clients)
+        self.commands = asyncio.Semaphore (max_clients)
+        self.wakeup = asyncio.Event ()
+        self.stopped = False
+        self.fetching = set ()
+
+    def add (self, resource):
+        '''
+        Follow a data resource, or pick up a change of it.  The first fetch is
+        at a random time within its period, to spread out startup.  A change
+        of nothing but its source, like those submitted by refresh, keeps it
+        on schedule.
+        '''
+        feed = Feed (resource)
+        old = self.feeds.get (feed.name)
+        if (old is not None and definition (old.resource) == definition (resource)):
+            old.resource = resource
+            return
+        if (old is not None):
+            feed.etag, feed.last_modified, feed.digest = old.etag, old.last_modified, old.digest
+        self.feeds[feed.name] = feed
+        self.schedule (feed, random.uniform (0, feed.period))
+
+    def remove (self, name):
+        '''Stop following a resource.'''
+        self.feeds.pop (name, None)
+
+    def schedule (self, feed, delay):
+        feed.due = time.monotonic () + delay
+        heapq.heappush (self.heap, (feed.due, feed.name))
+        if (self.heap[0][1] == feed.name):
+            self.wakeup.set ()
+
+    async def run (self):
+        '''Fetch feeds as they come due, until stop.'''
+        while (not self.stopped):
+            now = time.monotonic ()
+            while (self.heap and self.heap[0][0] <= now):
+                due, name = heapq.heappop (self.heap)
+                feed = self.feeds.get (name)
+                if (feed is None or feed.due != due):
+                    # Removed or rescheduled since
+                    continue
+                task = asyncio.ensure_future (self.refresh (feed))
+                self.fetching.add (task)
+                task.add_done_callback (self.fetching.discard)
+            self.wakeup.clear ()
+            delay = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for (self.wakeup.wait (), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop (self):
+        self.stopped = True
+        self.wakeup.set ()
+
+    async def refresh (self, feed):
+        '''
+        Fetch a feed, then schedule the next fetch.  Returns True if the
+        content changed, in which case it was submitted to the calc server.
+        '''
+        try:
+            content = await self.fetch (feed)
+        except Exception as ex:
+            print ("Unable to refresh {}: {}".format (feed.name, str (ex)))
+            content = None
+        finally:
+            if (self.feeds.get (feed.name) is feed):
+                period = feed.period
+                self.schedule (feed, period + random.uniform (
+                    -self.jitter * period, self.jitter * period))
+        if (content is None or self.feeds.get (feed.name) is not feed):
+            return False
+        digest = hashlib.sha256 (content).hexdigest ()
+        if (digest == feed.digest):
+            return False
+        feed.digest = digest
+        try:
+            source = content.decode ('utf-8')
+        except UnicodeDecodeError:
+            source = content
+        self.calcserver.submit ([dict (feed.resource, source=source)])
+        if (self.changed is not None):
+            self.changed.set ()
+        return True
+
+    async def fetch (self, feed):
+        '''Return the content of a feed, or None if it didn't change.'''
+        if ('url' in feed.resource):
+            return await self.fetchURL (feed)
+        if ('command' in feed.resource):
+            return await self.fetchCommand (feed)
+        raise Exception ("ERROR: no url or command")
+
+    async def fetchURL (self, feed):
+        headers = {}
+        if (feed.etag):
+            headers["If-None-Match"] = feed.etag
+        if (feed.last_modified):
+            headers["If-Modified-Since"] = feed.last_modified
+        response = await self.client.fetch (
+            feed.resource['url'], headers=headers, raise_error=False,
+            request_timeout=self.timeout)
+        if (response.code == 304):
+            return None
+        if (response.error):
+            raise response.error
+        feed.etag = response.headers.get ("ETag")
+        feed.last_modified = response.headers.get ("Last-Modified")
+        return response.body
+
+    async def fetchCommand (self, feed):
+        async with self.commands:
+            process = await asyncio.create_subprocess_exec (
+                *feed.resource['command'], stdout=asyncio.subprocess.PIPE)
+            try:
+                output, _ = await asyncio.wait_for (process.communicate (), self.timeout)
+            except asyncio.TimeoutError:
+                process.kill ()
+                await process.wait ()
+                raise
+        if (process.returncode != 0):
+            raise Exception ("ERROR: command exited with {}".format (process.returncode))
+        return output
+
+# Running modules as top-level scripts is an antipattern, use bin/snow instead
+if __name__ == '__main__':
+    pass
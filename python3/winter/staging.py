@@ -0,0 +1,135 @@
+# This file is part of Winter, a wiki-based computing platform.
+# Copyright (C) 2026  Max Polk <maxpolk@gmail.com>
+# License located at http://www.gnu.org/licenses/agpl-3.0.html
+'''
+Staging of changes, so a set of resource changes is released all at once.
+
+Each user assembles changes in their own Stage, then releases it: the changes
+are written to the resources collection with one bulk write, and the calc
+server recalculates everything affected in one cascade, so a resource observing
+many of the changed resources is calculated once rather than once per change.
+Before releasing, a stage can be previewed, calculating only what it affects
+over the values as released.
+
+Followers of the resources collection, like calc.CalcDaemon, see a release as
+many changes, so a release marks where its changes begin and end: before its
+bulk write it inserts a mark, a document whose _id is { "release": id }
+rather than a name, and deletes it after.  Changes between the two are taken
+together, see releaseOf.
+'''
+
+# Requires version 3, say it now rather than fail mysteriously later.
+# Won't work if you use Python 3 exclusive syntax anywhere in the file.
+import sys
+if (sys.version_info.major < 3):
+    exit ("Requires python 3")
+
+# Library imports
+import bson
+import pymongo
+
+# Import the current package to get package vars like winter.software_name
+import winter
+
+# Module short description
+module_description = "staging module"
+
+# Collection holding the definitive version of each resource, by name as _id
+resource_collection = "resources"
+
+class Stage (object):
+    '''
+    The changes one user staged for release, the latest change per resource.
+    '''
+    def __init__ (self, user):
+        self.user = user
+        self.changes = {}               # name -> resource, or None to delete
+
+    def __len__ (self):
+        return len (self.changes)
+
+    def put (self, resource):
+        '''Stage a new version of a resource, possibly creating it.'''
+        self.changes[resource['name']] = resource
+
+    def delete (self, name):
+        '''Stage the deletion of a resource.'''
+        self.changes[name] = None
+
+    def discard (self, name):
+        '''Forget the staged change to a resource.'''
+        self.changes.pop (name, None)
+
+    def operations (self):
+        '''Return the bulk write operations that apply the changes.'''
+        operations = []
+        for name, resource in sorted (self.changes.items ()):
+            if (resource is None):
+                operations.append (pymongo.DeleteOne ({"_id": name}))
+            else:
+                document = dict (resource)
+                document["_id"] = name
+                operations.append (pymongo.ReplaceOne ({"_id": name}, document, upsert=True))
+        return operations
+
+def releaseOf (key):
+    '''Return the release id of the _id of a mark, see release, or None.'''
+    if (isinstance (key, dict)):
+        return key.get ("release")
+    return None
+
+def preview (stage, calcserver):
+    '''
+    Return a calc.Overlay of the values the resources would have once the
+    stage is released, calculating only what its changes affect, without
+    writing anything or changing the calc server.
+    '''
+    return calcserver.preview (stage.changes)
+
+def release (stage, collection, calcserver, runner=None):
+    '''
+    Release the changes of a stage: write them to the collection with a single
+    unordered bulk write between the marks of the release, then recalculate
+    with a single cascade of the calc server.  The stage is emptied and the
+    names calculated returned.
+
+    If the write fails the cascade doesn't run and the stage keeps its changes,
+    so it can be released again.  The same goes when the gate of a
+    classify.TestRunner refuses the stage; otherwise the names calculated are
+    submitted to the runner, to be tested without holding up the release.
+    When only some of the bulk write fails, the changes written are
+    recalculated and emptied from the stage, and those that failed stay
+    staged, then the BulkWriteError is raised.
+    '''
+    if (not stage.changes):
+        return []
+    if (runner is not None):
+        runner.gate (stage)
+    names = sorted (stage.changes)
+    mark = {"_id": {"release": bson.ObjectId ()}}
+    collection.insert_one (mark)
+    failure = None
+    try:
+        collection.bulk_write (stage.operations (), ordered=False)
+        failed = set ()
+    except pymongo.errors.BulkWriteError as ex:
+        # Unordered, so every operation without an error was applied
+        failure = ex
+        failed = set (names[error["index"]] for error in ex.details.get ("writeErrors", ()))
+    finally:
+        collection.delete_one ({"_id": mark["_id"]})
+    changes = {name: resource for name, resource in stage.changes.items ()
+               if name not in failed}
+    stage.changes = {name: stage.changes[name] for name in failed}
+    resources = [resource for resource in changes.values () if resource is not None]
+    removed = [name for name, resource in changes.items () if resource is None]
+    calculated = calcserver.change (resources, removed) if changes else []
+    if (runner is not None):
+        runner.submit (calculated, removed)
+    if (failure is not None):
+        raise failure
+    return calculated
+
+# Running modules as top-level scripts is an antipattern, use bin/snow instead
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,284 @@
+# This file is part of Winter, a wiki-based computing platform.
+# Copyright (C) 2026  Max Polk <maxpolk@gmail.com>
+# License located at http://www.gnu.org/licenses/agpl-3.0.html
+'''
+File store of calculated resources, delivered as static content.
+
+Each calculated resource is published as one file per variant, a variant being
+the mime type, language, and encoding of the content.  Text is also stored
+compressed, with gzip, and with brotli and zstd when their modules are
+installed, so web servers pick what a client accepts and never compress on
+the request path.  Files are named by the SHA-256 of
+their content, so identical variants are stored once, and live in directories
+sharded by the first two hex digits so no directory grows too large:
+
+    objects/ab/cdef...                  content of a variant
+    resources/12/3456.../current.json   index of the published generation
+    resources/12/3456.../<gen>.json     indexes of recent generations
+    names.log                           journal of names published and removed
+    tmp/                                files being written
+
+where the resource directory is named by the SHA-256 of the resource name.
+Files are written under tmp and renamed into place, so readers only ever see
+complete files, and publishing a generation is the single rename of its index.
+Everything in the store can be recalculated, so nothing is synced to disk.
+
+The journal of names has a line per resource published for the first time,
+"+" then the name as JSON, and per resource removed, "-" then the name, so
+readers like namespace.Namespace follow it by reading what was appended.
+'''
+
+# Requires version 3, say it now rather than fail mysteriously later.
+# Won't work if you use Python 3 exclusive syntax anywhere in the file.
+import sys
+if (sys.version_info.major < 3):
+    exit ("Requires python 3")
+
+# Library imports
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# Optional compression modules, variants are only made with those installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Import the current package to get package vars like winter.software_name
+import winter
+
+# Module short description
+module_description = "static file store module"
+
+# Compression of encoded variants, by HTTP content coding, at moderate levels
+# since publishing is on the cascade thread: the top levels of brotli and zstd
+# are many times slower for a few percent smaller files
+compressors = {"gzip": lambda content: gzip.compress (content, 6, mtime=0)}
+if (brotli is not None):
+    compressors["br"] = lambda content: brotli.compress (content, quality=5)
+if (zstandard is not None):
+    compressors["zstd"] = lambda content: zstandard.ZstdCompressor (level=6).compress (content)
+
+# Content smaller than this many bytes is not worth compressing
+compress_size = 512
+
+def compressible (mime):
+    '''True if content of a mime type is usually made smaller by compression.'''
+    base = mime.split (";")[0].strip ().lower ()
+    return (base.startswith ("text/") or base.endswith (("+json", "+xml")) or
+            base in ("application/json", "application/javascript", "application/xml",
+                     "image/svg+xml"))
+
+class FileStore (object):
+    '''
+    Content-addressed store of calculated resource variants under a directory,
+    usually the one given by the --directory option.
+
+    Indexes of the last keep generations of a resource are kept, so a reader
+    holding an older index still finds its files; older ones are removed when
+    a new generation is published, and their files by the collect method.
+
+    Variants are compressed with each of encodings, all of the compressors
+    available by default.
+    '''
+    def __init__ (self, directory, keep=2, encodings=None):
+        self.directory = directory
+        self.keep = keep
+        self.encodings = tuple (compressors) if encodings is None else tuple (encodings)
+        self.objects = os.path.join (directory, "objects")
+        self.resources = os.path.join (directory, "resources")
+        self.tmp = os.path.join (directory, "tmp")
+        for path in (self.objects, self.resources, self.tmp):
+            os.makedirs (path, exist_ok=True)
+        if (not os.path.exists (self.namesPath ())):
+            self.compactNames ()
+
+    def objectPath (self, digest):
+        '''Return the path of the file with the given content digest.'''
+        return os.path.join (self.objects, digest[:2], digest[2:])
+
+    def resourcePath (self, name):
+        '''Return the directory holding the indexes of a resource.'''
+        digest = hashlib.sha256 (name.encode ('utf-8')).hexdigest ()
+        return os.path.join (self.resources, digest[:2], digest[2:])
+
+    def indexPath (self, name):
+        '''Return the path of the index of the published generation.'''
+        return os.path.join (self.resourcePath (name), "current.json")
+
+    def namesPath (self):
+        '''Return the path of the journal of names.'''
+        return os.path.join (self.directory, "names.log")
+
+    def journalName (self, change, name):
+        '''Append a change to the journal of names, "+" or "-".'''
+        with open (self.namesPath (), 'ab') as journal:
+            journal.write ((change + json.dumps (name) + "\n").encode ('utf-8'))
+
+    def publish (self, name, generation, variants):
+        '''
+        Publish a generation of a resource, where variants maps each (mime,
+        language) to the content as bytes; use "" as language when there is
+        none.  Compressible content also gets a variant per encoding, when
+        smaller, and the content as given has encoding "".  Returns the index
+        that was published.
+        '''
+        index = {
+            "name": name,
+            "generation": generation,
+            "variants": []
+        }
+        for (mime, language), content in sorted (variants.items ()):
+            encoded = {"": content}
+            if (len (content) >= compress_size and compressible (mime)):
+                for encoding in self.encodings:
+                    compressed = compressors[encoding] (content)
+                    if (len (compressed) < len (content)):
+                        encoded[encoding] = compressed
+            for encoding, data in encoded.items ():
+                index["variants"].append ({
+                    "mime": mime,
+                    "language": language,
+                    "encoding": encoding,
+                    "digest": self.writeObject (data),
+                    "size": len (data)
+                })
+        data = json.dumps (index, sort_keys=True).encode ('utf-8')
+        path = self.resourcePath (name)
+        os.makedirs (path, exist_ok=True)
+        new = not os.path.exists (os.path.join (path, "current.json"))
+        self._write (os.path.join (path, "{}.json".format (generation)), data)
+        self._write (os.path.join (path, "current.json"), data)
+        self._prune (path)
+        if (new):
+            self.journalName ("+", name)
+        return index
+
+    def writeObject (self, content):
+        '''Store content unless already present, and return its digest.'''
+        digest = hashlib.sha256 (content).hexdigest ()
+        path = self.objectPath (digest)
+        if (os.path.exists (path)):
+            # Freshen it so a concurrent collect spares it
+            os.utime (path)
+        else:
+            os.makedirs (os.path.dirname (path), exist_ok=True)
+            self._write (path, content)
+        return digest
+
+    def index (self, name):
+        '''Return the index of the published generation, or None.'''
+        try:
+            with open (self.indexPath (name), 'rb') as indexfile:
+                return json.loads (indexfile.read ().decode ('utf-8'))
+        except FileNotFoundError:
+            return None
+
+    def lookup (self, name, mime, language="", encoding=""):
+        '''
+        Return (path, generation, digest, size) of a published variant, or
+        None when there is no such resource or variant.
+        '''
+        index = self.index (name)
+        if (index is None):
+            return None
+        for variant in index["variants"]:
+            if (variant["mime"] == mime and variant["language"] == language and
+                variant.get ("encoding", "") == encoding):
+                return (self.objectPath (variant["digest"]), index["generation"],
+                        variant["digest"], variant["size"])
+        return None
+
+    def remove (self, name):
+        '''Unpublish a resource; its files go with the next collect.'''
+        if (os.path.exists (self.indexPath (name))):
+            shutil.rmtree (self.resourcePath (name), ignore_errors=True)
+            self.journalName ("-", name)
+
+    def names (self):
+        '''Return the names of all published resources, reading every index.'''
+        names = []
+        for root, dirs, files in os.walk (self.resources):
+            if ("current.json" in files):
+                try:
+                    with open (os.path.join (root, "current.json"), 'rb') as indexfile:
+                        names.append (json.loads (indexfile.read ().decode ('utf-8'))["name"])
+                except (FileNotFoundError, ValueError):
+                    pass
+        return sorted (names)
+
+    def compactNames (self):
+        '''
+        Rewrite the journal of names as just the names published now.  Like
+        collect, to be run by the process publishing, or none is.
+        '''
+        data = "".join ("+" + json.dumps (name) + "\n" for name in self.names ())
+        self._write (self.namesPath (), data.encode ('utf-8'))
+
+    def collect (self, grace=3600):
+        '''
+        Remove files no longer referred to by any kept index, provided they
+        weren't written in the last grace seconds, which protects files of a
+        generation being published right now.  Compacts the journal of names
+        too.  Returns the number removed.
+        '''
+        self.compactNames ()
+        referenced = set ()
+        for root, dirs, files in os.walk (self.resources):
+            for filename in files:
+                try:
+                    with open (os.path.join (root, filename), 'rb') as indexfile:
+                        index = json.loads (indexfile.read ().decode ('utf-8'))
+                except (FileNotFoundError, ValueError):
+                    continue
+                for variant in index["variants"]:
+                    referenced.add (variant["digest"])
+        removed = 0
+        deadline = time.time () - grace
+        for shard in os.listdir (self.objects):
+            for rest in os.listdir (os.path.join (self.objects, shard)):
+                if (shard + rest in referenced):
+                    continue
+                path = os.path.join (self.objects, shard, rest)
+                try:
+                    if (os.stat (path).st_mtime < deadline):
+                        os.unlink (path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def _prune (self, path):
+        '''Remove indexes of generations older than the last keep.'''
+        generations = sorted (int (filename[:-5]) for filename in os.listdir (path)
+                              if filename[:-5].isdigit ())
+        for generation in generations[:-self.keep]:
+            try:
+                os.unlink (os.path.join (path, "{}.json".format (generation)))
+            except FileNotFoundError:
+                pass
+
+    def _write (self, path, data):
+        '''Write data to a temporary file, then rename it to path.'''
+        fd, tmppath = tempfile.mkstemp (dir=self.tmp)
+        try:
+            with os.fdopen (fd, 'wb') as tmpfile:
+                tmpfile.write (data)
+            os.chmod (tmppath, 0o644)
+            os.replace (tmppath, path)
+        except BaseException:
+            os.unlink (tmppath)
+            raise
+
+# Running modules as top-level scripts is an antipattern, use bin/snow instead
+if __name__ == '__main__':
+    pass
@@ -12,9 +12,29 @@ import sys
 if (sys.version_info.major < 3):
     exit ("Requires python 3")
 
+import argparse
+import collections
+import datetime
+import gzip
+import json
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+import time
 import unittest
 
-from winter import initiate, notify, calc, web
+import bson
+import pymongo
+import tornado.concurrent
+import tornado.gen
+import tornado.testing
+import tornado.web
+import tornado.websocket
+
+from winter import initiate, notify, calc, web, store, database, staging, codecache, interp
+from winter import refresh, history, bench, memory, metrics, cluster, classify, namespace
 
 class TestMetadata (unittest.TestCase):
     def test_description (self):
@@ -22,6 +42,1085 @@ class TestMetadata (unittest.TestCase):
         assert len (notify.module_description) > 0, 'nofity: invalid module_description'
         assert len (calc.module_description) > 0, 'calc: invalid module_description'
         assert len (web.module_description) > 0, 'web: invalid module_description'
+        assert len (store.module_description) > 0, 'store: invalid module_description'
+        assert len (database.module_description) > 0, 'database: invalid module_description'
+        assert len (staging.module_description) > 0, 'staging: invalid module_description'
+        assert len (codecache.module_description) > 0, 'codecache: invalid module_description'
+        assert len (interp.module_description) > 0, 'interp: invalid module_description'
+        assert len (refresh.module_description) > 0, 'refresh: invalid module_description'
+        assert len (history.module_description) > 0, 'history: invalid module_description'
+        assert len (bench.module_description) > 0, 'bench: invalid module_description'
+        assert len (memory.module_description) > 0, 'memory: invalid module_description'
+        assert len (metrics.module_description) > 0, 'metrics: invalid module_description'
+        assert len (cluster.module_description) > 0, 'cluster: invalid module_description'
+        assert len (classify.module_description) > 0, 'classify: invalid module_description'
+        assert len (namespace.module_description) > 0, 'namespace: invalid module_description'
+
+def counter (resource, inputs, generation):
+    '''Evaluate a resource as one plus the sum of its references.'''
+    return 1 + sum (value or 0 for value in inputs.values ())
+
+class TestCalc (unittest.TestCase):
+    def test_cascade_only_observers (self):
+        server = calc.CalcServer (counter)
+        server.change ([
+            {'name': 'a', 'references': []},
+            {'name': 'b', 'references': ['a']},
+            {'name': 'c', 'references': ['b']},
+            {'name': 'x', 'references': []}])
+        self.assertEqual (server.values, {'a': 1, 'b': 2, 'c': 3, 'x': 1})
+        self.assertEqual (server.change ([{'name': 'b', 'references': []}]), ['b', 'c'])
+        self.assertEqual (server.values['c'], 2)
+        self.assertEqual (server.generations, {'a': 1, 'b': 2, 'c': 2, 'x': 1})
+
+    def test_error_cuts_off_only_its_observers (self):
+        statuses = []
+        server = calc.CalcServer (listener=statuses.extend)
+        code = lambda name, source, references=(): {
+            'name': name, 'kind': 'code', 'language': 'python', 'source': source,
+            'references': list (references)}
+        server.change ([code ('bad', "result = 1"), code ('good', "result = 2"),
+                        code ('sum', "result = ref ('bad') + ref ('good')", ['bad', 'good'])])
+        calculated = server.change ([code ('bad', "result = 1/0"), code ('good', "result = 3")])
+        self.assertEqual ((sorted (calculated[:2]), calculated[2]), (['bad', 'good'], 'sum'))
+        self.assertEqual (server.values, {'bad': 1, 'good': 3, 'sum': 4})
+        self.assertTrue (server.errors['bad'].startswith ('ZeroDivisionError'))
+        self.assertEqual ({status['_id']: status['status'] for status in statuses},
+                          {'bad': 'error', 'good': 'ready', 'sum': 'ready'})
+        # Nothing else changed, so sum is cut off after the failure
+        self.assertEqual (server.change ([code ('bad', "result = 2/0")]), ['bad'])
+        self.assertEqual (server.change ([code ('bad', "result = 5")]), ['bad', 'sum'])
+        self.assertEqual ((server.values['sum'], server.errors), (8, {}))
+
+    def test_failed_step_keeps_changes (self):
+        server = calc.CalcServer (counter)
+        run = server.executor.run
+        server.executor.run = lambda units: 1/0
+        with self.assertRaises (ZeroDivisionError):
+            server.change ([{'name': 'a', 'references': []}])
+        server.executor.run = run
+        self.assertEqual (server.step (), ['a'])
+
+    def test_failed_level_settles_observers (self):
+        failures = []
+        def listener (statuses):
+            if (failures and {'_id': 'a', 'status': 'ready'}.items () <= statuses[0].items ()):
+                failures.pop ()
+                raise Exception ("ERROR: publishing failed")
+        server = calc.CalcServer (counter, listener=listener)
+        server.change ([{'name': 'c', 'references': []}, {'name': 'a', 'references': []},
+                        {'name': 'b', 'references': ['a']}])
+        # a changes from 1 to 2, then its level fails after storing it
+        failures.append (True)
+        with self.assertRaises (Exception):
+            server.change ([{'name': 'a', 'references': ['c']}])
+        self.assertEqual ((server.values['a'], server.unsettled), (2, {'a'}))
+        self.assertEqual (server.step (), ['a', 'b'])
+        self.assertEqual ((server.values['b'], server.unsettled), (3, set ()))
+
+    def test_cycle_uses_previous_generation (self):
+        server = calc.CalcServer (counter)
+        server.change ([{'name': 'a', 'references': ['a']}])
+        server.change ([{'name': 'a', 'references': ['a']}])
+        self.assertEqual (server.values['a'], 2)
+        server.change ([
+            {'name': 'p', 'references': ['q']},
+            {'name': 'q', 'references': ['p']}])
+        # p goes first with q unset, then q sees p of this generation
+        self.assertEqual ((server.values['p'], server.values['q']), (1, 2))
+
+    def test_components_deep_chain (self):
+        graph = calc.DependencyGraph ()
+        for n in range (1, 5000):
+            graph.setReferences (n, [n - 1])
+        graph.setReferences (0, [])
+        order = graph.components (graph.dirty ([2500]))
+        self.assertEqual ([c[0] for c in order], list (range (2500, 5000)))
+
+    def test_early_cutoff (self):
+        server = calc.CalcServer ()
+        code = {'name': 'trimmed', 'kind': 'code', 'language': 'python',
+                'references': ['text'], 'source': 'result = (ref ("text") or "").strip ()'}
+        upper = {'name': 'upper', 'kind': 'code', 'language': 'python',
+                 'references': ['trimmed'], 'source': 'result = ref ("trimmed").upper ()'}
+        server.change ([{'name': 'text', 'source': 'hi'}, code, upper])
+        self.assertEqual (server.change ([{'name': 'text', 'source': ' hi  '}]),
+                          ['text', 'trimmed'])
+        self.assertEqual (server.generations['upper'], 1)
+        self.assertEqual (server.change ([{'name': 'text', 'source': 'ho'}]),
+                          ['text', 'trimmed', 'upper'])
+        self.assertEqual (server.values['upper'], 'HO')
+        # Removing a reference still reaches its observers
+        self.assertEqual (server.change (removed=['text'])[0], 'trimmed')
+
+    def test_status_and_eta (self):
+        reports = []
+        server = calc.CalcServer (counter, listener=reports.append)
+        server.change ([{'name': 'x'}, {'name': 'a'}, {'name': 'b', 'references': ['a']}])
+        server.durations = {'a': 10, 'b': 20}
+        reports.clear ()
+        server.submit ([{'name': 'a', 'references': ['x']}])
+        start = time.time ()
+        server.step ()
+        # Each level is computing, then ready, in turn
+        self.assertEqual ([[(s['_id'], s['status']) for s in report] for report in reports],
+                          [[('a', 'computing')], [('a', 'ready')],
+                           [('b', 'computing')], [('b', 'ready')]])
+        self.assertTrue (start + 10 <= reports[0][0]['eta'] < start + 11)
+        self.assertTrue (start + 30 <= reports[2][0]['eta'] < start + 31)
+        self.assertLess (server.durations['a'], 10)
+        # b is cut off, a's value being the same, so nothing is said of it
+        reports.clear ()
+        server.change ([{'name': 'a', 'references': ['x']}])
+        self.assertEqual ([[(s['_id'], s['generation']) for s in report] for report in reports],
+                          [[('a', 2)], [('a', 3)]])
+        self.assertEqual (server.step (), [])
+
+    def test_pool_matches_serial (self):
+        resources = [{'name': 'root', 'references': []}]
+        resources += [{'name': n, 'references': ['root']} for n in range (300)]
+        resources += [{'name': 'top', 'references': list (range (300))}]
+        serial = calc.CalcServer (counter)
+        serial.change (resources)
+        pooled = calc.CalcServer (counter, workers=2, batch=50)
+        try:
+            pooled.change (resources)
+        finally:
+            pooled.close ()
+        self.assertEqual (pooled.values, serial.values)
+        self.assertEqual (pooled.values['top'], 601)
+
+class TestCodeCache (unittest.TestCase):
+    def test_kept_by_pool_workers (self):
+        # A pool worker keeps the evaluate it started with for every batch
+        evaluate = calc.Evaluator ()
+        calc.startWorker (evaluate)
+        try:
+            unit = [({'name': 'a', 'kind': 'code', 'language': 'python',
+                      'source': 'result = 1'}, {}, 1)]
+            self.assertEqual (calc.evaluateBatch ([unit])[0][0][0], 1)
+            self.assertEqual (calc.evaluateBatch ([unit])[0][0][0], 1)
+            self.assertEqual ((evaluate.codes.hits, evaluate.codes.misses), (1, 1))
+        finally:
+            calc.worker_evaluate = None
+            evaluate.close ()
+
+
+    def test_compiled_once (self):
+        with tempfile.TemporaryDirectory () as directory:
+            cache = codecache.CodeCache (directory)
+            first = cache.compile ('result = 1', 'a')
+            self.assertIs (cache.compile ('result = 1', 'a'), first)
+            self.assertEqual ((cache.hits, cache.misses), (1, 1))
+            # A new process finds it on disk
+            other = codecache.CodeCache (directory)
+            other.compile ('result = 1', 'a')
+            self.assertEqual ((other.hits, other.misses), (1, 0))
+
+    def test_python_resources (self):
+        server = calc.CalcServer ()
+        server.change ([
+            {'name': 'price', 'source': 3},
+            {'name': 'total', 'kind': 'code', 'language': 'python',
+             'references': ['price', 'total'],
+             'source': 'result = ref ("price") + (ref ("total") or 0) + generation'}])
+        self.assertEqual (server.values['total'], 4)
+        server.change ([{'name': 'price', 'source': 10}])
+        self.assertEqual (server.values['total'], 16)
+
+# Interpreter doubling its input, or sleeping when asked to
+echo_interpreter = '''
+import json, struct, sys, time
+while True:
+    header = sys.stdin.buffer.read (4)
+    if not header:
+        break
+    request = json.loads (sys.stdin.buffer.read (struct.unpack ('>I', header)[0]))
+    if request['resource']['source'] == 'sleep':
+        time.sleep (10)
+    data = json.dumps ({'result': request['inputs']['x'] * 2}).encode ()
+    sys.stdout.buffer.write (struct.pack ('>I', len (data)) + data)
+    sys.stdout.buffer.flush ()
+'''
+
+class TestInterp (unittest.TestCase):
+    def test_pool_reuse_and_timeout (self):
+        pool = interp.InterpreterPool ([sys.executable, '-c', echo_interpreter],
+                                       size=1, max_requests=3, timeout=1)
+        try:
+            resource = {'name': 'r', 'kind': 'code', 'language': 'echo', 'source': ''}
+            pids = set ()
+            for x in range (4):
+                self.assertEqual (pool.evaluate (resource, {'x': x}, 1), x * 2)
+                pids.update (i.process.pid for i in pool.idle)
+            # Replaced once after max_requests
+            self.assertEqual (len (pids), 2)
+            with self.assertRaises (Exception):
+                pool.evaluate (dict (resource, source='sleep'), {'x': 1}, 1)
+            self.assertEqual ((pool.running, pool.idle), (0, []))
+            pool.supervise ()
+            self.assertEqual (len (pool.idle), 1)
+        finally:
+            pool.close ()
+
+    def test_write_timeout (self):
+        # Never reads, so a request larger than the pipe can't be written
+        interpreter = interp.Interpreter ([sys.executable, '-c', 'import time; time.sleep (30)'])
+        start = time.monotonic ()
+        try:
+            with self.assertRaises (Exception):
+                interpreter.call ({'inputs': 'x' * 1000000}, 0.5)
+            self.assertLess (time.monotonic () - start, 5)
+        finally:
+            interpreter.close (kill=True)
+
+class BulkCollection (object):
+    '''Stands in for a collection, recording bulk writes.'''
+    def __init__ (self):
+        self.writes = []
+        self.documents = []
+    def bulk_write (self, operations, ordered=True):
+        self.writes.append (operations)
+    def find (self, query=None):
+        return iter ([dict (document) for document in self.documents])
+    def insert_one (self, document):
+        self.documents.append (document)
+    def delete_one (self, query):
+        self.documents = [document for document in self.documents
+                          if document['_id'] != query['_id']]
+
+class BulkDatabase (object):
+    '''Stands in for a database.Database of BulkCollections.'''
+    def __init__ (self):
+        self.collections = {}
+    def collection (self, name):
+        return self.collections.setdefault (name, BulkCollection ())
+
+class TestStaging (unittest.TestCase):
+    def test_release_one_write_one_cascade (self):
+        evaluated = []
+        def evaluate (resource, inputs, generation):
+            evaluated.append (resource['name'])
+            return counter (resource, inputs, generation)
+        server = calc.CalcServer (evaluate)
+        shared = {'name': 'shared', 'references': ['r{}'.format (n) for n in range (50)]}
+        server.change ([{'name': 'r{}'.format (n), 'references': []} for n in range (50)] + [shared])
+        evaluated.clear ()
+        stage = staging.Stage ('someone')
+        for n in range (50):
+            stage.put ({'name': 'r{}'.format (n), 'references': []})
+        stage.delete ('r0')
+        collection = BulkCollection ()
+        staging.release (stage, collection, server)
+        self.assertEqual (len (collection.writes), 1)
+        self.assertEqual (len (collection.writes[0]), 50)
+        self.assertEqual (evaluated.count ('shared'), 1)
+        self.assertEqual (server.values['shared'], 50)
+        self.assertEqual (len (stage), 0)
+
+    def test_release_keeps_what_failed (self):
+        server = calc.CalcServer (counter)
+        collection = memory.MemoryDatabase ().collection (staging.resource_collection)
+        collection.create_index ('title', unique=True)
+        collection.insert_one ({'_id': 'taken', 'name': 'taken', 'title': 'T'})
+        stage = staging.Stage ('someone')
+        stage.put ({'name': 'a', 'references': [], 'title': 'A'})
+        stage.put ({'name': 'b', 'title': 'T'})
+        with self.assertRaises (pymongo.errors.BulkWriteError):
+            staging.release (stage, collection, server)
+        self.assertEqual ((server.values, list (stage.changes)), ({'a': 1}, ['b']))
+        self.assertEqual (sorted (document['_id'] for document in collection.find ()),
+                          ['a', 'taken'])
+
+    def test_preview_only_affected (self):
+        evaluated = []
+        def evaluate (resource, inputs, generation):
+            evaluated.append (resource['name'])
+            return counter (resource, inputs, generation)
+        server = calc.CalcServer (evaluate)
+        server.change ([{'name': 'a', 'references': []},
+                        {'name': 'b', 'references': ['a']},
+                        {'name': 'c', 'references': ['b']},
+                        {'name': 'x', 'references': []},
+                        {'name': 'y', 'references': ['x']}])
+        evaluated.clear ()
+        stage = staging.Stage ('someone')
+        stage.put ({'name': 'b', 'references': []})
+        stage.delete ('x')
+        overlay = staging.preview (stage, server)
+        self.assertEqual (sorted (evaluated), ['b', 'c', 'y'])
+        self.assertEqual ([overlay.value (name) for name in 'abcxy'], [1, 1, 2, None, 1])
+        self.assertNotIn ('x', overlay)
+        self.assertEqual (overlay.generation ('c'), 2)
+        # Nothing changed underneath, and the rest is read through
+        self.assertEqual ((server.values['c'], server.values['x'], len (stage)), (3, 1, 2))
+        self.assertEqual (set (overlay.values), {'b', 'c', 'y'})
+
+    def test_preview_reads_values_as_it_started (self):
+        meanwhile = []
+        def evaluate (resource, inputs, generation):
+            if (resource['name'] == 'b' and meanwhile):
+                meanwhile.pop () ()
+            return resource.get ('base', 0) + sum (value or 0 for value in inputs.values ())
+        server = calc.CalcServer (evaluate)
+        server.change ([{'name': 'a', 'base': 1},
+                        {'name': 'b', 'references': ['a']},
+                        {'name': 'c', 'references': ['a', 'b']}])
+        # A cascade changes a while the preview is calculating
+        meanwhile.append (lambda: server.change ([{'name': 'a', 'base': 100}]))
+        overlay = server.preview ({'b': {'name': 'b', 'references': ['a'], 'base': 10}})
+        self.assertEqual ((overlay.value ('b'), overlay.value ('c')), (11, 12))
+        self.assertEqual ((overlay.value ('a'), overlay.generation ('a')), (1, 1))
+        self.assertEqual (server.values, {'a': 100, 'b': 100, 'c': 200})
+
+class TestClassify (unittest.TestCase):
+    validator = {'name': 'check', 'kind': 'validator', 'validates': 'markup',
+                 'language': 'python', 'source': "result = ref ('value').startswith ('=')"}
+
+    def setUp (self):
+        self.server = calc.CalcServer ()
+        self.server.change ([self.validator,
+                             {'name': 'page', 'source': '= A =', 'classes': ['markup']},
+                             {'name': 'title', 'kind': 'code', 'language': 'python',
+                              'source': "result = ref ('page') + '!'", 'references': ['page'],
+                              'classes': ['markup']},
+                             {'name': 'other', 'source': 'x'}])
+        self.runner = classify.TestRunner (self.server)
+        self.runner.submit (list (self.server.resources))
+        self.assertEqual (self.runner.step (), {})
+
+    def test_only_affected_tests (self):
+        runs = classify.tests_total.value
+        stage = staging.Stage ('someone')
+        stage.put ({'name': 'other', 'source': 'y'})
+        staging.release (stage, BulkCollection (), self.server, self.runner)
+        self.runner.step ()
+        self.assertEqual (classify.tests_total.value, runs)
+        # The gate tests the new validator, then the cascade finds them passed
+        stage.put (dict (self.validator, source="result = '=' in ref ('value')"))
+        staging.release (stage, BulkCollection (), self.server, self.runner)
+        self.assertEqual (self.runner.step (), {})
+        self.assertEqual (classify.tests_total.value, runs + 2)
+        # Code is only tested once calculated, after its release
+        stage.put (dict (self.server.resources['title'], source="result = 'T'"))
+        staging.release (stage, BulkCollection (), self.server, self.runner)
+        self.assertEqual (self.runner.step (), {('check', 'title'): 'failed'})
+        self.assertEqual (self.runner.failures (), {('check', 'title'): 'failed'})
+
+    def test_passes_remembered_by_name (self):
+        named = {'name': 'named', 'kind': 'validator', 'validates': 'markup',
+                 'language': 'python', 'source': "result = ref ('name') != 'bad'"}
+        runner = classify.TestRunner (self.server, passed_size=2)
+        tests = [(named, 'good', '= A =', 1), (named, 'bad', '= A =', 1)]
+        self.assertEqual (runner.test (tests), {('named', 'bad'): 'failed'})
+        runner.test ([(named, 'other', '= A =', 1)])
+        self.assertEqual (len (runner.passed), 2)
+
+    def test_gate_refuses_failures (self):
+        stage = staging.Stage ('someone')
+        stage.put ({'name': 'page', 'source': 'plain', 'classes': ['markup']})
+        collection = BulkCollection ()
+        with self.assertRaises (Exception):
+            staging.release (stage, collection, self.server, self.runner)
+        self.assertEqual ((len (collection.writes), len (stage)), (0, 1))
+        stage.put ({'name': 'page', 'source': '= B =', 'classes': ['markup']})
+        self.assertEqual (staging.release (stage, collection, self.server, self.runner),
+                          ['page', 'title'])
+
+class TestDaemon (unittest.TestCase):
+    def test_publish_then_status (self):
+        tmpdir = tempfile.TemporaryDirectory ()
+        self.addCleanup (tmpdir.cleanup)
+        filestore = store.FileStore (tmpdir.name)
+        db = BulkDatabase ()
+        db.collection (staging.resource_collection).documents = [
+            {'_id': 'a', 'name': 'a', 'references': []},
+            {'_id': 'b', 'name': 'b', 'references': ['a'], 'mime': 'text/x-count'}]
+        db.collection (notify.status_collection).documents = [
+            {'_id': 'a', 'generation': 4}, {'_id': 'b', 'generation': 2,
+                                            'digest': calc.digestValue (2).hex ()}]
+        revisions = history.History (memory.MemoryDatabase ().collection ('history'))
+        daemon = calc.CalcDaemon (db, filestore, counter, history=revisions)
+        daemon.load ()
+        self.assertEqual (daemon.server.digests, {'b': calc.digestValue (2)})
+        daemon.step ()
+        path, generation, digest, size = filestore.lookup ('a', 'application/json')
+        with open (path, 'rb') as content:
+            self.assertEqual ((content.read (), generation), (b'1', 5))
+        daemon.remember ()
+        self.assertEqual (revisions.get ('a', 5), b'1')
+        self.assertEqual (filestore.lookup ('b', 'text/x-count')[1], 3)
+        writes = db.collection (notify.status_collection).writes
+        self.assertEqual (writes[-1][0]._doc['digest'], calc.digestValue (2).hex ())
+        daemon.server.submit (removed=['b'])
+        daemon.step ()
+        self.assertIsNone (filestore.lookup ('b', 'text/x-count'))
+
+    def test_refreshes_feeds (self):
+        tmpdir = tempfile.TemporaryDirectory ()
+        self.addCleanup (tmpdir.cleanup)
+        db = memory.MemoryDatabase ()
+        db.collection (staging.resource_collection).insert_one (
+            {'_id': 'uname', 'name': 'uname', 'command': ['echo', 'hi'], 'refresh': 0.1})
+        daemon = calc.CalcDaemon (db, store.FileStore (tmpdir.name))
+        daemon.listen ()
+        self.addCleanup (daemon.stop)
+        deadline = time.monotonic () + 10
+        while (daemon.server.values.get ('uname') != 'hi\n' and time.monotonic () < deadline):
+            time.sleep (0.05)
+        self.assertEqual (daemon.server.values.get ('uname'), 'hi\n')
+        self.assertEqual (daemon.feeds, {'uname'})
+
+    def test_one_step_per_release (self):
+        tmpdir = tempfile.TemporaryDirectory ()
+        self.addCleanup (tmpdir.cleanup)
+        daemon = calc.CalcDaemon (BulkDatabase (), store.FileStore (tmpdir.name), counter)
+        mark = {'release': 1}
+        daemon.receive ({'operationType': 'insert', 'documentKey': {'_id': mark}})
+        daemon.receive ({'operationType': 'replace', 'documentKey': {'_id': 'a'},
+                         'fullDocument': {'_id': 'a', 'name': 'a'}})
+        daemon.receive ({'operationType': 'delete', 'documentKey': {'_id': 'gone'}})
+        self.assertFalse (daemon.changed.is_set ())
+        daemon.receive ({'operationType': 'delete', 'documentKey': {'_id': mark}})
+        self.assertTrue (daemon.changed.is_set ())
+        self.assertEqual (daemon.server.take (), {'a': {'name': 'a'}, 'gone': None})
+        # Outside of releases, changes are submitted as they come
+        daemon.receive ({'operationType': 'delete', 'documentKey': {'_id': 'a'}})
+        self.assertEqual (daemon.server.take (), {'a': None})
+
+    def test_release_expires_without_changes (self):
+        tmpdir = tempfile.TemporaryDirectory ()
+        self.addCleanup (tmpdir.cleanup)
+        db = memory.MemoryDatabase ()
+        daemon = calc.CalcDaemon (db, store.FileStore (tmpdir.name), counter,
+                                  release_timeout=0.05)
+        collection = db.collection (staging.resource_collection)
+        mark = {'release': 1}
+        collection.insert_one ({'_id': mark})
+        daemon.receive ({'operationType': 'insert', 'documentKey': {'_id': mark}})
+        daemon.receive ({'operationType': 'replace', 'documentKey': {'_id': 'a'},
+                         'fullDocument': {'_id': 'a', 'name': 'a'}})
+        daemon.changed.clear ()
+        thread = threading.Thread (target=daemon.run, daemon=True)
+        thread.start ()
+        self.addCleanup (daemon.stop)
+        # The releaser died, so run gives up on its release by itself
+        for attempt in range (100):
+            if (daemon.server.values.get ('a') == 1):
+                break
+            time.sleep (0.02)
+        self.assertEqual (daemon.server.values.get ('a'), 1)
+        self.assertEqual (daemon.releases, {})
+        self.assertIsNone (collection.find_one ({'_id': mark}))
+
+class TestBench (unittest.TestCase):
+    def test_small_run (self):
+        resources = bench.syntheticWiki (50, fanout=2, cycles=0.2)
+        self.assertEqual (resources, bench.syntheticWiki (50, fanout=2, cycles=0.2))
+        # Some resource refers to a later one, closing a cycle
+        self.assertTrue (any (int (ref[1:]) > int (resource['name'][1:])
+                              for resource in resources for ref in resource['references']))
+        results = bench.run (nodes=50, requests=50, concurrency=5, sockets=5,
+                             collection=memory.MemoryDatabase ().collection ('benchmark'))
+        json.dumps (results)
+        self.assertEqual (results['release']['releases'], 20)
+        self.assertEqual (results['read']['failures'], 0)
+        self.assertGreater (results['cascade']['calculated_per_second'], 0)
+        self.assertEqual (results['notify']['sockets'], 5)
+        # Nothing measured is reported as no samples
+        results = bench.run (nodes=50, requests=0, sockets=0)
+        self.assertEqual (results['read']['samples'], 0)
+        self.assertIsNone (results['notify']['p99_ms'])
+
+class TestMemory (unittest.TestCase):
+    def test_queries_and_indexes (self):
+        collection = memory.MemoryDatabase ().collection ('history')
+        collection.create_index ([('resource', 1), ('generation', -1)], unique=True)
+        for generation in range (1, 6):
+            collection.insert_one ({'resource': 'a', 'generation': generation})
+        collection.insert_one ({'resource': 'b', 'generation': 1, 'tags': ['x', 'y']})
+        found = collection.find ({'resource': 'a', 'generation': {'$lt': 4}}, {'_id': False})
+        self.assertEqual (list (found.sort ('generation', -1).limit (2)),
+                          [{'resource': 'a', 'generation': 3}, {'resource': 'a', 'generation': 2}])
+        self.assertEqual (collection.count_documents ({'tags': 'x'}), 1)
+        self.assertEqual (collection.count_documents (
+            {'$or': [{'host': {'$exists': False}}, {'host': 'here'}]}), 6)
+        # A missing field equals null
+        self.assertEqual (collection.count_documents ({'tags': {'$in': ['y', None]}}), 6)
+        self.assertEqual (collection.count_documents ({'tags': {'$eq': None}}), 5)
+        self.assertEqual (collection.count_documents ({'tags': {'$ne': None}}), 1)
+        with self.assertRaises (pymongo.errors.DuplicateKeyError):
+            collection.insert_one ({'resource': 'a', 'generation': 2})
+        collection.delete_many ({'resource': 'a'})
+        self.assertEqual (collection.indexes['resource'], {'b': [collection.find_one ()['_id']]})
+
+    def test_bulk_write_and_changes (self):
+        tmpdir = tempfile.TemporaryDirectory ()
+        self.addCleanup (tmpdir.cleanup)
+        db = memory.MemoryDatabase ('winter', tmpdir.name)
+        collection = db.collection (staging.resource_collection)
+        stream = collection.watch ()
+        stage = staging.Stage ('someone')
+        stage.put ({'name': 'a', 'source': 1})
+        stage.put ({'name': 'b', 'source': 2})
+        collection.bulk_write (stage.operations (), ordered=False)
+        stage.put ({'name': 'a', 'source': 3})
+        stage.delete ('b')
+        collection.bulk_write (stage.operations (), ordered=False)
+        changes = [stream.try_next () for count in range (4)]
+        self.assertEqual ([(change['operationType'], change['documentKey']['_id'])
+                           for change in changes],
+                          [('insert', 'a'), ('insert', 'b'), ('replace', 'a'), ('delete', 'b')])
+        self.assertEqual (changes[2]['fullDocument']['source'], 3)
+        self.assertIsNone (stream.try_next ())
+        resumed = collection.watch (resume_after=changes[1]['_id'])
+        self.assertEqual (resumed.try_next ()['documentKey']['_id'], 'a')
+        db.save ()
+        copy = memory.MemoryDatabase ('winter', tmpdir.name)
+        self.assertEqual (list (copy.collection (staging.resource_collection).find ()),
+                          [{'_id': 'a', 'name': 'a', 'source': 3}])
+
+    def test_daemon_reloads_after_history_lost (self):
+        tmpdir = tempfile.TemporaryDirectory ()
+        self.addCleanup (tmpdir.cleanup)
+        db = memory.MemoryDatabase ()
+        resources = db.collection (staging.resource_collection)
+        resources.changes = collections.deque (maxlen=2)
+        resources.insert_one ({'_id': 'gone', 'name': 'gone', 'references': []})
+        daemon = calc.CalcDaemon (db, store.FileStore (tmpdir.name), counter)
+        daemon.load ()
+        daemon.step ()
+        stream = daemon.follow ()
+        resources.delete_one ({'_id': 'gone'})
+        for n in range (3):
+            resources.insert_one ({'_id': 'r{}'.format (n), 'name': 'r{}'.format (n),
+                                   'references': []})
+        daemon.changed.clear ()
+        thread = threading.Thread (target=daemon.watch, args=(stream,), daemon=True)
+        thread.start ()
+        self.addCleanup (daemon.stop)
+        self.assertTrue (daemon.changed.wait (5))
+        daemon.step ()
+        self.assertEqual (daemon.server.values, {'r0': 1, 'r1': 1, 'r2': 1})
+
+    def test_daemon_follows_changes (self):
+        tmpdir = tempfile.TemporaryDirectory ()
+        self.addCleanup (tmpdir.cleanup)
+        filestore = store.FileStore (tmpdir.name)
+        db = memory.MemoryDatabase ()
+        daemon = calc.CalcDaemon (db, filestore, counter, period=0)
+        daemon.listen ()
+        try:
+            stage = staging.Stage ('someone')
+            stage.put ({'name': 'a', 'references': []})
+            stage.put ({'name': 'b', 'references': ['a']})
+            staging.release (stage, db.collection (staging.resource_collection),
+                             calc.CalcServer (counter))
+            deadline = time.monotonic () + 5
+            while (filestore.lookup ('b', 'application/json') is None and
+                   time.monotonic () < deadline):
+                time.sleep (0.01)
+            self.assertIsNotNone (filestore.lookup ('b', 'application/json'))
+            status = db.collection (notify.status_collection).find_one ({'_id': 'b'})
+            self.assertEqual ((status['status'], status['generation']), ('ready', 1))
+        finally:
+            daemon.stop ()
+
+class TestMetrics (unittest.TestCase):
+    def test_exposition (self):
+        registry = metrics.Registry ()
+        counter = registry.counter ("things_total", "Things")
+        self.assertIs (registry.counter ("things_total", "Things"), counter)
+        counter.inc (3)
+        histogram = registry.histogram ("wait_seconds", "Waits", (0.1, 1))
+        for value in (0.05, 0.1, 0.5, 7):
+            histogram.observe (value)
+        registry.gauge ("open", "Open", lambda: 2)
+        text = metrics.exposition ([({"child": "a"}, registry.snapshot ()),
+                                    ({"child": "b"}, registry.snapshot ())])
+        self.assertIn ('things_total{child="b"} 3\n', text)
+        self.assertIn ('wait_seconds_bucket{child="a",le="0.1"} 2\n', text)
+        self.assertIn ('wait_seconds_bucket{child="a",le="+Inf"} 4\n', text)
+        self.assertIn ('wait_seconds_count{child="a"} 4\n', text)
+        self.assertIn ('open{child="a"} 2\n', text)
+        self.assertEqual (text.count ("# TYPE wait_seconds histogram"), 1)
+
+    def test_cascade_metrics (self):
+        before = calc.cascade_size.snapshot ()["counts"]
+        cutoff = calc.cutoff_total.value
+        server = calc.CalcServer (lambda resource, inputs, generation: 1)
+        server.change ([{'name': 'a', 'references': []}, {'name': 'b', 'references': ['a']}])
+        server.change ([{'name': 'a', 'references': []}])
+        self.assertEqual (sum (calc.cascade_size.snapshot ()["counts"]) - sum (before), 2)
+        self.assertEqual (calc.cutoff_total.value - cutoff, 1)
+
+class TestCluster (unittest.TestCase):
+    def test_lease_expiry (self):
+        queue = cluster.WorkQueue (memory.MemoryDatabase ().collection ('calcqueue'), lease=0.05)
+        queue.put ('b', [('one', cluster.encodeUnits ([(0, [({'name': 'a'}, {}, 1)])]))])
+        self.assertIsNone (queue.claim ('two'))
+        task = queue.claim ('one')
+        self.assertEqual (cluster.decodeUnits (task['units']), [(0, [({'name': 'a'}, {}, 1)])])
+        self.assertIsNone (queue.claim ('two'))
+        time.sleep (0.1)
+        # The lease of one ran out, so two takes over and one can't complete
+        self.assertEqual (queue.claim ('two')['_id'], task['_id'])
+        self.assertFalse (queue.complete (task, 'one', []))
+        self.assertEqual (queue.finished ('b'), [])
+
+    def test_lease_bounds (self):
+        queue = cluster.WorkQueue (memory.MemoryDatabase ().collection ('calcqueue'),
+                                   lease=0.05, max_attempts=2, max_lease=0.1)
+        queue.put ('b', [('one', cluster.encodeUnits ([(0, [({'name': 'a'}, {}, 1)])]))])
+        # Leases running out max_attempts times fail the task
+        for node in ('one', 'two'):
+            task = queue.claim (node)
+            self.assertEqual (task['owner'], node)
+            time.sleep (0.1)
+        self.assertIsNone (queue.claim ('three'))
+        queue.expire ('b')
+        self.assertEqual ([task['state'] for task in queue.finished ('b')], ['failed'])
+        # Renewing can't keep a task past max_lease
+        queue.put ('c', [('one', cluster.encodeUnits ([(0, [({'name': 'a'}, {}, 1)])]))])
+        stopped = threading.Event ()
+        looping = lambda units: stopped.wait ()
+        self.addCleanup (stopped.set)
+        task = queue.claim ('one')
+        self.assertFalse (cluster.work (queue, 'one', task, None,
+                                        argparse.Namespace (run=looping)))
+        self.assertEqual (queue.collection.find_one ({'batch': 'c'})['state'], 'ready')
+
+    def test_values_round_trip (self):
+        values = [None, True, 1.5, 'text', b'data', 2 ** 70, -2 ** 63, (1, 2), {3, 4},
+                  frozenset ([5]), 1 + 2j, datetime.datetime (2026, 1, 2, 3, 4, 5, 6),
+                  [{'a': (1,)}], {1: 'one', 'a.b': 2, '$c': 3, '~': 4, 'plain': [5]}]
+        for value in values:
+            document = bson.decode (bson.encode ({'value': cluster.encodeValue (value)}))
+            decoded = cluster.decodeValue (document['value'])
+            self.assertEqual (decoded, value)
+            self.assertIs (type (decoded), type (value))
+        with self.assertRaises (TypeError):
+            cluster.encodeValue (object ())
+        # A value that can't be stored is the error of its resource only
+        [(position, values)] = cluster.decodeResults (cluster.encodeResults (
+            [(0, [(object (), 0.5, None), (2 ** 64, 0.5, None)])]))
+        self.assertIsNone (values[0][0])
+        self.assertIn ("can't be stored", values[0][2])
+        self.assertEqual (values[1], (2 ** 64, 0.5, None))
+
+    def test_partitioner_keeps_chains (self):
+        partitioner = cluster.Partitioner ()
+        partitioner.setNodes (['one', 'two'])
+        nodes = {}
+        # Two chains, a level of each at a time, as cascades go
+        for number in range (5):
+            for chain in ('a', 'b'):
+                inputs = {'{}{}'.format (chain, number - 1): None} if number else {}
+                name = '{}{}'.format (chain, number)
+                nodes[name] = partitioner.place ([({'name': name}, inputs, 1)])
+        self.assertEqual (len (set (nodes[name] for name in nodes if name[0] == 'a')), 1)
+        self.assertNotEqual (nodes['a4'], nodes['b4'])
+        partitioner.setNodes (['two'])
+        self.assertEqual (partitioner.place ([({'name': 'a4'}, {}, 1)]), 'two')
+
+    def test_workers_match_serial (self):
+        db = memory.MemoryDatabase ()
+        worker = cluster.CalcWorker (db, counter, node='one')
+        worker.listen ()
+        self.addCleanup (worker.stop)
+        executor = cluster.QueueExecutor (db, counter, batch=2)
+        executor.refresh (force=True)
+        self.assertEqual (executor.nodes, ['one'])
+        resources = [{'name': 'n{}'.format (number),
+                      'references': ['n{}'.format (number - 1)] if number % 3 else []}
+                     for number in range (12)]
+        server = calc.CalcServer (counter, executor=executor)
+        server.change (resources)
+        serial = calc.CalcServer (counter)
+        serial.change (resources)
+        self.assertEqual (server.values, serial.values)
+        self.assertGreater (cluster.tasks_total.value, 0)
+        self.assertEqual (db.collection ('calcqueue').count_documents ({}), 0)
+
+class TestSupervisor (unittest.TestCase):
+    def test_backoff_and_stats (self):
+        supervisor = initiate.Supervisor (argparse.Namespace (), min_backoff=1, max_backoff=8)
+        self.assertEqual ([supervisor.backoff (n) for n in range (1, 7)], [1, 2, 4, 8, 8, 8])
+        stats = initiate.processStats (os.getpid ())
+        if (stats is not None):
+            self.assertGreater (stats["rss"], 0)
+            self.assertGreaterEqual (stats["cpu"], 0)
+        self.assertIsNone (initiate.processStats (-1))
+
+    def test_startup_grace (self):
+        supervisor = initiate.Supervisor (argparse.Namespace (), timeout=15)
+        child = initiate.Child ({'component': 'daemon', 'setup': {'startupTimeout': 60}}, 'daemon')
+        child.heartbeat = multiprocessing.Value ('d', 0.0)
+        child.launched = time.time () - 30
+        child.started = time.monotonic () - 30
+        child.restart_at = float ('inf')
+        killed = []
+        child.process = argparse.Namespace (is_alive=lambda: not killed,
+                                            kill=lambda: killed.append (True),
+                                            join=lambda: None, exitcode=-9)
+        supervisor.children['daemon'] = child
+        # Still loading, so not beating yet, within its startup timeout
+        supervisor.check ()
+        self.assertEqual (killed, [])
+        # Once beating, a stale heartbeat gets it killed
+        child.heartbeat.value = time.time () - 20
+        supervisor.check ()
+        self.assertEqual (killed, [True])
+
+    def test_web_workers (self):
+        supervisor = initiate.Supervisor (argparse.Namespace ())
+        workers = supervisor.workers ({
+            'w': {'_id': 'w', 'component': 'web', 'setup': {'workers': 3}},
+            'd': {'_id': 'd', 'component': 'daemon'}})
+        self.assertEqual (sorted (workers), [('d', 0), ('w', 0), ('w', 1), ('w', 2)])
+        self.assertEqual (workers[('w', 2)][1], 'web w #2')
+        self.assertEqual (workers[('d', 0)][1], 'daemon d')
+
+class ListCollection (object):
+    '''Stands in for a collection of revisions, answering what History asks.'''
+    def __init__ (self):
+        self.documents = []
+    def create_index (self, keys, unique=False):
+        pass
+    def insert_one (self, document):
+        self.documents.append (dict (document))
+    def find (self, query, projection=None):
+        found = [dict (d) for d in self.documents if d['resource'] == query['resource']]
+        generation = query.get ('generation')
+        if (isinstance (generation, int)):
+            found = [d for d in found if d['generation'] == generation]
+        elif (generation is not None):
+            if ('$lt' in generation):
+                found = [d for d in found if d['generation'] < generation['$lt']]
+            if ('$lte' in generation):
+                found = [d for d in found if d['generation'] <= generation['$lte']]
+            if ('$gte' in generation):
+                found = [d for d in found if d['generation'] >= generation['$gte']]
+        return ListCursor (found)
+
+class ListCursor (object):
+    def __init__ (self, documents):
+        self.documents = documents
+    def sort (self, key, direction):
+        self.documents.sort (key=lambda d: d[key], reverse=direction < 0)
+        return self
+    def limit (self, count):
+        self.documents = self.documents[:count]
+        return self
+    def __iter__ (self):
+        return iter (self.documents)
+
+class TestHistory (unittest.TestCase):
+    def test_cursor_pages (self):
+        revisions = history.History (ListCollection ())
+        for generation in range (1, 26):
+            revisions.record ('a', generation, 'v{}'.format (generation))
+        revisions.record ('b', 1, 'other')
+        page, cursor = revisions.page ('a', size=10)
+        self.assertEqual ([r['generation'] for r in page], list (range (25, 15, -1)))
+        page, cursor = revisions.page ('a', before=cursor, size=10)
+        page, cursor = revisions.page ('a', before=cursor, size=10)
+        self.assertEqual ([r['content'] for r in page], ['v5', 'v4', 'v3', 'v2', 'v1'])
+        self.assertIsNone (cursor)
+
+    def test_deltas (self):
+        collection = ListCollection ()
+        revisions = history.History (collection, max_deltas=3)
+        lines = ['line {}\n'.format (n) for n in range (100)]
+        for generation in range (1, 7):
+            lines[generation] = 'changed {}\n'.format (generation)
+            revisions.record ('a', generation, ''.join (lines))
+        revisions.record ('a', 7, b'\x00binary')
+        kinds = ['snapshot' if 'snapshot' in d else d['base'] for d in collection.documents]
+        self.assertEqual (kinds, ['snapshot', 1, 1, 1, 'snapshot', 5, 'snapshot'])
+        # Rebuilt from the collection alone
+        fresh = history.History (collection)
+        self.assertTrue (fresh.get ('a', 6).startswith ('line 0\nchanged 1\n'))
+        self.assertEqual (fresh.get ('a', 6).count ('changed'), 6)
+        self.assertEqual (fresh.get ('a', 3).count ('changed'), 3)
+        self.assertEqual (fresh.get ('a', 7), b'\x00binary')
+        self.assertIsNone (fresh.get ('a', 8))
+
+class TestStore (unittest.TestCase):
+    def setUp (self):
+        self.tmpdir = tempfile.TemporaryDirectory ()
+        self.store = store.FileStore (self.tmpdir.name, keep=1)
+
+    def tearDown (self):
+        self.tmpdir.cleanup ()
+
+    def test_publish_lookup (self):
+        self.store.publish ('a/b', 1, {
+            ('text/html', 'en'): b'<p>hi</p>',
+            ('text/plain', ''): b'hi'})
+        path, generation, digest, size = self.store.lookup ('a/b', 'text/html', 'en')
+        with open (path, 'rb') as content:
+            self.assertEqual (content.read (), b'<p>hi</p>')
+        self.assertEqual ((generation, size), (1, 9))
+        self.assertIsNone (self.store.lookup ('a/b', 'text/html', 'fr'))
+        self.assertIsNone (self.store.lookup ('missing', 'text/plain'))
+
+    def test_encoded_variants (self):
+        text = b'<p>' + b'winter ' * 200 + b'</p>'
+        self.store.publish ('page', 1, {('text/html', ''): text,
+                                        ('image/png', ''): bytes (range (256)) * 4})
+        path = self.store.lookup ('page', 'text/html', '', 'gzip')[0]
+        with open (path, 'rb') as content:
+            self.assertEqual (gzip.decompress (content.read ()), text)
+        self.assertIsNone (self.store.lookup ('page', 'image/png', '', 'gzip'))
+        self.assertEqual (sorted (variant['encoding'] for variant in self.store.index (
+            'page')['variants']), sorted (['', ''] + list (store.compressors)))
+
+    def test_collect_superseded (self):
+        self.store.publish ('a', 1, {('text/plain', ''): b'one'})
+        old = self.store.lookup ('a', 'text/plain')[0]
+        self.store.publish ('a', 2, {('text/plain', ''): b'two'})
+        self.assertEqual (self.store.collect (grace=3600), 0)
+        self.assertEqual (self.store.collect (grace=-1), 1)
+        self.assertFalse (os.path.exists (old))
+        self.assertTrue (os.path.exists (self.store.lookup ('a', 'text/plain')[0]))
+        self.assertEqual (os.listdir (self.store.tmp), [])
+
+class TestNamespace (unittest.TestCase):
+    def test_trie (self):
+        names = namespace.Namespace ()
+        for name in ('a/b', 'a/b/c', 'a/d', 'x'):
+            names.add (name)
+        self.assertIn ('a//b/', names)
+        self.assertNotIn ('a', names)
+        self.assertEqual (names.children ('a'), [('b', True, True), ('d', True, False)])
+        self.assertEqual (list (names.names ('a')), ['a/b', 'a/b/c', 'a/d'])
+        names.remove ('a/b/c')
+        names.remove ('a/d')
+        self.assertEqual (names.children ('a'), [('b', True, False)])
+        names.remove ('a/b')
+        self.assertIsNone (names.children ('a'))
+        self.assertEqual (len (names), 1)
+
+    def test_follows_store (self):
+        tmpdir = tempfile.TemporaryDirectory ()
+        self.addCleanup (tmpdir.cleanup)
+        filestore = store.FileStore (tmpdir.name)
+        names = namespace.Namespace (filestore)
+        filestore.publish ('p/q', 1, {('text/plain', ''): b'q'})
+        filestore.publish ('p/q', 2, {('text/plain', ''): b'Q'})
+        filestore.publish ('p/r', 1, {('text/plain', ''): b'r'})
+        names.refresh ()
+        self.assertEqual (list (names.names ()), ['p/q', 'p/r'])
+        filestore.remove ('p/q')
+        names.refresh ()
+        self.assertEqual (list (names.names ()), ['p/r'])
+        size = os.path.getsize (filestore.namesPath ())
+        filestore.collect ()
+        self.assertLess (os.path.getsize (filestore.namesPath ()), size)
+        names.refresh ()
+        self.assertEqual (list (names.names ()), ['p/r'])
+
+class TestDatabase (unittest.TestCase):
+    def test_shared_and_lazy (self):
+        options = argparse.Namespace (dbhost='127.0.0.1', dbport=1, dbname='winter',
+                                      dbuser=None, dbpassword=None, dbpoolsize=5)
+        db = database.connect (options)
+        self.assertIs (db, database.connect (options))
+        self.assertIsNone (db._client)
+        self.assertEqual (db.client.options.pool_options.max_pool_size, 5)
+        copy = pickle.loads (pickle.dumps (db))
+        self.assertIsNone (copy._client)
+        db.close ()
+
+class TestWeb (tornado.testing.AsyncHTTPTestCase):
+    def get_app (self):
+        self.tmpdir = tempfile.TemporaryDirectory ()
+        self.addCleanup (self.tmpdir.cleanup)
+        self.revisions = history.History (ListCollection ())
+        self.server = web.WebServer (self.tmpdir.name, history=self.revisions)
+        self.server.filestore.publish ('a/b', 7, {('text/plain', ''): b'0123456789'})
+        return self.server.application ()
+
+    def test_metrics (self):
+        self.fetch ('/a/b')
+        response = self.fetch ('/+/metrics')
+        self.assertEqual (response.code, 200)
+        self.assertIn (b'# TYPE web_request_seconds histogram', response.body)
+
+    def test_get_and_not_modified (self):
+        response = self.fetch ('/a//b')
+        self.assertEqual ((response.code, response.body), (200, b'0123456789'))
+        etag = response.headers['ETag']
+        self.assertTrue (etag.startswith ('"g7-'))
+        response = self.fetch ('/a/b', headers={'If-None-Match': etag})
+        self.assertEqual ((response.code, response.body), (304, b''))
+        self.assertEqual (self.fetch ('/a/c').code, 404)
+
+    def test_history (self):
+        for generation in range (1, 4):
+            self.revisions.record ('a/b', generation, 'v{}'.format (generation))
+        response = json.loads (self.fetch ('/a/b/+/history?size=2').body)
+        self.assertEqual ([r['generation'] for r in response['revisions']], [3, 2])
+        response = json.loads (self.fetch ('/a/b/+/history?size=2&before={}'.format (
+            response['next'])).body)
+        self.assertEqual ((response['revisions'][0]['content'], response['next']), ('v1', None))
+        self.assertEqual (self.fetch ('/+/history?before=x').code, 400)
+
+    def test_children (self):
+        self.server.filestore.publish ('a/c', 1, {('text/plain', ''): b'c'})
+        response = json.loads (self.fetch ('/a/+?size=1').body)
+        self.assertEqual ((response['resource'], response['next']), (False, 'b'))
+        self.assertEqual (response['children'], [{'name': 'b', 'resource': True, 'children': False}])
+        response = json.loads (self.fetch ('/a/+?after=b').body)
+        self.assertEqual ([child['name'] for child in response['children']], ['c'])
+        self.assertEqual ([child['name'] for child in json.loads (
+            self.fetch ('/+').body)['children']], ['a'])
+        self.assertEqual (self.fetch ('/nothing/+').code, 404)
+
+    def test_negotiation (self):
+        variants = [{'mime': 'text/html', 'language': 'en', 'encoding': ''},
+                    {'mime': 'text/html', 'language': 'en', 'encoding': 'gzip'},
+                    {'mime': 'text/html', 'language': 'fr', 'encoding': ''},
+                    {'mime': 'application/json', 'language': '', 'encoding': ''}]
+        choose = lambda *headers: variants.index (web.negotiate (variants, *headers))
+        self.assertEqual (choose ('', '', ''), 0)
+        self.assertEqual (choose ('text/*;q=0.5, application/json', '', 'gzip'), 3)
+        self.assertEqual (choose ('text/html', 'de, fr-CA;q=0.1, fr;q=0.8', 'gzip'), 2)
+        self.assertEqual (choose ('*/*', 'en-US', 'gzip;q=0.5, identity;q=0.1'), 1)
+        self.assertEqual (choose ('*/*', 'en', 'gzip;q=0'), 0)
+        text = b'winter ' * 200
+        self.server.filestore.publish ('big', 1, {('text/plain', ''): text})
+        response = self.fetch ('/big', headers={'Accept-Encoding': 'gzip'},
+                               decompress_response=False)
+        self.assertEqual (response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual (gzip.decompress (response.body), text)
+        response = self.fetch ('/big', headers={'Accept-Encoding': 'identity'},
+                               decompress_response=False)
+        self.assertEqual ((response.body, response.headers.get ('Content-Encoding')), (text, None))
+
+    def test_ranges (self):
+        response = self.fetch ('/a/b', headers={'Range': 'bytes=2-4'})
+        self.assertEqual ((response.code, response.body), (206, b'234'))
+        self.assertEqual (response.headers['Content-Range'], 'bytes 2-4/10')
+        response = self.fetch ('/a/b', headers={'Range': 'bytes=-3'})
+        self.assertEqual (response.body, b'789')
+        response = self.fetch ('/a/b', headers={'Range': 'bytes=20-'})
+        self.assertEqual (response.code, 416)
+        response = self.fetch ('/a/b', headers={'Range': 'bytes=2-4', 'If-Range': '"old"'})
+        self.assertEqual ((response.code, response.body), (200, b'0123456789'))
+
+    def test_workers_share_port (self):
+        sock, port = tornado.testing.bind_unused_port ()
+        sock.close ()
+        workers = [web.WebServer (self.tmpdir.name, port=port, reuse_port=True)
+                   for count in range (2)]
+        for worker in workers:
+            worker.listen ()
+        response = self.fetch ('http://127.0.0.1:{}/a/b'.format (port))
+        self.assertEqual (response.body, b'0123456789')
+        for worker in workers:
+            worker.server.stop ()
+
+class TestNotify (tornado.testing.AsyncHTTPTestCase):
+    def get_app (self):
+        self.server = notify.NotifyServer (window=0.01)
+        return self.server.application ()
+
+    @tornado.testing.gen_test
+    async def test_subscribe_and_coalesce (self):
+        url = 'ws://127.0.0.1:{}/'.format (self.get_http_port ())
+        connection = await tornado.websocket.websocket_connect (url)
+        connection.write_message (json.dumps ({'subscribe': ['a', 'b']}))
+        await tornado.gen.sleep (0.05)
+        self.assertEqual (set (self.server.subscribers), {'a', 'b'})
+        for generation in (1, 2, 3):
+            self.server.publish ({'resource': 'a', 'generation': generation,
+                                  'status': 'computing', 'eta': None})
+        self.server.publish ({'resource': 'z', 'generation': 1,
+                              'status': 'ready', 'eta': None})
+        message = json.loads (await connection.read_message ())
+        self.assertEqual ((message['resource'], message['generation']), ('a', 3))
+        connection.close ()
+        await tornado.gen.sleep (0.05)
+        self.assertEqual (self.server.subscribers, {})
+
+    def test_slow_client_held_back (self):
+        class SlowHandler (notify.NotifyHandler):
+            def __init__ (self, server):
+                self.initialize (server)
+                self.written = []
+                self.closed = None
+            def write_message (self, data):
+                self.written.append (json.loads (data))
+                return tornado.concurrent.Future ()
+            def close (self, code=None, reason=None):
+                self.closed = code
+        self.server.max_buffer = 100
+        self.server.max_lag = 0
+        handler = SlowHandler (self.server)
+        self.server.subscribe (handler, ['a', 'b'])
+        for generation in range (1, 20):
+            for name in ('a', 'b'):
+                handler.queue ({'resource': name, 'generation': generation,
+                                'status': 'computing', 'eta': None})
+            handler.drain ()
+        # Two sent before going over the buffer, then only the latest waits
+        self.assertEqual (len (handler.written), 2)
+        self.assertEqual ({m['generation'] for m in handler.pending.values ()}, {19})
+        handler.checkLag ()
+        self.assertEqual (handler.closed, 1013)
+
+class FeedHandler (tornado.web.RequestHandler):
+    '''Serves a feed with an ETag, counting full responses.'''
+    def initialize (self, state):
+        self.state = state
+
+    def get (self):
+        etag = '"{}"'.format (self.state['version'])
+        if (self.request.headers.get ('If-None-Match') == etag):
+            self.set_status (304)
+            return
+        self.state['sent'] += 1
+        self.set_header ('ETag', etag)
+        self.write (self.state['body'])
+
+class TestRefresh (tornado.testing.AsyncHTTPTestCase):
+    def get_app (self):
+        self.state = {'version': 1, 'body': 'news', 'sent': 0}
+        return tornado.web.Application ([('/feed', FeedHandler, dict (state=self.state))])
+
+    @tornado.testing.gen_test
+    async def test_cascade_only_on_change (self):
+        server = calc.CalcServer ()
+        changed = threading.Event ()
+        scheduler = refresh.RefreshScheduler (server, changed)
+        scheduler.add ({'name': 'feed', 'url': self.get_url ('/feed'), 'refresh': 60})
+        scheduler.add ({'name': 'uname', 'command': ['echo', 'hi'], 'refresh': 60})
+        feed = scheduler.feeds['feed']
+        self.assertTrue (await scheduler.refresh (feed))
+        self.assertTrue (changed.is_set ())
+        self.assertEqual (server.step (), ['feed'])
+        self.assertEqual (server.values['feed'], 'news')
+        # The content submitted keeps the feed on schedule
+        due = feed.due
+        scheduler.add (server.resources['feed'])
+        self.assertEqual (scheduler.feeds['feed'].due, due)
+        # Not modified, then modified but same content
+        self.assertFalse (await scheduler.refresh (feed))
+        self.state['version'] = 2
+        self.assertFalse (await scheduler.refresh (feed))
+        self.assertEqual (self.state['sent'], 2)
+        self.state['body'] = 'more news'
+        self.state['version'] = 3
+        self.assertTrue (await scheduler.refresh (feed))
+        server.step ()
+        self.assertEqual (server.generations['feed'], 2)
+        self.assertTrue (await scheduler.refresh (scheduler.feeds['uname']))
+        server.step ()
+        self.assertEqual (server.values['uname'], 'hi\n')
+        # Each refresh scheduled the next one, within jitter of the period
+        self.assertTrue (all (due > time.monotonic () + 50 for due, name in scheduler.heap[-2:]))
 
 if __name__ == '__main__':
     unittest.main ()
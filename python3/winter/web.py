@@ -3,6 +3,10 @@
 # License located at http://www.gnu.org/licenses/agpl-3.0.html
 '''
 Web server that provides the web interface to Winter.
+
+Resources are always delivered as last calculated by the calc server, straight
+from the files of the store.FileStore, so viewing a resource never touches the
+database or runs any code.
 '''
 
 # Requires version 3, say it now rather than fail mysteriously later.
@@ -12,19 +16,404 @@ if (sys.version_info.major < 3):
     exit ("Requires python 3")
 
 # Library imports
+import base64
+import bisect
+import collections
+import mmap
+import os
 import pymongo
+import re
+import time
+import tornado.gen
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
 
 # Import the current package to get package vars like winter.software_name
 import winter
+from winter import metrics, namespace, store
 
 # Module short description
 module_description = "web server module"
 
+# Bytes of a file written before waiting for the client to take them
+chunk_size = 256 * 1024
+
+# Metrics of the web server, see metrics
+requests_total = metrics.registry.counter (
+    "web_requests_total", "Requests answered")
+request_seconds = metrics.registry.histogram (
+    "web_request_seconds", "Seconds to answer a request")
+
+def normalizeResource (resource):
+    '''Fix unruly slashes in the resource path.'''
+    # Replace multiple slashes with one slash throughout entire path, when there are any
+    if ('//' in resource):
+        resource = re.sub (r'//+', r'/', resource)
+    # If after all replacement, there is only one slash left and nothing else, remove it
+    if (resource == '/'):
+        return ''
+    return resource
+
+def parseRange (header, size):
+    '''
+    Parse a Range header of a single byte range, like "bytes=0-99",
+    "bytes=100-", or "bytes=-100" (the last 100 bytes).
+
+    Returns (start, end) with end exclusive, or None when the header should be
+    ignored and the whole content sent, which includes multiple ranges.
+    Raises ValueError when the range can't be satisfied.
+    '''
+    unit, _, ranges = header.partition ("=")
+    if (unit.strip () != "bytes" or "," in ranges):
+        return None
+    first, dash, last = ranges.strip ().partition ("-")
+    if (not dash or not (first.isdigit () or last.isdigit ())):
+        return None
+    if (not first):
+        # Suffix range, the last so many bytes
+        length = int (last)
+        if (length == 0):
+            raise ValueError ("empty suffix range")
+        return (max (0, size - length), size)
+    start = int (first)
+    if (last and not last.isdigit ()):
+        return None
+    end = min (int (last) + 1, size) if last else size
+    if (start >= size or start >= end):
+        raise ValueError ("range outside content")
+    return (start, end)
+
+# Preference among encodings a client accepts equally, smallest usually first
+encoding_rank = {"br": 3, "zstd": 2, "gzip": 1, "": 0}
+
+# Choices of variant remembered per resource, by request headers
+choices_size = 64
+
+def parsePreferences (header):
+    '''
+    Parse an Accept, Accept-Language, or Accept-Encoding header into a tuple
+    of (value, q), lowercase, most preferred first, leaving out those with q
+    of 0, which are not acceptable.
+    '''
+    preferences = []
+    for position, item in enumerate (header.split (",")):
+        value, _, parameters = item.partition (";")
+        value = value.strip ().lower ()
+        q = 1.0
+        for parameter in parameters.split (";"):
+            key, _, number = parameter.partition ("=")
+            if (key.strip () == "q"):
+                try:
+                    q = float (number)
+                except ValueError:
+                    q = 0.0
+        if (value and q > 0):
+            preferences.append ((-q, position, value))
+    return tuple ((value, -q) for q, position, value in sorted (preferences))
+
+def matchesMime (pattern, mime):
+    base = mime.split (";")[0].strip ().lower ()
+    return (pattern == base or pattern == "*/*" or
+            (pattern.endswith ("/*") and base.startswith (pattern[:-1])))
+
+def matchesLanguage (pattern, language):
+    language = language.lower ()
+    return (pattern == language or language.startswith (pattern + "-") or
+            (pattern == "*" and language != ""))
+
+def choose (available, preferences, matches):
+    '''Return the first of available matching the best preference, or None.'''
+    for pattern, q in preferences:
+        for value in available:
+            if (matches (pattern, value)):
+                return value
+    return None
+
+def negotiate (variants, accept, accept_language, accept_encoding):
+    '''
+    Return the variant, of those of an index, that best suits the Accept,
+    Accept-Language, and Accept-Encoding headers, using their q-values.  The
+    mime type is chosen first, then the language, then the encoding; when
+    none is acceptable, the first published is used, and unencoded content
+    when no encoding is.
+    '''
+    mimes = list (dict.fromkeys (variant["mime"] for variant in variants))
+    mime = choose (mimes, parsePreferences (accept), matchesMime) or mimes[0]
+    variants = [variant for variant in variants if variant["mime"] == mime]
+    languages = list (dict.fromkeys (variant["language"] for variant in variants))
+    language = (choose (languages, parsePreferences (accept_language), matchesLanguage)
+                or languages[0])
+    variants = [variant for variant in variants if variant["language"] == language]
+    encodings = dict (parsePreferences (accept_encoding))
+
+    def quality (variant):
+        encoding = variant.get ("encoding", "")
+        if (not encoding):
+            return (encodings.get ("identity", 0.001), 0)
+        return (encodings.get (encoding, encodings.get ("*", 0)), encoding_rank.get (encoding, 0))
+
+    best = max (variants, key=quality)
+    return best if quality (best)[0] > 0 else variants[0]
+
+def matchesETag (header, etag):
+    '''True if an If-None-Match header matches etag, using weak comparison.'''
+    if (header.strip () == "*"):
+        return True
+    tags = [tag.strip () for tag in header.split (",")]
+    return etag in [tag[2:] if tag.startswith ("W/") else tag for tag in tags]
+
+class ServerHandler (tornado.web.RequestHandler):
+    '''
+    Base of the handlers of the web server, which keeps track of requests in
+    progress so it can let them finish before stopping.
+    '''
+    def initialize (self, server):
+        self.server = server
+
+    def prepare (self):
+        self.server.active.add (self)
+
+    def on_finish (self):
+        self.server.active.discard (self)
+        requests_total.inc ()
+        request_seconds.observe (self.request.request_time ())
+
+    def on_connection_close (self):
+        self.server.active.discard (self)
+
+class ResourceHandler (ServerHandler):
+    '''
+    Delivers the last calculated version of a resource from the file store,
+    with a strong ETag for conditional requests, and single byte ranges.
+    '''
+    SUPPORTED_METHODS = ("GET", "HEAD")
+
+    async def get (self, resource):
+        name = normalizeResource (resource)
+        headers = self.request.headers
+        variant = self.server.lookup (
+            name, headers.get ("Accept", ""), headers.get ("Accept-Language", ""),
+            headers.get ("Accept-Encoding", ""))
+        if (variant is None):
+            raise tornado.web.HTTPError (404)
+        mime, language, encoding, path, generation, digest, size = variant
+
+        etag = '"g{}-{}"'.format (generation, digest[:16])
+        self.set_header ("ETag", etag)
+        self.set_header ("Cache-Control", "no-cache")
+        self.set_header ("Vary", "Accept, Accept-Language, Accept-Encoding")
+        if (matchesETag (headers.get ("If-None-Match", ""), etag)):
+            self.set_status (304)
+            return
+
+        self.set_header ("Content-Type", mime)
+        if (language):
+            self.set_header ("Content-Language", language)
+        if (encoding):
+            self.set_header ("Content-Encoding", encoding)
+        self.set_header ("Accept-Ranges", "bytes")
+        start, end = 0, size
+        if ("Range" in headers and headers.get ("If-Range", etag) == etag):
+            try:
+                byte_range = parseRange (headers["Range"], size)
+            except ValueError:
+                self.set_status (416)
+                self.set_header ("Content-Range", "bytes */{}".format (size))
+                return
+            if (byte_range is not None):
+                start, end = byte_range
+                self.set_status (206)
+                self.set_header ("Content-Range", "bytes {}-{}/{}".format (
+                    start, end - 1, size))
+        self.set_header ("Content-Length", end - start)
+        if (self.request.method == "HEAD" or start == end):
+            return
+
+        # Map the file rather than reading it, and hand it over in chunks so
+        # a large file isn't held in memory all at once for a slow client
+        with open (path, 'rb') as content:
+            with mmap.mmap (content.fileno (), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range (start, end, chunk_size):
+                    self.write (mapped[offset:min (offset + chunk_size, end)])
+                    await self.flush ()
+
+    head = get
+
+class HistoryHandler (ServerHandler):
+    '''
+    Lists revisions of a resource as JSON, a page at a time, newest first:
+        GET /name/+/history?before=generation&size=10
+    answers { "revisions": [...], "next": generation or null }, where next is
+    the before of the next page.
+    '''
+
+    async def get (self, resource):
+        if (self.server.history is None):
+            raise tornado.web.HTTPError (404)
+        name = normalizeResource (resource or '')
+        try:
+            before = self.get_query_argument ("before", None)
+            before = int (before) if before is not None else None
+            size = int (self.get_query_argument ("size", "10"))
+        except ValueError:
+            raise tornado.web.HTTPError (400)
+        # The database is only reached from a thread, not to block serving
+        revisions, cursor = await tornado.ioloop.IOLoop.current ().run_in_executor (
+            None, self.server.history.page, name, before, size)
+        for revision in revisions:
+            if (isinstance (revision.get ("content"), bytes)):
+                revision["content"] = {
+                    "base64": base64.b64encode (revision["content"]).decode ('ascii')}
+        self.set_header ("Cache-Control", "no-cache")
+        self.write ({"revisions": revisions, "next": cursor})
+
+class NamespaceHandler (ServerHandler):
+    '''
+    Lists the children of a name in the namespace as JSON, a page at a time:
+        GET /name/+?after=segment&size=100
+    answers { "name": name, "resource": true if a resource has that name,
+    "children": [ { "name": segment, "resource": bool, "children": bool } ],
+    "next": segment or null }, where next is the after of the next page.
+    '''
+
+    def get (self, resource):
+        name = normalizeResource (resource or '')
+        try:
+            size = int (self.get_query_argument ("size", "100"))
+        except ValueError:
+            raise tornado.web.HTTPError (400)
+        after = self.get_query_argument ("after", None)
+        self.server.namespace.refresh ()
+        children = self.server.namespace.children (name)
+        if (children is None):
+            raise tornado.web.HTTPError (404)
+        start = bisect.bisect_right (children, (after, True, True)) if after is not None else 0
+        page = children[start:start + max (1, size)]
+        self.set_header ("Cache-Control", "no-cache")
+        self.write ({
+            "name": name,
+            "resource": name in self.server.namespace,
+            "children": [{"name": segment, "resource": present, "children": below}
+                         for segment, present, below in page],
+            "next": page[-1][0] if start + len (page) < len (children) else None
+        })
+
 class WebServer (object):
     '''
     The web server of Winter.
+
+    Serves the files of a store.FileStore, keeping the index of each resource
+    read so far until its file is replaced, so most requests cost one stat.
+    The variant chosen for each combination of request headers is kept with
+    it, so negotiating content, including its encoding, is one lookup.
+    With a history.History, also serves the history of resources.  The
+    metrics of the process are served as /+/metrics, and the children of
+    each name in the namespace as /name/+, see namespace.
+
+    Serving is nearly all reading files, so to use more than one core, run
+    several web servers in separate processes with reuse_port, which lets them
+    all listen on the same port with the kernel spreading connections among
+    them; initiate.Supervisor does that for the workers of a web component.
     '''
-    pass
+    def __init__ (self, filestore, address="127.0.0.1", port=8080, cache_size=100000,
+                  history=None, reuse_port=False):
+        if (isinstance (filestore, str)):
+            filestore = store.FileStore (filestore)
+        self.filestore = filestore
+        self.history = history
+        self.address = address
+        self.port = port
+        self.cache_size = cache_size
+        self.reuse_port = reuse_port
+        self.indexes = collections.OrderedDict ()    # name -> (stat key, index, choices)
+        self.active = set ()                         # requests in progress
+        self.namespace = namespace.Namespace (self.filestore)
+        self.server = None
+
+    def application (self):
+        '''Return the tornado application of the web server.'''
+        return tornado.web.Application ([
+            (r"/\+/metrics", metrics.MetricsHandler),
+            (r"/(?:(.*)/)?\+/history", HistoryHandler, dict (server=self)),
+            (r"/(?:(.*)/)?\+", NamespaceHandler, dict (server=self)),
+            (r"/(.*)", ResourceHandler, dict (server=self))
+        ])
+
+    def listen (self):
+        '''Start accepting connections on the current IOLoop.'''
+        sockets = tornado.netutil.bind_sockets (self.port, self.address,
+                                                reuse_port=self.reuse_port)
+        self.server = tornado.httpserver.HTTPServer (self.application ())
+        self.server.add_sockets (sockets)
+
+    def run (self):
+        '''Serve until the IOLoop is stopped.'''
+        self.listen ()
+        tornado.ioloop.IOLoop.current ().start ()
+
+    async def drain (self, timeout=30):
+        '''
+        Stop accepting connections, give requests in progress up to timeout
+        seconds to finish, then close all connections.
+        '''
+        self.server.stop ()
+        deadline = time.monotonic () + timeout
+        while (self.active and time.monotonic () < deadline):
+            await tornado.gen.sleep (0.1)
+        await self.server.close_all_connections ()
+
+    def entry (self, name):
+        '''
+        Return (index, choices) of a resource, or None when it isn't
+        published, where choices maps request headers to the variant of the
+        index chosen for them so far.
+        '''
+        try:
+            stat = os.stat (self.filestore.indexPath (name))
+        except FileNotFoundError:
+            self.indexes.pop (name, None)
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached = self.indexes.get (name)
+        if (cached is not None and cached[0] == key):
+            self.indexes.move_to_end (name)
+            return cached[1:]
+        index = self.filestore.index (name)
+        if (index is None):
+            return None
+        self.indexes[name] = (key, index, {})
+        if (len (self.indexes) > self.cache_size):
+            self.indexes.popitem (last=False)
+        return (index, self.indexes[name][2])
+
+    def index (self, name):
+        '''Return the published index of a resource, or None.'''
+        entry = self.entry (name)
+        return entry[0] if entry is not None else None
+
+    def lookup (self, name, accept, accept_language, accept_encoding=""):
+        '''
+        Return (mime, language, encoding, path, generation, digest, size) of
+        the variant of a resource to deliver, or None if there is none, as
+        chosen by negotiate for the Accept, Accept-Language, and
+        Accept-Encoding headers.
+        '''
+        entry = self.entry (name)
+        if (entry is None or not entry[0]["variants"]):
+            return None
+        index, choices = entry
+        headers = (accept, accept_language, accept_encoding)
+        chosen = choices.get (headers)
+        if (chosen is None):
+            chosen = negotiate (index["variants"], *headers)
+            if (len (choices) >= choices_size):
+                choices.clear ()
+            choices[headers] = chosen
+        return (chosen["mime"], chosen["language"], chosen.get ("encoding", ""),
+                self.filestore.objectPath (chosen["digest"]),
+                index["generation"], chosen["digest"], chosen["size"])
 
 # Running modules as top-level scripts is an antipattern, use bin/snow instead
 if __name__ == '__main__':
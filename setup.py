@@ -50,6 +50,8 @@ setup (
     scripts = [os.path.join (base_dir, 'bin', 'runtests'),
                os.path.join (base_dir, 'bin', 'snow')],
     install_requires = ['pymongo', 'tornado'],
+    # Optional compression of published variants, besides gzip
+    extras_require = {'compression': ['brotli', 'zstandard']},
     package_data = {
         # If any package contains *.txt or *.rst files, include them:
         '': ['*.txt', '*.rst', '*.md'],